@@ -0,0 +1,162 @@
+import argparse
+import json
+import select
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+#every streamed token starts with its send time, so the client can tell how long it took to reach the screen
+def stampToken(size):
+    stamp = f" t{time.monotonic_ns():x}"
+    return stamp + "x" * max(0, size - len(stamp))
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    #kept so stop can drop kept alive connections too, like a server going away would
+    def setup(self):
+        super().setup()
+        self.server.connections.add(self.connection)
+
+    def finish(self):
+        self.server.connections.discard(self.connection)
+        super().finish()
+
+    def reply(self, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def sendChunk(self, body):
+        line = (json.dumps(body) + "\n").encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/version":
+            self.reply({"version": "0.0.0-bench"})
+        elif self.path == "/api/tags":
+            self.reply({"models": [{"model": model, "name": model, "size": 0, "digest": "bench"} for model in self.server.models]})
+        elif self.path == "/api/ps":
+            self.reply({"models": [{"model": model, "name": model} for model in self.server.loaded]})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path == "/api/show":
+            self.reply({"parameters": f"num_ctx {self.server.numCtx}", "model_info": {}, "modelfile": "", "template": "",
+                        "details": {}})
+        elif self.path == "/api/chat":
+            self.chat(body)
+        else:
+            self.send_error(404)
+
+    #stands in for reading the prompt, which stops early if the client hangs up like ollama does
+    def evaluatePrompt(self, seconds):
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            readable, _, _ = select.select([self.connection], [], [], min(0.002, max(0, end - time.monotonic())))
+            if readable and self.connection.recv(1, socket.MSG_PEEK) == b"":
+                self.server.aborts.append(time.monotonic())
+                return False
+        return True
+
+    def chat(self, body):
+        model = body.get("model", "")
+        if len(body.get("messages", [])) == 0:
+            self.reply({"model": model, "message": {"role": "assistant", "content": ""}, "done": True,
+                        "done_reason": "load", "load_duration": 0})
+            return
+        self.server.chats += 1
+        if not self.evaluatePrompt(self.server.promptDelay):
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        server = self.server
+        start = time.monotonic()
+        try:
+            for i in range(server.tokens):
+                #paced against the start so sleep overshoot doesn't lower the rate
+                wait = start + i / server.rate - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                self.sendChunk({"model": model, "message": {"role": "assistant", "content": stampToken(server.tokenSize)},
+                                "done": False})
+            duration = int((time.monotonic() - start) * 1e9)
+            self.sendChunk({"model": model, "message": {"role": "assistant", "content": ""}, "done": True,
+                            "eval_count": server.tokens, "eval_duration": duration, "total_duration": duration})
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.aborts.append(time.monotonic())
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeOllama:
+    """A stand-in for ollama serve that streams stamped tokens at a set rate and size."""
+    def __init__(self, port=0, rate=100.0, tokenSize=16, tokens=200, models=("bench",), numCtx=32768, promptDelay=0.0,
+                 loaded=None):
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), FakeOllamaHandler)
+        self.server.daemon_threads = True
+        self.server.models = list(models)
+        #what /api/ps says is in memory, all of them unless told otherwise
+        self.server.loaded = list(models if loaded is None else loaded)
+        self.server.numCtx = numCtx
+        #chat requests received, and when the server saw a client hang up mid response
+        self.server.chats = 0
+        self.server.aborts = []
+        self.server.connections = set()
+        self.configure(rate, tokenSize, tokens, promptDelay)
+        self.thread = None
+
+    def configure(self, rate=None, tokenSize=None, tokens=None, promptDelay=None):
+        if rate is not None:
+            self.server.rate = rate
+        if tokenSize is not None:
+            self.server.tokenSize = tokenSize
+        if tokens is not None:
+            self.server.tokens = tokens
+        if promptDelay is not None:
+            self.server.promptDelay = promptDelay
+
+    @property
+    def host(self):
+        return f"127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for connection in list(self.server.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fake ollama server streaming stamped tokens")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--rate", type=float, default=100.0, help="tokens per second")
+    parser.add_argument("--token-size", type=int, default=16, help="characters per token")
+    parser.add_argument("--tokens", type=int, default=200, help="tokens per response")
+    parser.add_argument("--prompt-delay", type=float, default=0.0, help="seconds spent reading the prompt")
+    args = parser.parse_args()
+    fake = FakeOllama(args.port, args.rate, args.token_size, args.tokens, promptDelay=args.prompt_delay)
+    print(f"fake ollama on {fake.host}")
+    fake.server.serve_forever()
@@ -0,0 +1,520 @@
+"""Headless benchmarks of the chat window against a fake ollama server.
+
+    python bench/runBench.py               run and compare against bench/baselines.json, exits 1 on a regression or a failed check
+    python bench/runBench.py --update      run and store the results as the new baselines
+    python bench/runBench.py --only chunk  run only the benchmarks whose names start with chunk
+    python bench/runBench.py --full        also recolour and translate 1MB, which takes minutes
+
+Times are in seconds, lower is better. Baselines are only comparable on the machine they were recorded on.
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from fakeOllama import FakeOllama
+
+
+benchDir = Path(__file__).resolve().parent
+sizes = {"1KB": 1 << 10, "10KB": 10 << 10, "100KB": 100 << 10, "1MB": 1 << 20}
+#fixed ceilings in seconds for benchmarks starting with these, checked whatever the baseline says
+limits = {"stop.": 0.1}
+
+#a mix of what chats hold, prose, lists and code, so the translators and highlighter do realistic work
+blocks = [
+    "Can you explain how the event loop decides which callback runs next? I keep seeing timers fire late "
+    "when the page is busy and want to understand why.",
+    "Timers only run once the current task has finished, so a long task delays them.\n\n"
+    "- the **task queue** holds timers and I/O callbacks\n- the *microtask queue* is drained after every task\n"
+    "- rendering happens between tasks, roughly once a frame\n\nKeep tasks short and the timers stay on time.",
+    "Here is the version that batches the writes:\n\n```python\ndef flush(queue):\n    batch = []\n"
+    "    while queue:\n        batch.append(queue.popleft())\n    return \"\".join(batch)\n```\n\n"
+    "It joins everything waiting into one string, so the display only updates once.",
+    "1. measure first\n2. change one thing\n3. measure again\n\n| step | time |\n|------|------|\n| parse | 2 ms |\n"
+    "| render | 14 ms |",
+]
+
+
+def makeTranscript(size, delims):
+    parts = []
+    total = 0
+    i = 0
+    while total < size:
+        role = "user" if i % 2 == 0 else "assistant"
+        part = f"{delims[role]} {blocks[i % len(blocks)]}\n\n"
+        parts.append(part)
+        total += len(part)
+        i += 1
+    return "".join(parts) + f"{delims['user']} "
+
+
+def percentiles(values, *ps):
+    values = sorted(values)
+    return [values[min(len(values) - 1, int(p / 100 * len(values)))] for p in ps]
+
+
+class Bench:
+    """Drives a real App under the offscreen platform and records timings by name."""
+    def __init__(self, only=None, full=False):
+        self.only = only
+        #whole document recolours and translations of 1MB take tens of seconds each
+        self.heavySizes = sizes if full else {label: size for label, size in sizes.items() if size < sizes["1MB"]}
+        self.results = {}
+        #checks that came out wrong, any of them fails the run whatever the timings
+        self.failures = []
+        self.home = tempfile.mkdtemp(prefix="ollamaChatBench")
+        self.fake = FakeOllama().start()
+
+        #everything the app touches lives in a throwaway home, and it talks to the fake server
+        os.environ["HOME"] = self.home
+        os.environ["USERPROFILE"] = self.home
+        os.environ["OLLAMA_HOST"] = self.fake.host
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        sys.path.insert(0, str(benchDir.parent / "src"))
+
+        from PyQt5.QtWidgets import QApplication
+        self.app = QApplication(sys.argv)
+        from App import App
+        self.window = App(self.app.primaryScreen().geometry(), "ollamaChatBench")
+        self.waitFor(self.window.ollamaSupervisor.isReady, 10)
+        self.window.toggleVisible()
+        self.window.modelRegistry.stopPolling()
+        self.window.updateModels(["bench"])
+        self.window.model = "bench"
+        self.delims = self.window.delims
+        self.display = self.window.chatDisplay
+        self.pump(0.2)
+
+    def wanted(self, name):
+        return self.only is None or name.startswith(self.only)
+
+    def pump(self, seconds):
+        from PyQt5.QtCore import QEventLoop
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            self.app.processEvents(QEventLoop.AllEvents, 10)
+            time.sleep(0.001)
+
+    def waitFor(self, condition, timeout):
+        from PyQt5.QtCore import QEventLoop
+        end = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > end:
+                raise TimeoutError("benchmark timed out waiting for the app")
+            self.app.processEvents(QEventLoop.AllEvents, 10)
+            time.sleep(0.0005)
+
+    def setText(self, text):
+        self.display.clearText()
+        self.display.display_text(text)
+        self.pump(0.05)
+
+    def record(self, name, seconds):
+        self.results[name] = seconds
+        print(f"  {name:<32}{seconds * 1000:10.3f} ms", flush=True)
+
+    def fail(self, name, message):
+        self.failures.append(name)
+        print(f"  {name:<32}FAILED {message}", flush=True)
+
+    #from a token leaving the fake server to it being in the chat document
+    def tokenToScreen(self, name, rate, tokenSize, tokens):
+        if not self.wanted(name):
+            return
+        self.fake.configure(rate, tokenSize, tokens)
+        latencies = []
+        def measure(chunk):
+            now = time.monotonic_ns()
+            for stamp in re.findall(r" t([0-9a-f]{8,})", chunk):
+                latencies.append((now - int(stamp, 16)) / 1e9)
+        handler = self.window.promptHandler
+        handler.progress.connect(measure)
+        self.setText(f"{self.delims['user']} benchmark prompt")
+        chat = self.window.chatHandler.prevChat
+        self.window.newPrompt.emit()
+        self.waitFor(lambda: not handler.isGenerating(chat), 60)
+        handler.progress.disconnect(measure)
+        p50, p99 = percentiles(latencies, 50, 99)
+        self.record(f"{name}.p50", p50)
+        self.record(f"{name}.p99", p99)
+
+    #from asking a response to stop to the app confirming it has, and to the server seeing the connection drop
+    def stopLatency(self, name, promptDelay, waitForTokens):
+        if not self.wanted(name):
+            return
+        fake = self.fake
+        fake.configure(50, 16, 1000, promptDelay)
+        handler = self.window.promptHandler
+        times, aborts = [], []
+        for _ in range(5):
+            chats, seen = fake.server.chats, []
+            handler.progress.connect(seen.append)
+            self.setText(f"{self.delims['user']} benchmark prompt")
+            chat = self.window.chatHandler.prevChat
+            self.window.newPrompt.emit()
+            self.waitFor(lambda: fake.server.chats > chats and (not waitForTokens or len(seen) > 3), 10)
+            handler.progress.disconnect(seen.append)
+            #settle into reading the prompt, or into streaming
+            self.pump(0.05)
+            abortCount = len(fake.server.aborts)
+            start = time.monotonic()
+            handler.stopChat(chat)
+            self.waitFor(lambda: not handler.isGenerating(chat), 10)
+            times.append(time.monotonic() - start)
+            self.waitFor(lambda: len(fake.server.aborts) > abortCount, 10)
+            aborts.append(fake.server.aborts[-1] - start)
+        fake.configure(promptDelay=0.0)
+        self.record(f"{name}", statistics.median(times))
+        self.record(f"{name}.server", statistics.median(aborts))
+
+    #a pool of an unreachable host, one without the model loaded and one with it, then the loaded one going away
+    def pool(self):
+        if not self.wanted("pool"):
+            return
+        import socket
+        from Backends import OllamaBackend
+        window = self.window
+        cold = FakeOllama(tokens=20, loaded=()).start()
+        warm = FakeOllama(tokens=20).start()
+        #a port nothing listens on
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            deadPort = probe.getsockname()[1]
+        original = window.backends.backends["ollama"]
+        window.backends.backends["ollama"] = OllamaBackend([f"127.0.0.1:{deadPort}", cold.host, warm.host])
+        window.backends.listModels()
+        handler = window.promptHandler
+
+        def firstToken():
+            seen = []
+            handler.progress.connect(seen.append)
+            self.setText(f"{self.delims['user']} benchmark prompt")
+            chat = window.chatHandler.prevChat
+            start = time.monotonic()
+            window.newPrompt.emit()
+            self.waitFor(lambda: len(seen) > 1, 20)
+            seconds = time.monotonic() - start
+            self.waitFor(lambda: not handler.isGenerating(chat), 20)
+            handler.progress.disconnect(seen.append)
+            return seconds
+
+        placed = [firstToken() for _ in range(3)]
+        if cold.server.chats > 0 or warm.server.chats != 3:
+            self.fail("pool.placement", f"{cold.server.chats} prompts went to the host without the model loaded")
+        self.record("pool.firstToken", statistics.median(placed))
+        warm.stop()
+        self.record("pool.failover", firstToken())
+        if cold.server.chats != 1:
+            self.fail("pool.failover", "the prompt didn't go to the remaining host")
+        window.backends.backends["ollama"] = original
+        cold.stop()
+
+    #appending one streamed chunk as the transcript grows
+    def chunkCost(self):
+        for label, size in sizes.items():
+            if not self.wanted(f"chunk.{label}"):
+                continue
+            self.setText(makeTranscript(size, self.delims))
+            times = []
+            for i in range(200):
+                start = time.perf_counter()
+                self.display.chunk(f" token{i:04d}", self.delims)
+                times.append(time.perf_counter() - start)
+                #let qt lay out what was added so it doesn't pile up into the next measurement
+                self.app.processEvents()
+            self.record(f"chunk.{label}", statistics.median(times))
+
+    #a full recolour, as when the delimiters change or a chat is loaded, what the gui blocks on up front,
+    #the longest slice after that and the time until every block is recoloured
+    def recolour(self):
+        for label, size in self.heavySizes.items():
+            if not self.wanted(f"recolour.{label}"):
+                continue
+            self.setText(makeTranscript(size, self.delims))
+            highlighters = (self.display.rawHighlighter, self.display.richHighlighter)
+            times, slices, totals = [], [], []
+            for _ in range(3 if size < sizes["1MB"] else 1):
+                for highlighter in highlighters:
+                    highlighter.delims = None
+                start = time.perf_counter()
+                self.display.recolour_text(self.delims)
+                times.append(time.perf_counter() - start)
+                longest = 0
+                while any(highlighter.isRecolouring() for highlighter in highlighters):
+                    sliceStart = time.perf_counter()
+                    self.app.processEvents()
+                    longest = max(longest, time.perf_counter() - sliceStart)
+                slices.append(longest)
+                totals.append(time.perf_counter() - start)
+            self.record(f"recolour.{label}", statistics.median(times))
+            self.record(f"recolour.slice.{label}", statistics.median(slices))
+            self.record(f"recolour.total.{label}", statistics.median(totals))
+
+    def translators(self):
+        from Translator import makeTranslator
+        original = self.display.translator
+        self.display.setRichVisibility(True, self.delims)
+        for richType in ("markdown", "html"):
+            self.display.translator = makeTranslator(richType)
+            for label, size in self.heavySizes.items():
+                if not self.wanted(f"toRich.{richType}.{label}") and not self.wanted(f"toRaw.{richType}.{label}") \
+                        and not self.wanted(f"toRich.{richType}.edit.{label}"):
+                    continue
+                text = makeTranscript(size, self.delims)
+                toRich, toRaw, edit = [], [], []
+                for _ in range(3 if size < sizes["1MB"] else 1):
+                    self.setText(text)
+                    #a new translator has nothing cached, so every turn is rendered
+                    self.display.translator = makeTranslator(richType)
+                    start = time.perf_counter()
+                    self.display.renderRich()
+                    toRich.append(time.perf_counter() - start)
+                    #typing at the end of the chat, what a space key costs
+                    for i in range(5):
+                        self.display.appendStream(f" word{i}")
+                        start = time.perf_counter()
+                        self.display.renderRich()
+                        edit.append(time.perf_counter() - start)
+                    start = time.perf_counter()
+                    self.display.renderRaw(self.delims)
+                    toRaw.append(time.perf_counter() - start)
+                self.record(f"toRich.{richType}.{label}", statistics.median(toRich))
+                self.record(f"toRich.{richType}.edit.{label}", statistics.median(edit))
+                self.record(f"toRaw.{richType}.{label}", statistics.median(toRaw))
+        self.display.translator = original
+        self.display.setRichVisibility(False, self.delims)
+
+    #random edits spliced into the rich pane must leave it the same as rendering the result from scratch
+    def splice(self, steps=300):
+        if not self.wanted("splice"):
+            return
+        import random
+        from PyQt5.QtWidgets import QTextEdit
+        from Translator import makeTranslator
+        pieces = [f"{self.delims['user']} hello **there**", f"{self.delims['assistant']} # Head\n\n```python\nx = 1\n```\n\n- a\n- b",
+                  f"{self.delims['user']} after list", f"{self.delims['assistant']} plain",
+                  f"{self.delims['assistant']} | a | b |\n|---|---|\n| 1 | 2 |", f"{self.delims['user']} > quote\n\nmore",
+                  f"{self.delims['system']} be *nice*", f"{self.delims['assistant']} 1. one\n2. two", "preamble text"]
+
+        def blocks(document):
+            out = []
+            block = document.begin()
+            while block.isValid():
+                blockFormat = block.blockFormat()
+                out.append((block.text(), blockFormat.headingLevel(), block.textList() is not None, round(blockFormat.topMargin()),
+                            round(blockFormat.bottomMargin()), round(blockFormat.leftMargin()), block.charFormat().fontWeight()))
+                block = block.next()
+            return out
+
+        for richType in ("markdown", "html"):
+            #seeded so a mismatch can be reproduced
+            rng = random.Random(richType)
+            pane, fresh = QTextEdit(), QTextEdit()
+            pane.show()
+            fresh.show()
+            translator = makeTranslator(richType)
+            segments, times, mismatches = [], [], 0
+            for _ in range(steps):
+                segments = list(segments)
+                op = rng.random()
+                if op < 0.3 or len(segments) == 0:
+                    segments.append(rng.choice(pieces))
+                elif op < 0.5:
+                    segments[-1] += " more"
+                elif op < 0.65:
+                    segments[rng.randrange(len(segments))] = rng.choice(pieces)
+                elif op < 0.75:
+                    del segments[rng.randrange(len(segments))]
+                elif op < 0.85:
+                    segments[:0] = rng.sample(pieces, rng.randint(1, 3))
+                elif op < 0.9:
+                    segments = segments[rng.randint(0, len(segments)):]
+                else:
+                    i = rng.randrange(len(segments))
+                    segments[i:i] = rng.sample(pieces, 2)
+                start = time.perf_counter()
+                translator.rawToRich(pane, segments)
+                times.append(time.perf_counter() - start)
+                makeTranslator(richType).rawToRich(fresh, segments)
+                if blocks(pane.document()) != blocks(fresh.document()):
+                    mismatches += 1
+            pane.deleteLater()
+            fresh.deleteLater()
+            self.record(f"splice.{richType}", statistics.median(times))
+            if mismatches > 0:
+                self.fail(f"splice.{richType}", f"{mismatches} of {steps} edits left the pane different from a fresh render")
+
+    #the rich pane as a list of turns, showing it, resizing it and streaming into it
+    def turnView(self):
+        display = self.display
+        display.setTurnView(True, self.delims)
+        for label, size in sizes.items():
+            names = [f"turns.show.{label}", f"turns.resize.{label}", f"turns.chunk.{label}"]
+            if not any(self.wanted(name) for name in names):
+                continue
+            self.setText(makeTranscript(size, self.delims))
+            start = time.perf_counter()
+            display.setRichVisibility(True, self.delims)
+            self.app.processEvents()
+            self.record(f"turns.show.{label}", time.perf_counter() - start)
+
+            times = []
+            for step in (40, -40, 40, -40):
+                self.window.resize(self.window.width() + step, self.window.height())
+                start = time.perf_counter()
+                self.app.processEvents()
+                times.append(time.perf_counter() - start)
+            self.record(f"turns.resize.{label}", statistics.median(times))
+
+            times = []
+            for i in range(200):
+                start = time.perf_counter()
+                display.chunk(f" token{i:04d}", self.delims)
+                self.app.processEvents()
+                times.append(time.perf_counter() - start)
+            self.record(f"turns.chunk.{label}", statistics.median(times))
+            display.setRichVisibility(False, self.delims)
+        display.setTurnView(False, self.delims)
+
+    #opening a saved chat, read from the database or already in the transcript cache
+    def chatSwitch(self):
+        import TranscriptParser
+        window = self.window
+        store = window.chatStore
+        labels = [label for label in sizes if any(self.wanted(f"switch.{kind}.{label}") for kind in ("cold", "warm", "olderPage"))]
+        for label in labels:
+            turns = TranscriptParser.parse(makeTranscript(sizes[label], self.delims), self.delims).turns
+            store.saveTurns(f"bench {label.lower()} a", "", turns)
+            store.saveTurns(f"bench {label.lower()} b", "", turns)
+        window.topBar.newChatNames(store.names(), "", True)
+        handler = window.chatHandler
+
+        def openChat(name):
+            start = time.perf_counter()
+            window.selectChat(name)
+            self.waitFor(lambda: not handler.loadPending, 30)
+            return time.perf_counter() - start
+
+        for label in labels:
+            a, b = f"bench {label.lower()} a", f"bench {label.lower()} b"
+            cold, warm = [], []
+            for _ in range(3):
+                openChat(a)
+                handler.cache.discard(b)
+                cold.append(openChat(b))
+                warm.append(openChat(a))
+                self.pump(0.05)
+            self.record(f"switch.cold.{label}", statistics.median(cold))
+            self.record(f"switch.warm.{label}", statistics.median(warm))
+            #a page of older turns going in at the top of a chat too long to show at once
+            times = []
+            while len(self.display.older) > 0 and len(times) < 5:
+                start = time.perf_counter()
+                self.display.loadOlder()
+                self.app.processEvents()
+                times.append(time.perf_counter() - start)
+            if len(times) > 0:
+                self.record(f"switch.olderPage.{label}", statistics.median(times))
+
+    def run(self):
+        self.tokenToScreen("tokenToScreen", 200, 16, 400)
+        self.tokenToScreen("tokenToScreen.burst", 2000, 64, 2000)
+        self.stopLatency("stop.promptEval", 10.0, False)
+        self.stopLatency("stop.streaming", 0.0, True)
+        self.pool()
+        self.chunkCost()
+        self.recolour()
+        self.translators()
+        self.splice()
+        self.turnView()
+        self.chatSwitch()
+        return self.results
+
+    def close(self):
+        self.fake.stop()
+        self.window.ollamaSupervisor.stop(terminate=False)
+        self.window.chatHandler.executor.flush()
+        shutil.rmtree(self.home, ignore_errors=True)
+
+
+#names that got slower than the baseline by more than threshold, ignoring differences under floor seconds
+def compare(results, baselines, threshold, floor):
+    regressions = []
+    print(f"\n{'benchmark':<32}{'baseline':>12}{'now':>12}{'change':>10}")
+    for name, value in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            print(f"{name:<32}{'-':>12}{value * 1000:12.3f}{'new':>10}")
+            continue
+        change = (value - baseline) / baseline if baseline > 0 else 0.0
+        regressed = value > baseline * (1 + threshold) and value - baseline > floor
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<32}{baseline * 1000:12.3f}{value * 1000:12.3f}{change:+10.0%}" + ("  REGRESSED" if regressed else ""))
+    return regressions
+
+
+#names over their fixed ceiling
+def overLimits(results):
+    over = []
+    for name, value in results.items():
+        for prefix, limit in limits.items():
+            if name.startswith(prefix) and value > limit:
+                print(f"{name} took {value * 1000:.1f} ms, over the {limit * 1000:.0f} ms limit")
+                over.append(name)
+    return over
+
+
+def main():
+    parser = argparse.ArgumentParser(description="headless benchmarks of the chat window")
+    parser.add_argument("--update", action="store_true", help="store the results as the new baselines")
+    parser.add_argument("--baselines", type=Path, default=benchDir / "baselines.json")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown, 0.25 is 25%%")
+    parser.add_argument("--floor", type=float, default=0.001, help="differences under this many seconds never fail")
+    parser.add_argument("--only", help="only run benchmarks whose names start with this")
+    parser.add_argument("--output", type=Path, help="also write the results here as json")
+    parser.add_argument("--full", action="store_true", help="include the 1MB recolour and translator runs")
+    args = parser.parse_args()
+
+    bench = Bench(args.only, args.full)
+    try:
+        results = bench.run()
+    finally:
+        bench.close()
+
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=1))
+    code = 0
+    if args.update:
+        stored = json.loads(args.baselines.read_text()) if args.baselines.is_file() else {"results": {}}
+        stored["results"] = {**stored["results"], **results}
+        stored["recorded"] = {"platform": platform.platform(), "python": platform.python_version(),
+                              "time": time.strftime("%Y-%m-%d %H:%M")}
+        args.baselines.write_text(json.dumps(stored, indent=1, sort_keys=True))
+        print(f"\nbaselines written to {args.baselines}")
+    elif args.baselines.is_file():
+        regressions = compare(results, json.loads(args.baselines.read_text())["results"], args.threshold, args.floor)
+        if len(regressions) > 0:
+            print(f"\n{len(regressions)} regressed: {', '.join(regressions)}")
+            code = 1
+    else:
+        print("\nno baselines yet, run with --update to record them")
+    if len(overLimits(results)) > 0:
+        code = 1
+    if len(bench.failures) > 0:
+        print(f"\n{len(bench.failures)} failed: {', '.join(bench.failures)}")
+        code = 1
+    sys.stdout.flush()
+    #the app's worker threads are still parked, skip interpreter teardown rather than wait on them
+    os._exit(code)
+
+
+if __name__ == "__main__":
+    main()
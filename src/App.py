@@ -1,19 +1,26 @@
-import re
-import os
 import sys
 from pathlib import Path
-from ollama import list as ollamaList
 
-from PyQt5.Qt import Qt
-from PyQt5.QtCore import pyqtSignal, QTimer, QEvent
+from PyQt5.QtCore import Qt, pyqtSignal, QTimer, QEvent
 from PyQt5.QtGui import QIcon, QFont
 from PyQt5.QtWidgets import QMainWindow, QWidget, QVBoxLayout, QApplication
 
-from Settings import Settings
+from SettingsModel import SettingsModel
+from StartupProfiler import profiler
 from LoadImage import resource_path
 from TopBar import TopBar
 from ChatDisplay import ChatDisplay
 from ChatHandler import ChatHandler
+from ChatStore import ChatStore
+from HistoryMigrator import HistoryMigrator
+from ModelRegistry import ModelRegistry
+from Backends import BackendSet
+from OllamaSupervisor import OllamaSupervisor
+from ModelWarmer import ModelWarmer
+from ContextBudget import ContextBudget
+from ImageCache import ImageCache
+from MetricsLog import MetricsLog
+import TranscriptParser
 from PromptHandler import PromptHandler
 
 
@@ -38,7 +45,7 @@ class App(QMainWindow):
         self.delims = None
         self.prevChat = None
         self.deletingTemp = False
-        self.prompting = False
+        self.model = ""
         self.appName = appName
         self.dataStore = Path.home() / f"AppData/Roaming/{self.appName}"
         self.dataStore.mkdir(parents=True, exist_ok=True)
@@ -51,8 +58,28 @@ class App(QMainWindow):
                             tempSavePath.unlink()
                     tempPath.rmdir()
 
-        self.settings = Settings(self.dataStore, screen, self.appName)
+        #last known models are shown straight away, the server is asked in the background
+        self.modelRegistry = ModelRegistry(self.dataStore / "models.json")
+        self.settings = SettingsModel(self.dataStore, screen, self.modelRegistry.models)
         self.settings.submitted.connect(self.fetchSettings)
+        #the settings window is only built the first time it is opened
+        self.settingsWindow = None
+        profiler.mark("settings")
+
+        #start the server, or attach to a running one, while the rest of the window is built
+        self.ollamaSupervisor = OllamaSupervisor(self.settings.settings["serverCommand"], self.settings.settings["serverEnv"],
+                                                 self.dataStore / "ollama.log")
+        self.ollamaSupervisor.start()
+        self.backends = BackendSet(self.settings.settings["backends"], self.settings.settings["modelBackends"],
+                                   self.ollamaSupervisor.url)
+        self.modelRegistry.backends = self.backends
+        self.modelWarmer = ModelWarmer(self.ollamaSupervisor, self.settings.settings["keepAlive"], self.settings.settings["warmModel"],
+                                       backends=self.backends)
+
+        #saved chats live in sqlite, any old .txt history is imported in the background
+        self.chatStore = ChatStore(historyPath / "chats.db")
+        self.historyMigrator = HistoryMigrator(self.chatStore, self.settings.getDelims())
+        profiler.mark("chat store")
 
         """
         -----------------------------------------------------------------------
@@ -67,7 +94,7 @@ class App(QMainWindow):
         self.move(pos[0], pos[1])
 
         self.moveOrResize.connect(lambda: self.settings.movedOrResized(self.pos(), self.size()))
-        self.userClosed.connect(self.settings.hide)
+        self.userClosed.connect(self.hideSettings)
         self.toggleSignal.connect(self.toggleVisible)
 
         central = QWidget()
@@ -80,12 +107,11 @@ class App(QMainWindow):
         ------------                Top Bar                    ----------------
         -----------------------------------------------------------------------
         """
-        self.topBar = TopBar(self.dataStore)
+        self.topBar = TopBar(self.chatStore.names())
         self.prevChat = self.topBar.historyInput.text().lower()
         layout.addWidget(self.topBar)
         self.topBar.historySelect.currentIndexChanged.connect(
             lambda: self.chatHandler.loadChat(
-                self.prompting,
                 self.chatDisplay.getText(),
                 self.deletingTemp,
                 self.topBar.historyNames,
@@ -97,6 +123,10 @@ class App(QMainWindow):
                 self.delims
             ))
 
+        #warm the cache with whatever is under the cursor while the dropdown is open
+        self.topBar.historySelect.highlighted.connect(
+            lambda i: self.chatHandler.prefetch(self.topBar.historyNames[i] if 0 <= i < len(self.topBar.historyNames) else None))
+
         self.topBar.saveButton.clicked.connect(
             lambda: self.chatHandler.saveChat(
                 self.topBar.historySelect.currentIndex(),
@@ -105,11 +135,11 @@ class App(QMainWindow):
                 self.chatDisplay.getText(),
                 self.enableSysPrompt,
                 self.sysPrompt,
-                self.delims
+                self.delims,
+                self.model
             ))
         self.topBar.revertButton.clicked.connect(
             lambda: self.chatHandler.loadChat(
-                self.prompting,
                 self.chatDisplay.getText(),
                 self.deletingTemp,
                 self.topBar.historyNames,
@@ -122,7 +152,6 @@ class App(QMainWindow):
             ))
         self.topBar.deleteButton.clicked.connect(
             lambda: self.chatHandler.deleteChat(
-                self.prompting,
                 self.topBar.historyNames,
                 self.topBar.historySelect.currentText(),
                 self.chatDisplay.getText(),
@@ -133,7 +162,6 @@ class App(QMainWindow):
             ))
         self.topBar.newButton.clicked.connect(
             lambda: self.chatHandler.newChat(
-                self.prompting,
                 self.chatDisplay.getText(),
                 self.settings.settings["sysPrompt"],
                 self.topBar.historyNames,
@@ -143,9 +171,16 @@ class App(QMainWindow):
                 self.delims
             ))
 
+        self.topBar.searchSelected.connect(self.selectChat)
+
         self.topBar.modelSelect.currentIndexChanged.connect(self.changeModel)
-        self.topBar.settingsButton.clicked.connect(self.settings.toggleSettings)
+        #only a model picked by the user is warmed, not the passing selections while the list is refilled
+        self.topBar.modelSelect.activated.connect(lambda: self.modelWarmer.warm(self.model))
+        self.topBar.settingsButton.clicked.connect(self.toggleSettings)
         self.topBar.historyInput.installEventFilter(self)
+        self.ollamaSupervisor.stateChanged.connect(self.topBar.showServerState)
+        self.topBar.showServerState(self.ollamaSupervisor.state)
+        profiler.mark("top bar")
 
         """
         -----------------------------------------------------------------------
@@ -156,44 +191,86 @@ class App(QMainWindow):
         layout.addWidget(self.chatDisplay)
         self.chatDisplay.rawDisplay.installEventFilter(self)
         self.chatDisplay.richDisplay.installEventFilter(self)
+        self.chatDisplay.turnView.installEventFilter(self)
 
         self.chatDisplay.autoShowRaw.connect(lambda: self.topBar.checkboxRaw.setChecked(True))
         self.chatDisplay.autoShowRich.connect(lambda: self.topBar.checkboxMarkdown.setChecked(True))
 
         self.topBar.checkboxRaw.clicked.connect(lambda x: self.chatDisplay.setRawVisibility(x, self.delims))
         self.topBar.checkboxMarkdown.clicked.connect(lambda x: self.chatDisplay.setRichVisibility(x, self.delims))
+        profiler.mark("chat display")
 
         """
         -----------------------------------------------------------------------
         ------------             Prompt Handler                ----------------
         -----------------------------------------------------------------------
         """
-        self.promptHandler = PromptHandler()
-        self.promptHandler.progress.connect(lambda chunk: self.chatDisplay.chunk(chunk, self.delims), Qt.QueuedConnection)
-        self.promptHandler.reGen.connect(lambda: self.chatDisplay.deleteForRegen(self.delims), Qt.QueuedConnection)
+        self.promptHandler = PromptHandler(self.ollamaSupervisor, self.settings.maxStreams())
+        self.promptHandler.waiting.connect(self.topBar.showPromptQueued)
+        self.promptHandler.keepAlive = self.settings.settings["keepAlive"]
+        self.promptHandler.firstToken.connect(lambda model, seconds: self.modelWarmer.promptLoaded(model))
+        #only ollama models are warmed, so only they are warm or cold
+        self.promptHandler.isWarm = lambda model: self.modelWarmer.isWarm(model) if self.backends.isOllama(model) else None
+        self.promptHandler.backends = self.backends
+        self.promptHandler.budget = ContextBudget(self.settings.settings["contextPolicy"], self.settings.settings["numCtx"],
+                                                  self.settings.settings["contextReserve"], backends=self.backends)
+        self.promptHandler.usage.connect(self.topBar.showContextUsage)
+        self.promptHandler.images = ImageCache(self.dataStore / "imageCache", self.settings.settings["imageMaxSide"])
+        #progress is already on this thread, and only ever for the chat on screen
+        self.promptHandler.progress.connect(self.showChunk)
         self.promptHandler.updatePrevModel.connect(self.settings.updatePrevModel)
+        self.promptHandler.chatState.connect(self.topBar.showChatState)
 
-        self.newPrompt.connect(
-            lambda: self.promptHandler.prompt(
-                self.chatDisplay.getText(),
-                self.delims,
-                self.model,
-                self.enableSysPrompt,
-                self.sysPrompt
-            ))
+        self.newPrompt.connect(self.submitPrompt)
+
+        #compare columns under the chat, fed by their own jobs
+        self.promptHandler.compareProgress.connect(self.chatDisplay.compareView.chunk)
+        self.promptHandler.compareFirstToken.connect(self.chatDisplay.compareView.firstToken)
+        self.promptHandler.compareFinished.connect(self.chatDisplay.compareView.finish)
+        self.chatDisplay.compareView.dismissed.connect(lambda: self.promptHandler.stopCompare(True))
+        self.chatDisplay.compareView.merge.connect(self.mergeCompare)
 
         """
         -----------------------------------------------------------------------
         ------------              Chat Handler                 ----------------
         -----------------------------------------------------------------------
         """
-        self.chatHandler = ChatHandler(self.dataStore, self.topBar.historyInput.text().lower())
+        self.chatHandler = ChatHandler(self.dataStore, self.chatStore, self.topBar.historyInput.text().lower(),
+                                       self.settings.settings["transcriptCacheMB"] << 20, self.settings.settings["pageTurns"])
+        self.chatDisplay.pageTurns = self.settings.settings["pageTurns"]
         self.chatHandler.display.connect(self.chatDisplay.display_text)
+        self.chatHandler.paged.connect(self.chatDisplay.setOlder)
         self.chatHandler.recolour.connect(lambda: self.chatDisplay.recolour_text(self.delims))
         self.chatHandler.clear.connect(self.chatDisplay.clearText)
-        self.chatHandler.endGeneration.connect(self.promptHandler.endGeneration)
         self.chatHandler.changeCurrentChatName.connect(self.topBar.historyInput.setText)
+        self.chatHandler.changeCurrentChatName.connect(self.topBar.chatShown)
+        #a chat being generated keeps going when another one is opened
+        self.chatHandler.leaving.connect(lambda name: self.promptHandler.detach(name, self.displayedChat))
+        #a compare is of the chat on screen, so it goes when the chat does
+        self.chatHandler.leaving.connect(lambda name: self.chatDisplay.compareView.dismiss())
+        self.chatHandler.liveText = self.promptHandler.attach
+        self.chatHandler.renamed.connect(self.promptHandler.renameChat)
+        self.chatHandler.deleted.connect(self.promptHandler.discardChat)
+        self.promptHandler.finishedOffscreen.connect(lambda name, text: self.chatHandler.storeDraft(name, text, self.delims))
         self.chatHandler.updateChatNames.connect(self.topBar.newChatNames)
+        #searching runs on the executor, a big history would stall typing
+        self.topBar.searchRequested.connect(self.chatHandler.search)
+        self.chatHandler.searchResults.connect(self.topBar.showSearchResults)
+
+        #every response's timings go to a rotating log, the viewer is built the first time it's opened
+        self.metricsLog = MetricsLog(self.dataStore / "metrics.jsonl", self.chatHandler.executor)
+        self.metricsViewer = None
+        self.promptHandler.metrics.connect(self.metricsLog.record)
+        self.promptHandler.metrics.connect(self.topBar.showSpeed)
+        self.topBar.speedButton.clicked.connect(self.toggleMetrics)
+
+        self.historyMigrator.progress.connect(self.topBar.showImportProgress)
+        self.modelRegistry.executor = self.chatHandler.executor
+        self.modelRegistry.modelsChanged.connect(lambda models: self.updateModels(models, True))
+        self.modelRegistry.modelsChanged.connect(self.settings.updateModels)
+        self.ollamaSupervisor.ready.connect(lambda: self.modelRegistry.refresh() if self.isVisible() else None)
+        self.historyMigrator.start.emit()
+        profiler.mark("chat handler")
 
         """
         -----------------------------------------------------------------------
@@ -201,13 +278,15 @@ class App(QMainWindow):
         -----------------------------------------------------------------------
         """
         self.fetchSettings()
+        profiler.mark("apply settings")
 
 
     def toggleVisible(self):
         if self.isHidden():
-            self.updateModels()
-            self.chatHandler.newChat(self.prompting,
-                                     self.chatDisplay.getText(),
+            self.updateModels(self.modelRegistry.models)
+            self.modelRegistry.startPolling()
+            self.modelWarmer.warm(self.model)
+            self.chatHandler.newChat(self.chatDisplay.getText(),
                                      self.settings.settings["sysPrompt"],
                                      self.topBar.historyNames,
                                      False,
@@ -222,33 +301,65 @@ class App(QMainWindow):
             self.chatDisplay.renderRich()
             self.chatDisplay.recolour_text(self.delims)
         else:
+            self.promptHandler.detach(self.chatHandler.prevChat, self.displayedChat)
+            self.chatDisplay.compareView.dismiss()
             self.chatDisplay.clearText()
             self.chatHandler.clearTemp()
+            self.modelRegistry.stopPolling()
+            self.modelWarmer.cancel()
             self.hide()
-            self.settings.hide()
-
-    def updateModels(self):
-        models = sorted([str(model.model) for model in ollamaList().models])
-        if self.settings.settings["loadFixedModel"] and self.settings.settings["selectedModel"] in models:
+            self.hideSettings()
+
+    def toggleSettings(self):
+        if self.settingsWindow is None:
+            with profiler.phase("settings window"):
+                from Settings import Settings
+                self.settingsWindow = Settings(self.settings, self.appName)
+        self.settingsWindow.toggleSettings()
+
+    def hideSettings(self):
+        if self.settingsWindow is not None:
+            self.settingsWindow.hide()
+        if self.metricsViewer is not None:
+            self.metricsViewer.hide()
+
+    def toggleMetrics(self):
+        if self.metricsViewer is None:
+            from MetricsViewer import MetricsViewer
+            self.metricsViewer = MetricsViewer(self.metricsLog)
+        self.metricsViewer.toggle()
+
+    #keepCurrent leaves the selected model alone if it is still installed
+    def updateModels(self, models, keepCurrent=False):
+        if keepCurrent and self.model in models:
+            pass
+        elif self.settings.settings["loadFixedModel"] and self.settings.settings["selectedModel"] in models:
             self.model = self.settings.settings["selectedModel"]
         elif self.settings.settings["prevModel"] != "" and self.settings.settings["prevModel"] in models:
             self.model = self.settings.settings["prevModel"]
-        else:
+        elif len(models) > 0:
             self.model = models[0]
+        else:
+            self.model = ""
 
         self.topBar.updateModels(models, self.model)
-        self.settings.updateModels(models)
+        if keepCurrent and self.isVisible():
+            self.modelWarmer.warm(self.model)
 
     #get settings when they are changed
     def fetchSettings(self):
         try:
-            newDelims = {"user": f"{self.settings.settings["delimUser"]}:",
-                           "assistant": f"{self.settings.settings["delimAssistant"]}:",
-                           "system": f"{self.settings.settings["delimSystem"]}:"}
+            if self.backends.modelBackends != self.settings.settings["modelBackends"]:
+                self.backends.modelBackends = dict(self.settings.settings["modelBackends"])
+                #context lengths were asked of the old backends
+                self.promptHandler.budget.lengths.clear()
+
+            newDelims = self.settings.getDelims()
             if self.delims is None:
                 self.delims = newDelims
             else:
                 self.changeDelims(newDelims)
+            self.chatDisplay.setTurnView(self.settings.settings["turnView"], self.delims)
 
             text = self.chatDisplay.getText()
             self.enableSysPrompt, self.hideSysPrompt, self.sysPrompt, newText = self.settings.fetchSysPromptSettings(text, self.enableSysPrompt, self.hideSysPrompt, self.sysPrompt)
@@ -262,43 +373,59 @@ class App(QMainWindow):
 
     def changeDelims(self, newDelims):
         try:
-            changes = []
-            for key in newDelims.keys():
-                if newDelims[key] != self.delims[key]:
-                    changes.append([self.delims[key], newDelims[key]])
-            if len(changes) == 0:
+            if newDelims == self.delims:
                 return
 
-            currentText = self.chatDisplay.getText()
-            for i in range(len(changes)):
-                currentText = currentText.replace(changes[i][0], changes[i][1])
-
-            self.chatDisplay.clearText()
-            self.chatDisplay.display_text(currentText)
+            #chats are stored as roles, so only the open chat needs redrawing with the new delimiters
+            #and only the part of it in the raw pane, older turns are kept without them
+            transcript = TranscriptParser.parse(self.chatDisplay.rawDisplay.toPlainText().strip(), self.delims)
+            self.chatDisplay.rawDisplay.clear()
+            self.chatDisplay.display_text(TranscriptParser.render(transcript.turns, newDelims, transcript.preamble))
             self.delims = newDelims
+            self.promptHandler.changeDelims(newDelims)
             self.chatDisplay.recolour_text(self.delims)
 
-            permSaves = self.dataStore / f"history/"
-            tempSaves = self.dataStore / f"history/temp{os.getpid()}"
-            for directory in [permSaves, tempSaves]:
-                if directory.is_dir():
-                    for path in directory.iterdir():
-                        if path.is_file():
-                            with open(path, "r", encoding="utf-8") as file:
-                                text = file.read()
-                            for change in changes:
-                                text = text.replace(change[0], change[1])
-                            with open(path, "w", encoding="utf-8") as file:
-                                file.write(text)
-
         except Exception as e:
             self.chatDisplay.display_text("changeDelims: ", str(e))
 
-    def splitText(self, text):
-        try:
-            return re.split(f"({self.delims["user"]}|{self.delims["assistant"]}|{self.delims["system"]})", text, flags=re.IGNORECASE)[1:]
-        except Exception as e:
-            self.display.emit(f"splitText: {str(e)}")
+    #shift-enter, a compare if models are ticked for one, otherwise the usual prompt
+    def submitPrompt(self):
+        chat = self.chatHandler.prevChat
+        models = self.topBar.compareModels()
+        if self.promptHandler.isComparing():
+            self.promptHandler.stopCompare()
+        elif len(models) > 0 and not self.promptHandler.isGenerating(chat):
+            self.chatDisplay.compareView.start(models)
+            self.promptHandler.compare(chat, self.chatDisplay.fullTranscript(self.delims), self.delims, models,
+                                       self.enableSysPrompt, self.sysPrompt)
+        else:
+            self.promptHandler.prompt(chat, self.chatDisplay.fullTranscript(self.delims), self.delims, self.model,
+                                      self.enableSysPrompt, self.sysPrompt)
+
+    #the kept answer goes into the chat as if it had been generated there
+    def mergeCompare(self, text, regen):
+        if regen:
+            self.chatDisplay.deleteForRegen(self.delims)
+        self.chatDisplay.chunk("assis12", self.delims)
+        self.chatDisplay.chunk(text, self.delims)
+        self.chatDisplay.chunk("usr12", self.delims)
+        self.chatDisplay.compareView.dismiss()
+
+    #the whole chat on screen, hidden system prompt included, unstripped so streaming can carry on from it
+    def displayedChat(self):
+        return self.chatHandler.addHiddenPromptIfNeeded(self.chatDisplay.fullText(), self.enableSysPrompt,
+                                                        self.sysPrompt, self.delims)
+
+    def showChunk(self, chunk):
+        if chunk == "regen12":
+            self.chatDisplay.deleteForRegen(self.delims)
+        else:
+            self.chatDisplay.chunk(chunk, self.delims)
+
+    #open a chat by name, e.g. from a search result
+    def selectChat(self, name):
+        if name in self.topBar.historyNames:
+            self.topBar.historySelect.setCurrentIndex(self.topBar.historyNames.index(name))
 
     # change the model
     def changeModel(self):
@@ -314,7 +441,7 @@ class App(QMainWindow):
                 return False
 
             key = event.key()
-            if obj is self.chatDisplay.rawDisplay or obj is self.chatDisplay.richDisplay:
+            if obj is self.chatDisplay.rawDisplay or obj is self.chatDisplay.richDisplay or obj is self.chatDisplay.turnView:
 
                 if (key == Qt.Key_Return or key == Qt.Key_Enter) and event.modifiers() == Qt.ShiftModifier:
                     if obj is self.chatDisplay.rawDisplay:
@@ -370,12 +497,7 @@ class App(QMainWindow):
             self.userClosed.emit()
             return
 
-        path = self.dataStore / f"history/temp{os.getpid()}"
-        if path.is_dir():
-            for child in path.iterdir():
-                if child.is_file():
-                    child.unlink()
-            path.rmdir()
+        self.chatHandler.flush()
         super().closeEvent(event)
 
 if __name__ == "__main__":
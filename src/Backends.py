@@ -0,0 +1,502 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from OllamaSupervisor import hostUrl
+
+
+#timing keys every backend reports on its last chunk, named and scaled as ollama has them, durations in nanoseconds
+timingKeys = ("eval_count", "eval_duration", "prompt_eval_count", "prompt_eval_duration", "load_duration", "total_duration")
+
+
+class Backend:
+    """Something that can list its models and stream a chat from one of them.
+
+    streamChat is an async generator of chunks {"content", "done"} with timingKeys added to the last one. It is read
+    on the caller's event loop, and cancelling the task reading it drops the connection so the server stops
+    generating, even while it is still reading the prompt.
+    """
+    kind = ""
+
+    def listModels(self):
+        raise NotImplementedError
+
+    #messages are ollama style, {"role", "content", "images": [base64]}
+    def streamChat(self, model, messages, keepAlive=None, numCtx=0):
+        raise NotImplementedError
+
+    #None leaves it to the context budget's default
+    def contextLength(self, model):
+        return None
+
+
+#async clients belong to the event loop they were first used on, so each loop gets its own
+class LoopClients:
+    def __init__(self, makeClient):
+        self.makeClient = makeClient
+        self.clients = weakref.WeakKeyDictionary()
+
+    def get(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self.clients:
+            self.clients[loop] = self.makeClient()
+        return self.clients[loop]
+
+
+class OllamaHost:
+    """One ollama server, with clients that keep their connections open between requests."""
+    def __init__(self, url):
+        self.url = hostUrl(url)
+        self.client = None
+        self.asyncClients = LoopClients(self.makeAsyncClient)
+        self.lock = threading.Lock()
+        #what it last listed and had loaded, left as they were if it can't be reached
+        self.models = None
+        self.loaded = set()
+        self.loadedAt = float("-inf")
+        #streams from here running on it, ollama doesn't say how many it has queued from elsewhere
+        self.active = 0
+        self.downUntil = float("-inf")
+
+    #imported on first use, off the GUI thread, as ollama is slow to import
+    def getClient(self):
+        with self.lock:
+            if self.client is None:
+                import httpx
+                from ollama import Client
+                self.client = Client(host=self.url, timeout=httpx.Timeout(30, connect=3))
+            return self.client
+
+    #no read timeout, reading a long prompt can take minutes before anything is streamed
+    def makeAsyncClient(self):
+        import httpx
+        from ollama import AsyncClient
+        return AsyncClient(host=self.url, timeout=httpx.Timeout(None, connect=3))
+
+    def isDown(self):
+        return time.monotonic() < self.downUntil
+
+    #what is loaded comes along, so placing a warm up has something to go on before the first prompt
+    def listModels(self):
+        client = self.getClient()
+        self.models = [str(model.model) for model in client.list().models]
+        try:
+            self.setLoaded(client.ps())
+        except Exception:
+            #older servers don't have /api/ps
+            self.loaded = set()
+        self.downUntil = float("-inf")
+        return self.models
+
+    def setLoaded(self, response):
+        self.loaded = {str(model.model) for model in response.models} | {str(model.name) for model in response.models}
+        self.loadedAt = time.monotonic()
+
+
+class OllamaBackend(Backend):
+    """One ollama server, or a pool of them that each prompt is placed on.
+
+    A prompt goes to a host that lists the model, preferring one that already has it loaded and then the one with
+    the fewest streams from here. A host that fails before anything is streamed is skipped for a while and the
+    prompt moves on to the next.
+    """
+    kind = "ollama"
+    #ollama's default context when neither the model nor the server sets one
+    defaultContext = 4096
+    #how long what /api/ps said is trusted, and how long a failed host is passed over
+    loadedMaxAge = 2.0
+    retryAfter = 15.0
+
+    def __init__(self, hosts=None):
+        if isinstance(hosts, str) or hosts is None:
+            hosts = [hosts]
+        self.hosts = [OllamaHost(host) for host in hosts]
+        #workers pick hosts and count their streams on their own threads
+        self.lock = threading.RLock()
+
+    #every host's models, a host that can't be reached keeps what it last listed
+    def listModels(self):
+        answered = False
+        errors = []
+        with ThreadPoolExecutor(len(self.hosts)) as pool:
+            for host, error in zip(self.hosts, pool.map(self.listHost, self.hosts)):
+                if error is None:
+                    answered = True
+                else:
+                    errors.append(f"{host.url} {error}")
+        if not answered:
+            raise ConnectionError(", ".join(errors))
+        for error in errors:
+            print("ollama pool: ", error)
+        return sorted({model for host in self.hosts for model in host.models or []})
+
+    def listHost(self, host):
+        try:
+            host.listModels()
+        except Exception as e:
+            host.downUntil = time.monotonic() + self.retryAfter
+            return str(e)
+        return None
+
+    #hosts to try in order, a host that hasn't listed yet might have the model
+    def candidates(self, model):
+        hosts = [host for host in self.hosts if host.models is None or model in host.models] or list(self.hosts)
+        with self.lock:
+            return sorted(hosts, key=lambda host: (host.isDown(), model not in host.loaded, host.active))
+
+    #the best host not tried yet, counted as busy before another stream can pick it, and whether it is the last
+    def claim(self, model, tried):
+        with self.lock:
+            hosts = [host for host in self.candidates(model) if host not in tried]
+            hosts[0].active += 1
+            return hosts[0], len(hosts) == 1
+
+    def release(self, host):
+        with self.lock:
+            host.active -= 1
+
+    #where a prompt for model would go right now, without asking the hosts
+    def preferredUrl(self, model):
+        return self.candidates(model)[0].url
+
+    async def refreshLoaded(self, hosts):
+        async def refresh(host):
+            try:
+                host.setLoaded(await asyncio.wait_for(host.asyncClients.get().ps(), self.loadedMaxAge))
+            except Exception:
+                host.loaded = set()
+                host.loadedAt = time.monotonic()
+        stale = [host for host in hosts if not host.isDown() and time.monotonic() - host.loadedAt > self.loadedMaxAge]
+        await asyncio.gather(*(refresh(host) for host in stale))
+
+    async def streamChat(self, model, messages, keepAlive=None, numCtx=0):
+        if len(self.hosts) > 1:
+            await self.refreshLoaded(self.candidates(model))
+        tried = []
+        while True:
+            host, last = self.claim(model, tried)
+            tried.append(host)
+            streamed = False
+            try:
+                response = await host.asyncClients.get().chat(model=model, messages=messages, stream=True,
+                                                              keep_alive=keepAlive,
+                                                              options={"num_ctx": numCtx} if numCtx > 0 else None)
+                async for chunk in response:
+                    streamed = True
+                    out = {"content": chunk['message']['content'], "done": bool(chunk['done'])}
+                    if out["done"]:
+                        out.update({key: chunk.get(key) for key in timingKeys})
+                    yield out
+                host.loaded.add(model)
+                return
+            except Exception as e:
+                #part of a response can't be taken back, and the last host has nowhere to fail over to
+                if streamed or last:
+                    raise
+                print("ollama pool: ", host.url, str(e))
+                #an error from the server itself, such as a missing model, says nothing about the next request
+                from ollama import ResponseError
+                if not isinstance(e, ResponseError):
+                    host.downUntil = time.monotonic() + self.retryAfter
+            finally:
+                self.release(host)
+
+    #num_ctx from the modelfile or the server's default, capped at what the model was trained on
+    def contextLength(self, model):
+        length = int(os.environ.get("OLLAMA_CONTEXT_LENGTH", self.defaultContext) or self.defaultContext)
+        info = self.candidates(model)[0].getClient().show(model)
+        match = re.search(r"^num_ctx\s+(\d+)", info.parameters or "", flags=re.MULTILINE)
+        if match:
+            length = int(match.group(1))
+        trained = [value for key, value in (info.modelinfo or {}).items() if key.endswith(".context_length")]
+        if len(trained) > 0:
+            length = min(length, int(trained[0]))
+        return length
+
+
+class OpenAIBackend(Backend):
+    """Any server with the OpenAI chat completions api, such as llama.cpp server, vLLM or LM Studio."""
+    kind = "openai"
+
+    def __init__(self, url, apiKey="", timeout=600):
+        url = url.rstrip("/")
+        if not url.endswith("/v1"):
+            url = url + "/v1"
+        self.url = url
+        self.apiKey = apiKey
+        self.timeout = timeout
+        self.lengths = {}
+        self.asyncClients = LoopClients(self.makeAsyncClient)
+
+    def makeAsyncClient(self):
+        import httpx
+        return httpx.AsyncClient(timeout=self.timeout)
+
+    def headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.apiKey:
+            headers["Authorization"] = f"Bearer {self.apiKey}"
+        return headers
+
+    def get(self, url):
+        import httpx
+        response = httpx.get(url, headers=self.headers(), timeout=self.timeout)
+        if response.status_code != 200:
+            raise RuntimeError(f"{url} {response.status_code}: {response.text[:200]}")
+        return response.json()
+
+    def listModels(self):
+        models = []
+        for entry in self.get(f"{self.url}/models").get("data", []):
+            models.append(entry["id"])
+            #vLLM says how long its context is
+            if entry.get("max_model_len"):
+                self.lengths[entry["id"]] = int(entry["max_model_len"])
+        return models
+
+    @staticmethod
+    def mediaType(data):
+        return {"/9j/": "image/jpeg", "iVBO": "image/png", "UklG": "image/webp"}.get(data[:4], "image/jpeg")
+
+    #images go in as data urls alongside the text
+    def convertMessages(self, messages):
+        converted = []
+        for message in messages:
+            if len(message.get("images", ())) == 0:
+                converted.append({"role": message["role"], "content": message["content"]})
+                continue
+            parts = [{"type": "text", "text": message["content"]}]
+            for image in message["images"]:
+                parts.append({"type": "image_url", "image_url": {"url": f"data:{self.mediaType(image)};base64,{image}"}})
+            converted.append({"role": message["role"], "content": parts})
+        return converted
+
+    async def streamChat(self, model, messages, keepAlive=None, numCtx=0):
+        body = {"model": model, "messages": self.convertMessages(messages), "stream": True,
+                "stream_options": {"include_usage": True}}
+        start = time.monotonic()
+        async with self.asyncClients.get().stream("POST", f"{self.url}/chat/completions", json=body,
+                                                  headers=self.headers()) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise RuntimeError(f"chat {response.status_code}: {response.text[:200]}")
+            async for chunk in self.parseEvents(response.aiter_lines(), start):
+                yield chunk
+
+    #server sent events, one "data: {json}" line per delta and "data: [DONE]" at the end
+    @staticmethod
+    async def parseEvents(lines, start):
+        firstAt = None
+        count = 0
+        usage = {}
+        serverTimings = {}
+        async for line in lines:
+            line = line.strip()
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            event = json.loads(data)
+            usage = event.get("usage") or usage
+            serverTimings = event.get("timings") or serverTimings
+            for choice in event.get("choices", []):
+                content = (choice.get("delta") or {}).get("content") or ""
+                if content:
+                    if firstAt is None:
+                        firstAt = time.monotonic()
+                    count += 1
+                    yield {"content": content, "done": False}
+        end = time.monotonic()
+        done = {"content": "", "done": True,
+                "eval_count": usage.get("completion_tokens", count),
+                "eval_duration": int((end - (firstAt or end)) * 1e9),
+                "prompt_eval_count": usage.get("prompt_tokens"),
+                "prompt_eval_duration": int(((firstAt or end) - start) * 1e9),
+                "load_duration": None, "total_duration": int((end - start) * 1e9)}
+        #llama.cpp server reports its own timings, which leave out the network
+        if "predicted_n" in serverTimings:
+            done.update({"eval_count": serverTimings["predicted_n"],
+                         "eval_duration": int(serverTimings["predicted_ms"] * 1e6),
+                         "prompt_eval_count": serverTimings.get("prompt_n"),
+                         "prompt_eval_duration": int(serverTimings.get("prompt_ms", 0) * 1e6)})
+        yield done
+
+    #vLLM lists it with the models, llama.cpp server has it under /props
+    def contextLength(self, model):
+        if model not in self.lengths:
+            rootUrl = self.url[:-len("/v1")]
+            props = self.get(f"{rootUrl}/props")
+            length = (props.get("default_generation_settings") or {}).get("n_ctx")
+            self.lengths[model] = int(length) if length else None
+        return self.lengths[model]
+
+
+#the same conversation always gets the same key, so a replay can find what was recorded for it
+def recordingKey(model, messages):
+    text = json.dumps([model] + [[message["role"], message["content"]] for message in messages])
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=12).hexdigest()
+
+
+class RecordingBackend(Backend):
+    """Passes everything through to another backend, appending each finished stream to a JSON lines file."""
+    def __init__(self, inner, path):
+        self.inner = inner
+        self.kind = inner.kind
+        self.path = path
+        self.lock = threading.Lock()
+
+    def listModels(self):
+        return self.inner.listModels()
+
+    def contextLength(self, model):
+        return self.inner.contextLength(model)
+
+    #a stream that is cancelled part way isn't saved
+    async def streamChat(self, model, messages, keepAlive=None, numCtx=0):
+        start = time.monotonic()
+        recorded = []
+        async for chunk in self.inner.streamChat(model, messages, keepAlive, numCtx):
+            recorded.append([round(time.monotonic() - start, 4), chunk])
+            yield chunk
+        line = json.dumps({"model": model, "key": recordingKey(model, messages), "chunks": recorded}) + "\n"
+        with self.lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(line)
+
+
+class ReplayBackend(Backend):
+    """Plays back streams captured by a RecordingBackend with their original timing.
+
+    A conversation that was recorded gets its own recording, anything else gets the model's recordings in turn.
+    """
+    kind = "replay"
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.recordings = {}
+        self.byModel = {}
+        self.next = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    recording = json.loads(line)
+                except ValueError:
+                    continue
+                self.recordings[recording["key"]] = recording["chunks"]
+                self.byModel.setdefault(recording["model"], []).append(recording["chunks"])
+
+    def listModels(self):
+        return list(self.byModel)
+
+    #each chunk comes out at the offset it was recorded at
+    async def streamChat(self, model, messages, keepAlive=None, numCtx=0):
+        chunks = self.recordings.get(recordingKey(model, messages))
+        if chunks is None:
+            if model not in self.byModel:
+                raise RuntimeError(f"nothing recorded for {model}")
+            with self.lock:
+                index = self.next.get(model, 0)
+                self.next[model] = index + 1
+            chunks = self.byModel[model][index % len(self.byModel[model])]
+        start = time.monotonic()
+        for offset, chunk in chunks:
+            wait = start + offset / self.speed - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            yield chunk
+
+
+#config is one entry from the backends setting, "record" on any of them saves what it streams
+def makeBackend(config, ollamaUrl=None):
+    kind = config.get("type", "ollama")
+    if kind == "ollama":
+        backend = OllamaBackend(config.get("hosts") or config.get("host") or ollamaUrl)
+    elif kind == "openai":
+        backend = OpenAIBackend(config["url"], config.get("apiKey", ""))
+    elif kind == "replay":
+        backend = ReplayBackend(os.path.expanduser(config["path"]), config.get("speed", 1.0))
+    else:
+        raise ValueError(f"unknown backend type - {kind}")
+    if config.get("record"):
+        backend = RecordingBackend(backend, os.path.expanduser(config["record"]))
+    return backend
+
+
+class BackendSet:
+    """The configured backends and which one answers each model.
+
+    A model goes to the backend chosen for it in modelBackends, otherwise to the first backend that lists it,
+    otherwise to the first backend.
+    """
+    def __init__(self, configs=None, modelBackends=None, ollamaUrl=None):
+        self.backends = {}
+        for name, config in (configs or {"ollama": {"type": "ollama"}}).items():
+            try:
+                self.backends[name] = makeBackend(config, ollamaUrl)
+            except Exception as e:
+                print("backends: ", name, str(e))
+        if len(self.backends) == 0:
+            self.backends["ollama"] = OllamaBackend(ollamaUrl)
+        self.modelBackends = dict(modelBackends or {})
+        self.owners = {}
+        self.lists = {}
+
+    def names(self):
+        return list(self.backends)
+
+    def forModel(self, model):
+        name = self.modelBackends.get(model)
+        if name not in self.backends:
+            name = self.owners.get(model)
+        return self.backends.get(name) or next(iter(self.backends.values()))
+
+    def isOllama(self, model):
+        return self.forModel(model).kind == "ollama"
+
+    #the ollama server a prompt for model would go to, None if ollama doesn't serve it
+    def ollamaUrl(self, model):
+        backend = self.forModel(model)
+        if isinstance(backend, RecordingBackend):
+            backend = backend.inner
+        return backend.preferredUrl(model) if isinstance(backend, OllamaBackend) else None
+
+    #whether an ollama backend pools more than one server, the local manifests don't show the others' models
+    def isPooled(self):
+        backends = [backend.inner if isinstance(backend, RecordingBackend) else backend for backend in self.backends.values()]
+        return any(isinstance(backend, OllamaBackend) and len(backend.hosts) > 1 for backend in backends)
+
+    #whether a prompt for model would go to the ollama server at url, so has to wait for it to be up
+    def usesServer(self, model, url):
+        return self.isOllama(model) and self.ollamaUrl(model) == hostUrl(url)
+
+    #every backend's models, a backend that can't be reached keeps the list it last gave, None if none answered
+    def listModels(self):
+        answered = False
+        owners = {}
+        for name, backend in self.backends.items():
+            try:
+                self.lists[name] = backend.listModels()
+                answered = True
+            except Exception as e:
+                print("backends: ", name, str(e))
+            for model in self.lists.get(name, []):
+                owners.setdefault(model, name)
+        if not answered:
+            return None
+        self.owners = owners
+        return sorted(owners)
@@ -1,10 +1,12 @@
-import re
-
-from PyQt5.QtCore import pyqtSignal
-from PyQt5.QtGui import QTextCharFormat, QTextCursor, QColor
-from PyQt5.QtWidgets import QHBoxLayout, QWidget, QTextEdit
+from PyQt5.QtCore import pyqtSignal, QTimer, QPoint
+from PyQt5.QtGui import QTextCursor
+from PyQt5.QtWidgets import QHBoxLayout, QVBoxLayout, QWidget, QTextEdit
 
+from CompareView import CompareView
+from RoleHighlighter import RoleHighlighter
 from Translator import makeTranslator
+from TranscriptParser import TranscriptParser, Transcript, render
+from TurnView import TurnView
 
 
 class ChatDisplay(QWidget):
@@ -15,13 +17,44 @@ class ChatDisplay(QWidget):
         self.richType = "markdown"
         self.translator = makeTranslator(self.richType)
 
-        layout = QHBoxLayout(self)
+        outerLayout = QVBoxLayout(self)
+        layout = QHBoxLayout()
+        outerLayout.addLayout(layout, 3)
         self.rawDisplay = self.createRawDisplay()
         layout.addWidget(self.rawDisplay)
         self.richDisplay = self.createRichDisplay()
         layout.addWidget(self.richDisplay)
+        #the rich pane as a list of turns instead of one document, for long chats
+        self.useTurnView = False
+        self.turnView = TurnView()
+        self.turnView.setTranslator(self.translator)
+        self.turnView.turnModel.edited.connect(self.editTurn)
+        self.turnView.hide()
+        layout.addWidget(self.turnView)
+        self.delims = None
+        #answers from several models side by side, under the chat, only shown while comparing
+        self.compareView = CompareView()
+        outerLayout.addWidget(self.compareView, 2)
+        #bumped on every edit so the parsed transcript can be reused while the text is unchanged
+        self.revision = 0
+        self.parser = TranscriptParser()
+        self.rawDisplay.document().contentsChanged.connect(self.bumpRevision)
+        self.rawHighlighter = RoleHighlighter(self.rawDisplay.document())
+        self.richHighlighter = RoleHighlighter(self.richDisplay.document())
+        #turns of a long chat that are older than those in the raw pane, oldest first, kept without delimiters
+        #and moved into the pane a page at a time as it is scrolled to the top
+        self.olderPreamble = ""
+        self.older = []
+        self.pageTurns = 40
+        self.olderTimer = QTimer(self)
+        self.olderTimer.setSingleShot(True)
+        self.olderTimer.timeout.connect(self.loadOlderAtTop)
+        for pane in (self.rawDisplay, self.richDisplay, self.turnView):
+            pane.verticalScrollBar().valueChanged.connect(self.checkOlder)
+            pane.verticalScrollBar().rangeChanged.connect(self.checkOlder)
 
-        layout.setContentsMargins(0, 0, 0, 0)
+        outerLayout.setContentsMargins(0, 0, 0, 0)
+        outerLayout.setSpacing(5)
         layout.setSpacing(5)
 
 
@@ -38,6 +71,10 @@ class ChatDisplay(QWidget):
         richDisplay.hide()
         return richDisplay
 
+    #whichever widget is showing the rich pane
+    def richPane(self):
+        return self.turnView if self.useTurnView else self.richDisplay
+
     def setRawVisibility(self, x, delims):
         if x:
             self.rawDisplay.show()
@@ -47,89 +84,130 @@ class ChatDisplay(QWidget):
             else:
                 self.autoShowRaw.emit()"""
             self.rawDisplay.hide()
-            if not self.richDisplay.isVisible():
+            if not self.richPane().isVisible():
                 self.autoShowRich.emit()
                 self.setRichVisibility(True, delims)
     def setRichVisibility(self, x, delims):
         if x:
-            self.richDisplay.show()
-            self.renderRich()
+            self.richPane().show()
             self.recolour_text(delims)
+            self.renderRich()
         else:
             """if self.rawDisplay.isVisible():
                 self.richDisplay.hide()
             else:
                 self.autoShowRich.emit()"""
-            self.richDisplay.hide()
+            self.richPane().hide()
             if not self.rawDisplay.isVisible():
                 self.autoShowRaw.emit()
                 self.setRawVisibility(True, delims)
 
+    def setTurnView(self, x, delims):
+        if x == self.useTurnView:
+            return
+        shown = self.richPane().isVisible()
+        self.richPane().hide()
+        self.useTurnView = x
+        if shown:
+            self.setRichVisibility(True, delims)
+
 
     def renderRaw(self, delims):
-        self.translator.richToRaw(delims, self.richDisplay, self.rawDisplay)
+        #the turn view edits the raw pane directly
+        if not self.useTurnView:
+            self.translator.richToRaw(delims, self.richDisplay, self.rawDisplay)
 
     def renderRich(self):
-        self.translator.rawToRich(self.richDisplay, self.rawDisplay)
+        if self.useTurnView:
+            if self.turnView.isVisible() and self.delims is not None:
+                self.turnView.turnModel.setTurns(self.transcript(self.delims).turns)
+        elif self.richDisplay.isVisible():
+            self.translator.rawToRich(self.richDisplay, self.segments())
+
+    #the raw pane cut where each turn starts, the rich pane is rendered and cached a piece at a time
+    def segments(self):
+        if self.delims is None:
+            return [self.rawDisplay.toPlainText()]
+        transcript = self.transcript(self.delims)
+        segments = [transcript.text[turn.span[0]:turn.span[1]].rstrip() for turn in transcript.turns]
+        if transcript.preamble.strip() != "":
+            segments.insert(0, transcript.preamble.rstrip())
+        return segments
+
+    #an edited turn goes back into the raw pane in place, so the rest of the document and its undo history are kept
+    def editTurn(self, row, text):
+        transcript = self.transcript(self.delims)
+        if row >= len(transcript):
+            return
+        turn = transcript[row]
+        trailing = turn.content[len(turn.content.rstrip()):]
+        start = turn.span[0] + len(turn.delim)
+        #qt positions count utf-16 code units
+        def position(index):
+            return len(transcript.text[:index].encode("utf-16-le")) // 2
+        cursor = QTextCursor(self.rawDisplay.document())
+        cursor.setPosition(position(start))
+        cursor.setPosition(position(turn.span[1]), QTextCursor.KeepAnchor)
+        cursor.insertText(" " + text.strip() + trailing)
+        self.renderRich()
+
+
+    def setOlder(self, preamble, turns):
+        self.olderPreamble = preamble
+        self.older = list(turns)
+        self.checkOlder()
+
+    #left until scrolling has settled, the scrollbars also move while text is being inserted
+    def checkOlder(self, *args):
+        if len(self.older) > 0:
+            self.olderTimer.start(0)
+
+    def loadOlderAtTop(self):
+        for pane in (self.rawDisplay, self.richPane()):
+            scrollBar = pane.verticalScrollBar()
+            if pane.isVisible() and scrollBar.value() == scrollBar.minimum():
+                self.loadOlder()
+                return
 
+    #put the newest page of older turns at the start of the raw pane, keeping what was on screen where it was
+    def loadOlder(self):
+        if len(self.older) == 0 or self.delims is None:
+            return
+        split = max(0, len(self.older) - max(1, self.pageTurns))
+        page = self.older[split:]
+        text = render(page, self.delims, self.olderPreamble if split == 0 else "")
+        self.older = self.older[:split]
+        if split == 0:
+            self.olderPreamble = ""
 
-    # recolour all text in text box
+        rawBar = self.rawDisplay.verticalScrollBar()
+        #a cursor follows the text it is in as text is inserted before it
+        top = self.rawDisplay.cursorForPosition(QPoint(0, 0))
+        offset = self.rawDisplay.cursorRect(top).top()
+        richBar = self.richDisplay.verticalScrollBar()
+        fromBottom = richBar.maximum() - richBar.value()
+        firstRow = self.turnView.indexAt(QPoint(0, 0)).row()
+
+        document = self.rawDisplay.document()
+        #the pane is now the only copy of these turns, so they can't be undone away
+        document.setUndoRedoEnabled(False)
+        QTextCursor(document).insertText(text)
+        document.setUndoRedoEnabled(True)
+        rawBar.setValue(rawBar.value() + self.rawDisplay.cursorRect(top).top() - offset)
+
+        self.renderRich()
+        if self.useTurnView:
+            if firstRow >= 0:
+                self.turnView.scrollTo(self.turnView.turnModel.index(firstRow + len(page)), TurnView.PositionAtTop)
+        elif self.richDisplay.isVisible():
+            richBar.setValue(richBar.maximum() - fromBottom)
+
+    # recolour the delimiters from what is on screen, the highlighters keep themselves up to date as the text changes
     def recolour_text(self, delims):
-        try:
-            black = QColor("black")
-            prevEnd = 0
-            def py_to_qt_index(s, py_index):
-                # utf-16-le: 2 bytes per code unit; subtract BOM
-                return len(s[:py_index].encode("utf-16-le")) // 2
-            for obj in [self.rawDisplay, self.richDisplay]:
-                text = obj.toPlainText()
-                cursor = obj.textCursor()
-                cursor.select(QTextCursor.Document)
-                cursor.mergeCharFormat(QTextCharFormat())
-
-                pattern = re.compile(f"({delims['user']}|{delims['assistant']}|{delims['system']})",
-                                     re.IGNORECASE)
-                matches = list(pattern.finditer(text.lower()))
-
-                for i, match in enumerate(matches):
-                    role_text = match.group().lower()
-                    if delims["user"] in role_text:
-                        role_color = QColor("blue")
-                    elif delims["assistant"] in role_text:
-                        role_color = QColor("green")
-                    else:
-                        role_color = QColor("gray")
-
-                    start = py_to_qt_index(text, match.start())
-                    end = py_to_qt_index(text, match.end()-1)
-                    #end = py_to_qt_index(text, matches[i + 1].start()) if i + 1 < len(matches) else len(
-                    #    text.encode("utf-16-le")) // 2
-
-                    fmt = QTextCharFormat()
-                    fmt.setForeground(black)
-                    cursor.setPosition(prevEnd)
-                    cursor.setPosition(start, QTextCursor.KeepAnchor)
-                    cursor.mergeCharFormat(fmt)
-                    prevEnd = end
-
-                    fmt = QTextCharFormat()
-                    fmt.setForeground(role_color)
-                    cursor.setPosition(start)
-                    cursor.setPosition(end, QTextCursor.KeepAnchor)
-                    cursor.mergeCharFormat(fmt)
-
-                fmt = QTextCharFormat()
-                fmt.setForeground(black)
-                cursor.setPosition(prevEnd)
-                end = cursor.document().characterCount() - 1
-                cursor.setPosition(end, QTextCursor.KeepAnchor)
-
-                cursor.mergeCharFormat(fmt)
-
-
-        except Exception as e:
-            import traceback
-            self.display_text("recolourText error:\n" + traceback.format_exc())
+        self.delims = delims
+        for pane, highlighter in ((self.rawDisplay, self.rawHighlighter), (self.richDisplay, self.richHighlighter)):
+            if delims != highlighter.delims:
+                highlighter.setDelims(delims, pane.cursorForPosition(QPoint(0, 0)).blockNumber())
 
     # display text in the text box
     def display_text(self, text, end=""):
@@ -144,27 +222,74 @@ class ChatDisplay(QWidget):
     def chunk(self, chunk, delims):
         if chunk == "assis12":
             if self.rawDisplay.hasFocus() or (self.richDisplay.hasFocus() and self.richType=="html"):
-                self.display_text(f"\n\n")
-            self.display_text(f"{delims["assistant"]} ")
+                self.appendStream(f"\n\n")
+            self.appendStream(f"{delims["assistant"]} ")
             self.recolour_text(delims)
+            #the turn view gets a row for the response, which chunks are then added to
+            if self.useTurnView:
+                self.renderRich()
         elif chunk == "usr12":
-            self.display_text(f"\n\n{delims["user"]} ")
+            self.appendStream(f"\n\n{delims["user"]} ")
+            #rich pane is only rebuilt once the response has finished
+            self.renderRich()
             self.recolour_text(delims)
         else:
-            self.display_text(chunk)
+            self.appendStream(chunk)
+            if self.useTurnView and self.turnView.isVisible():
+                self.turnView.turnModel.appendToLast(chunk)
+
+    #append text to the end of the raw pane without touching the rest of the document
+    def appendStream(self, text):
+        scrollBar = self.rawDisplay.verticalScrollBar()
+        atBottom = scrollBar.value() >= scrollBar.maximum()
 
-        self.translator.richToRaw(delims, self.rawDisplay, self.rawDisplay)
+        cursor = QTextCursor(self.rawDisplay.document())
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text)
+
+        if atBottom:
+            scrollBar.setValue(scrollBar.maximum())
 
     #clear previous response if the user wants to regenerate
     def deleteForRegen(self, delims):
         #get rid of: empty after user, user, response, assistant
-        text = re.split(f"({delims["user"]}|{delims["assistant"]}|{delims["system"]})", self.rawDisplay.toPlainText())[:-4]
+        transcript = self.transcript(delims)
+        #the response being removed can be all that is left in the pane
+        while len(transcript) < 2 and len(self.older) > 0:
+            self.loadOlder()
+            transcript = self.transcript(delims)
+        if len(transcript) < 2:
+            return
+        text = transcript.text[:transcript[-2].span[0]]
         #remove newlines from last remaining item
-        text[-1] = text[-1][:-2]
+        text = text[:-2]
         self.rawDisplay.clear()
-        self.display_text("".join(text))
+        self.display_text(text)
+
+    def bumpRevision(self):
+        self.revision += 1
+    #turns of the raw pane, only re-parsed when the document has changed
+    def transcript(self, delims):
+        return self.parser.parse(self.revision, delims, self.rawDisplay.toPlainText)
+
+    #every turn of the chat for a prompt, the older ones straight from memory rather than put in the pane first
+    def fullTranscript(self, delims):
+        transcript = self.transcript(delims)
+        if len(self.older) == 0:
+            return transcript
+        return Transcript(None, self.olderPreamble, self.older + transcript.turns, delims)
+
+    #the whole chat, older turns included, unstripped
+    def fullText(self):
+        if len(self.older) == 0 and self.olderPreamble == "":
+            return self.rawDisplay.toPlainText()
+        return render(self.older, self.delims, self.olderPreamble) + self.rawDisplay.toPlainText()
 
     def getText(self):
-        return self.rawDisplay.toPlainText().strip()
+        return self.fullText().strip()
     def clearText(self):
-        self.rawDisplay.clear()
\ No newline at end of file
+        self.olderPreamble = ""
+        self.older = []
+        self.rawDisplay.clear()
+        if self.useTurnView:
+            self.turnView.turnModel.setTurns([])
\ No newline at end of file
@@ -1,32 +1,55 @@
-import re
-import time
-import os
-from pathlib import Path
+import json
 from xmlrpc.client import Boolean
 
 from PyQt5.QtCore import pyqtSignal, QObject
 
+import TranscriptParser
+from IOExecutor import IOExecutor
+from TranscriptCache import TranscriptCache
+
 
 class ChatHandler(QObject):
     display = pyqtSignal(str)
+    #the preamble and turns of a long chat that come before those displayed
+    paged = pyqtSignal(str, list)
     recolour = pyqtSignal()
     clear = pyqtSignal()
     updateChatNames = pyqtSignal(list, str, Boolean)
-    endGeneration = pyqtSignal()
     changeCurrentChatName = pyqtSignal(str)
+    #the chat on screen is about to change away from this one
+    leaving = pyqtSignal(str)
+    renamed = pyqtSignal(str, str)
+    deleted = pyqtSignal(str)
+    #chat names and snippets for the latest search
+    searchResults = pyqtSignal(list)
 
-    def __init__(self, datastore, prevChat):
+    def __init__(self, datastore, store, prevChat, cacheBytes=64 << 20, pageTurns=40):
         super().__init__()
 
         self.prevChat = None
         self.deletingTemp = False
+        self.store = store
         self.dataStore = datastore
         self.dataStore.mkdir(parents=True, exist_ok=True)
 
+        #all disk access goes through the executor, the GUI only ever queues work
+        self.executor = IOExecutor()
+        #recently used chats, and the only copy of unsaved edits
+        self.cache = TranscriptCache(cacheBytes)
+        #bumped on every switch so a slow load can't overwrite a newer one
+        self.loadId = 0
+        self.loadPending = False
+        #returns the text of a chat that is still generating, which is newer than any saved copy
+        self.liveText = lambda name: None
+        #turns displayed when a chat is opened, 0 displays them all
+        self.pageTurns = pageTurns
+        #bumped on every search so results for an older query are dropped
+        self.searchId = 0
+
         self.prevChat = prevChat
 
     #save chat permenantly
-    def saveChat(self, currentIndex, newName, allNames, fullChat, enableSysPrompt, sysPrompt, delims):
+    def saveChat(self, currentIndex, newName, allNames, fullChat, enableSysPrompt, sysPrompt, delims, model=""):
         try:
             i=0
             if newName.strip() == "" or any([x in newName for x in [":","\\"]]):
@@ -36,17 +59,20 @@ class ChatHandler(QObject):
                 if f"{newName} ({i})" not in allNames:
                     newName = f"{newName} ({i})"
 
-            if (self.dataStore / f"history/{allNames[currentIndex]}.txt").is_file():
-                Path.rename(self.dataStore / f"history/{allNames[currentIndex]}.txt", self.dataStore / f"history/{newName}.txt")
-            else:
-                (self.dataStore / "history").mkdir(parents=True, exist_ok=True)
-                with open(self.dataStore / f"history/{newName}.txt", "w"):
-                    pass
-            toWrite = self.addHiddenPromptIfNeeded(fullChat, enableSysPrompt, sysPrompt, delims)
-            with open(self.dataStore / f"history/{newName}.txt", "w", encoding="utf-8") as file:
-                file.write(toWrite)
-
-            self.saveTemp(fullChat, enableSysPrompt, sysPrompt, delims)
+            oldName = allNames[currentIndex]
+            if oldName != newName:
+                self.renamed.emit(oldName, newName)
+            transcript = TranscriptParser.parse(self.addHiddenPromptIfNeeded(fullChat, enableSysPrompt, sysPrompt, delims), delims)
+            content = json.dumps({"from": oldName, "model": model, "preamble": transcript.preamble,
+                                  "turns": [[turn.role, turn.content] for turn in transcript.turns]})
+            self.executor.write(("chat", newName), content, lambda _: self.writeChat(oldName, newName, transcript, model))
+
+            #the permanent save now matches, so the draft becomes the saved copy under the new name
+            self.cache.discard(oldName)
+            self.cache.discard(newName)
+            self.cache.put(newName, transcript.preamble, transcript.turns)
+            self.cache.put(newName, transcript.preamble, transcript.turns)
+            self.prevChat = newName
             allNames[currentIndex] = newName
 
             self.updateChatNames.emit(allNames, newName, False)
@@ -55,72 +81,136 @@ class ChatHandler(QObject):
         except Exception as e:
             self.display.emit(f"saveChat: {str(e)}")
 
-    #save chat as a temporary chat when switching away
+    #runs on the executor thread
+    def writeChat(self, oldName, newName, transcript, model):
+        if oldName != newName and self.store.exists(oldName):
+            self.store.rename(oldName, newName)
+            self.executor.forget(("chat", oldName))
+        self.store.saveTurns(newName, transcript.preamble, transcript.turns, model)
+
+    #keep edits to the chat being switched away from as a draft in memory
     def saveTemp(self, fullChat, enableSysPrompt, sysPrompt, delims):
         try:
-            if self.prevChat is None:
+            #the display doesn't hold prevChat until its load has arrived
+            if self.prevChat is None or self.loadPending:
                 return
-            (self.dataStore / f"history/temp{os.getpid()}").mkdir(parents=True, exist_ok=True)
-            toWrite = self.addHiddenPromptIfNeeded(fullChat, enableSysPrompt, sysPrompt, delims)
-            with open(self.dataStore / f"history/temp{os.getpid()}/{self.prevChat}.txt", "w", encoding="utf-8") as file:
-                file.write(toWrite)
+            transcript = TranscriptParser.parse(self.addHiddenPromptIfNeeded(fullChat, enableSysPrompt, sysPrompt, delims), delims)
+            self.cache.put(self.prevChat, transcript.preamble, transcript.turns, True)
 
         except Exception as e:
             self.display.emit(f"saveTemp: {str(e)}")
 
+    #a response that finished while its chat wasn't on screen, kept until the chat is saved or closed
+    def storeDraft(self, name, text, delims):
+        try:
+            transcript = TranscriptParser.parse(text, delims)
+            self.cache.put(name, transcript.preamble, transcript.turns, True)
+        except Exception as e:
+            self.display.emit(f"storeDraft: {str(e)}")
+
     def addHiddenPromptIfNeeded(self, text, enableSysPrompt, sysPrompt, delims):
         try:
             if text:
-                split = self.splitText(text, delims)
-                if len(split)>0:
-                    if not split[0].startswith(delims["system"]) and sysPrompt.strip() != "" and enableSysPrompt:
+                transcript = TranscriptParser.parse(text, delims)
+                if len(transcript)>0:
+                    if transcript[0].role != "system" and sysPrompt.strip() != "" and enableSysPrompt:
                         text = f"{delims["system"]} {sysPrompt}\n\n{text}"
                 return text
             return ""
         except Exception as e:
             self.display.emit(f"addHiddenPromptIfNeeded: {str(e)}")
 
-    def splitText(self, text, delims):
-        try:
-            return re.split(f"({delims["user"]}|{delims["assistant"]}|{delims["system"]})", text, flags=re.IGNORECASE)[1:]
-        except Exception as e:
-            self.display.emit(f"splitText: {str(e)}")
-
     #load the chat selected in the dropdown
-    def loadChat(self, prompting, fullChat, deletingTemp, allNames, currentIndex, loadPerm, enableSysPrompt, hideSysPrompt, sysPrompt, delims):
+    def loadChat(self, fullChat, deletingTemp, allNames, currentIndex, loadPerm, enableSysPrompt, hideSysPrompt, sysPrompt, delims):
         try:
-            if prompting:
-                self.endGeneration.emit()
-                time.sleep(0.001)
+            #a chat that is generating carries on in the background
+            if self.prevChat is not None and not self.loadPending:
+                self.leaving.emit(self.prevChat)
             if self.prevChat is not None and not deletingTemp:
                 self.saveTemp(fullChat, enableSysPrompt, sysPrompt, delims)
             self.deletingTemp = False
 
-            self.changeCurrentChatName.emit(allNames[currentIndex])
-
-            paths = [(self.dataStore / f"history/temp{os.getpid()}/{allNames[currentIndex]}.txt"), (self.dataStore / f"history/{allNames[currentIndex]}.txt")]
-            for i in range(len(paths)):
-                if i == 0 and loadPerm:
-                    continue
-                if paths[i].is_file():
-                    with open(paths[i], "r", encoding="utf-8") as file:
-                        self.clear.emit()
-                        text = file.read()
-                        split = self.splitText(text, delims)
-                        if len(split) >= 2:
-                            if split[0].startswith(delims["system"]) and sysPrompt.strip() != "":
-                                if split[
-                                    1].strip() == sysPrompt.strip() and enableSysPrompt and hideSysPrompt:
-                                    self.display.emit("".join(split[2:]))
-                                else:
-                                    self.display.emit(text)
-                            else:
-                                self.display.emit(text)
-                        else:
-                            self.display.emit(text)
-                    #stop if temp has been loaded
-                    break
-            self.prevChat = allNames[currentIndex]
+            name = allNames[currentIndex]
+            self.changeCurrentChatName.emit(name)
+            self.prevChat = name
+
+            self.loadId += 1
+            loadId = self.loadId
+            live = self.liveText(name)
+            if live is not None:
+                self.loadPending = False
+                self.showChat(loadId, live, enableSysPrompt, hideSysPrompt, sysPrompt, delims)
+                return
+            #reverting throws away the draft
+            if loadPerm and self.cache.isDraft(name):
+                self.cache.discard(name)
+            cached = self.cache.get(name)
+            if cached is not None:
+                self.showChat(loadId, TranscriptParser.render(cached[1], delims, cached[0]), enableSysPrompt, hideSysPrompt, sysPrompt, delims)
+                return
+
+            self.loadPending = True
+            self.executor.run(lambda: self.store.loadTurns(name),
+                              lambda loaded: self.loadedChat(name, loadId, loaded, enableSysPrompt, hideSysPrompt, sysPrompt, delims))
+
+        except Exception as e:
+            self.display.emit(f"loadChat: {str(e)}")
+
+    def loadedChat(self, name, loadId, loaded, enableSysPrompt, hideSysPrompt, sysPrompt, delims):
+        text = loaded
+        if loaded is not None and not isinstance(loaded, Exception):
+            self.cacheLoaded(name, loaded)
+            text = TranscriptParser.render(loaded[1], delims, loaded[0])
+        self.showChat(loadId, text, enableSysPrompt, hideSysPrompt, sysPrompt, delims)
+
+    def search(self, query):
+        self.searchId += 1
+        searchId = self.searchId
+        self.executor.run(lambda: self.store.search(query), lambda results: self.searched(searchId, results))
+
+    def searched(self, searchId, results):
+        if isinstance(results, Exception):
+            print("search: ", str(results))
+            results = []
+        if searchId == self.searchId:
+            self.searchResults.emit(results)
+
+    #load a chat into the cache ahead of it being opened
+    def prefetch(self, name):
+        if name is None or self.cache.contains(name):
+            return
+        self.executor.run(lambda: self.store.loadTurns(name), lambda loaded: self.cacheLoaded(name, loaded))
+
+    #anything put in the cache while the read was queued is newer than what was read
+    def cacheLoaded(self, name, loaded):
+        if isinstance(loaded, tuple) and not self.cache.contains(name):
+            self.cache.put(name, loaded[0], loaded[1])
+
+    def showChat(self, loadId, text, enableSysPrompt, hideSysPrompt, sysPrompt, delims):
+        try:
+            #a newer switch has happened since this was queued
+            if loadId != self.loadId:
+                return
+            self.loadPending = False
+            if isinstance(text, Exception):
+                raise text
+            if text is not None:
+                self.clear.emit()
+                transcript = TranscriptParser.parse(text, delims)
+                first = 0
+                if len(transcript) >= 1:
+                    if transcript[0].role == "system" and sysPrompt.strip() != "":
+                        if transcript[0].content.strip() == sysPrompt.strip() and enableSysPrompt and hideSysPrompt:
+                            first = 1
+                #only the newest turns are displayed, the rest are handed over to be added as the chat is scrolled up
+                shown = first
+                if self.pageTurns > 0 and len(transcript) - first > self.pageTurns:
+                    shown = len(transcript) - self.pageTurns
+                    self.paged.emit("" if first == 1 else transcript.preamble, transcript.turns[first:shown])
+                if shown == 0:
+                    self.display.emit(text)
+                else:
+                    self.display.emit(transcript.textFrom(shown))
             #self.chatDisplay.rawDisplay.setFocus()
             self.recolour.emit()
 
@@ -128,20 +218,18 @@ class ChatHandler(QObject):
             self.display.emit(f"loadChat: {str(e)}")
 
     #delete the current chat
-    def deleteChat(self, prompting, allNames, nameToDelete, fullText, sysPrompt, enableSysPrompt, hideSysPrompt, delims):
+    def deleteChat(self, allNames, nameToDelete, fullText, sysPrompt, enableSysPrompt, hideSysPrompt, delims):
         try:
-            if prompting:
-                self.endGeneration()
+            self.deleted.emit(nameToDelete)
             self.clear.emit()
-            if (self.dataStore / f"history/{nameToDelete}.txt").is_file():
-                (self.dataStore / f"history/{nameToDelete}.txt").unlink()
-            if (self.dataStore / f"history/temp{os.getpid()}/{nameToDelete}.txt").is_file():
+            self.executor.write(("chat", nameToDelete), None, lambda _: self.store.delete(nameToDelete))
+            if self.cache.isDraft(nameToDelete):
                 self.deletingTemp = True
-                (self.dataStore / f"history/temp{os.getpid()}/{nameToDelete}.txt").unlink()
+            self.cache.discard(nameToDelete)
             index = allNames.index(nameToDelete)
             allNames.remove(nameToDelete)
             if len(allNames) == 0:
-                self.newChat(prompting, fullText, sysPrompt, allNames, True, enableSysPrompt, hideSysPrompt, delims)
+                self.newChat(fullText, sysPrompt, allNames, True, enableSysPrompt, hideSysPrompt, delims)
             if index == len(allNames):
                 newName = allNames[index-1]
             else:
@@ -152,12 +240,15 @@ class ChatHandler(QObject):
             self.display.emit(f"deleteChat: {str(e)}")
 
     #create a new chat
-    def newChat(self, prompting, fullText, sysPrompt, allNames, save, enableSysPrompt, hideSysPrompt, delims):
+    def newChat(self, fullText, sysPrompt, allNames, save, enableSysPrompt, hideSysPrompt, delims):
         try:
-            if prompting:
-                self.endGeneration.emit()
+            if self.prevChat is not None and not self.loadPending:
+                self.leaving.emit(self.prevChat)
             if save:
                 self.saveTemp(fullText, enableSysPrompt, sysPrompt, delims)
+            #any load still in flight is for a chat we are leaving
+            self.loadId += 1
+            self.loadPending = False
             allNames.insert(0, None)
             default = "new chat"
             i = 0
@@ -182,12 +273,11 @@ class ChatHandler(QObject):
             self.display.emit(f"newChat: {str(e)}")
 
     def clearTemp(self):
-        temp_dir = self.dataStore / f"history/temp{os.getpid()}"
-        if temp_dir.is_dir():
-            for item in temp_dir.iterdir():
-                if item.is_file() or item.is_symlink():
-                    item.unlink()
-        allNames = sorted([path.name[:-4] for path in list(sorted((self.dataStore / f"history").glob('*.txt')))])
-        self.updateChatNames.emit(allNames, "", False)
+        self.cache.dropDrafts()
+        self.executor.run(self.store.names, lambda allNames: self.updateChatNames.emit(allNames, "", False))
         #self.topBar.historySelect.clear()
-        #self.topBar.historySelect.addItems(self.topBar.historyNames)
\ No newline at end of file
+        #self.topBar.historySelect.addItems(self.topBar.historyNames)
+
+    #wait for queued saves, used before the process exits
+    def flush(self):
+        self.executor.flush()
@@ -0,0 +1,246 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+
+import TranscriptParser
+from TranscriptParser import Turn
+
+
+#statements to bring the database up to each schema version
+migrations = {
+    1: ["""CREATE TABLE IF NOT EXISTS chats (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            preamble TEXT NOT NULL DEFAULT '',
+            model TEXT NOT NULL DEFAULT '',
+            created REAL NOT NULL,
+            updated REAL NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            turnCount INTEGER NOT NULL DEFAULT 0
+        )""",
+        "CREATE INDEX IF NOT EXISTS chatsUpdated ON chats(updated)",
+        "CREATE INDEX IF NOT EXISTS chatsModel ON chats(model)",
+        "CREATE INDEX IF NOT EXISTS chatsSize ON chats(size)",
+        """CREATE TABLE IF NOT EXISTS turns (
+            id INTEGER PRIMARY KEY,
+            chat INTEGER NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            UNIQUE(chat, position)
+        )"""],
+    2: ["CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"],
+    #full text index over turns, kept in step with the turns table by triggers
+    3: ["CREATE VIRTUAL TABLE IF NOT EXISTS turnsFts USING fts5(content, content='turns', content_rowid='id', prefix='2 3')",
+        """CREATE TRIGGER IF NOT EXISTS turnsInsert AFTER INSERT ON turns BEGIN
+            INSERT INTO turnsFts(rowid, content) VALUES (new.id, new.content);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS turnsDelete AFTER DELETE ON turns BEGIN
+            INSERT INTO turnsFts(turnsFts, rowid, content) VALUES ('delete', old.id, old.content);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS turnsUpdate AFTER UPDATE ON turns BEGIN
+            INSERT INTO turnsFts(turnsFts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO turnsFts(rowid, content) VALUES (new.id, new.content);
+        END""",
+        "INSERT INTO turnsFts(turnsFts) VALUES ('rebuild')"],
+}
+
+#search snippets mark matches with these
+matchStart = "\x02"
+matchEnd = "\x03"
+
+
+def turnHash(role, content):
+    return hashlib.blake2b(f"{role}\0{content}".encode("utf-8"), digest_size=16).hexdigest()
+
+
+class ChatStore:
+    """Saved chats in SQLite, one row per chat and one row per turn, stored without delimiters."""
+    def __init__(self, path):
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        #sqlite connections can't be shared between threads
+        self.local = threading.local()
+        self.importLock = threading.Lock()
+        #how many of the newest matching turns a search ranks
+        self.searchCap = 2000
+        self.createSchema()
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            self.local.connection = connection
+        return connection
+
+    def createSchema(self):
+        connection = self.connection()
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        options = [row[0] for row in connection.execute("PRAGMA compile_options")]
+        #without fts5 the schema stops at 2 and search falls back to LIKE
+        self.hasFts = "ENABLE_FTS5" in options
+        with connection:
+            for target in sorted(migrations):
+                if target == 3 and not self.hasFts:
+                    break
+                if target > version:
+                    for statement in migrations[target]:
+                        connection.execute(statement)
+                    connection.execute(f"PRAGMA user_version={target}")
+
+    def getMeta(self, key, default=None):
+        row = self.connection().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def setMeta(self, key, value):
+        with self.connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def chatId(self, name):
+        row = self.connection().execute("SELECT id FROM chats WHERE name = ?", (name,)).fetchone()
+        return None if row is None else row[0]
+
+    #includes old .txt chats that the background import hasn't reached yet
+    def names(self):
+        names = [row[0] for row in self.connection().execute("SELECT name FROM chats ORDER BY name")]
+        legacy = self.legacyNames()
+        if len(legacy) > 0:
+            names = sorted(set(names) | set(legacy))
+        return names
+
+    def exists(self, name):
+        return self.chatId(name) is not None or self.legacyPath(name).is_file()
+
+    #returns (preamble, turns) or None if there is no such chat
+    def loadTurns(self, name):
+        self.ensureImported(name)
+        connection = self.connection()
+        row = connection.execute("SELECT id, preamble FROM chats WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        turns = [Turn(role, None, content, None) for role, content in connection.execute(
+            "SELECT role, content FROM turns WHERE chat = ? ORDER BY position", (row[0],))]
+        return row[1], turns
+
+    #only turns from the first one that differs are rewritten, finding it still hashes every turn
+    def saveTurns(self, name, preamble, turns, model=""):
+        connection = self.connection()
+        now = time.time()
+        with connection:
+            self.writeTurns(connection, name, preamble, turns, model, now)
+
+    def writeTurns(self, connection, name, preamble, turns, model, now):
+        chatId = self.chatId(name)
+        if chatId is None:
+            chatId = connection.execute(
+                "INSERT INTO chats (name, preamble, model, created, updated) VALUES (?, ?, ?, ?, ?)",
+                (name, preamble, model, now, now)).lastrowid
+        stored = [row[0] for row in connection.execute(
+            "SELECT hash FROM turns WHERE chat = ? ORDER BY position", (chatId,))]
+        hashes = [turnHash(turn.role, turn.content) for turn in turns]
+
+        firstDiff = 0
+        while firstDiff < min(len(stored), len(hashes)) and stored[firstDiff] == hashes[firstDiff]:
+            firstDiff += 1
+        connection.execute("DELETE FROM turns WHERE chat = ? AND position >= ?", (chatId, firstDiff))
+        connection.executemany(
+            "INSERT INTO turns (chat, position, role, content, hash) VALUES (?, ?, ?, ?, ?)",
+            [(chatId, i, turns[i].role, turns[i].content, hashes[i]) for i in range(firstDiff, len(turns))])
+
+        size = len(preamble) + sum(len(turn.content) for turn in turns)
+        connection.execute(
+            "UPDATE chats SET preamble = ?, model = CASE WHEN ? = '' THEN model ELSE ? END, updated = ?, size = ?, turnCount = ? WHERE id = ?",
+            (preamble, model, model, now, size, len(turns), chatId))
+
+    def rename(self, oldName, newName):
+        self.ensureImported(oldName)
+        with self.connection() as connection:
+            connection.execute("UPDATE chats SET name = ? WHERE name = ?", (newName, oldName))
+
+    def delete(self, name):
+        with self.connection() as connection:
+            connection.execute("DELETE FROM chats WHERE name = ?", (name,))
+        self.legacyPath(name).unlink(missing_ok=True)
+
+    #chats ranked by how well their turns match, with a snippet of the best matching turn
+    def search(self, query, limit=20):
+        terms = re.findall(r"\w+", query)
+        if len(terms) == 0:
+            return []
+        connection = self.connection()
+        if self.hasFts:
+            #shorter prefixes match too much of the index to rank quickly, so they have to match a whole word
+            match = " ".join(f'"{term}"*' if len(term) >= 3 else f'"{term}"' for term in terms)
+            #only the newest searchCap matching turns are ranked, so common words cost the same as rare ones
+            return connection.execute(
+                """SELECT chats.name, snippet(turnsFts, 0, :start, :end, '…', 12) FROM (
+                        SELECT turns.chat AS chat, ranked.rowid AS turn, MIN(ranked.rank) AS rank FROM (
+                            SELECT rowid, rank FROM turnsFts WHERE turnsFts MATCH :match ORDER BY rowid DESC LIMIT :cap
+                        ) AS ranked
+                        JOIN turns ON turns.id = ranked.rowid
+                        GROUP BY turns.chat ORDER BY rank LIMIT :limit
+                    ) AS best
+                    JOIN turnsFts ON turnsFts.rowid = best.turn
+                    JOIN chats ON chats.id = best.chat
+                    WHERE turnsFts MATCH :match
+                    ORDER BY best.rank""",
+                {"start": matchStart, "end": matchEnd, "match": match, "cap": self.searchCap, "limit": limit}).fetchall()
+        pattern = "%" + re.sub(r"([\\%_])", r"\\\1", terms[0]) + "%"
+        #the newest matching turn of each chat
+        rows = connection.execute(
+            """SELECT chats.name, turns.content, MAX(turns.id) FROM turns JOIN chats ON chats.id = turns.chat
+               WHERE turns.content LIKE ? ESCAPE '\\' GROUP BY turns.chat ORDER BY chats.updated DESC LIMIT ?""",
+            (pattern, limit))
+        return [(name, self.likeSnippet(content, terms[0])) for name, content, _ in rows]
+
+    def likeSnippet(self, content, term):
+        index = content.lower().find(term.lower())
+        start = max(0, index - 40)
+        return ("…" if start > 0 else "") + content[start:index] + matchStart + content[index:index + len(term)] + matchEnd + content[index + len(term):index + len(term) + 40] + "…"
+
+    def legacyPath(self, name):
+        return self.path.parent / f"{name}.txt"
+    def legacyPaths(self):
+        return sorted(self.path.parent.glob("*.txt"))
+    def legacyNames(self):
+        return [path.stem for path in self.legacyPaths()]
+
+    #import an old .txt chat before it is read or changed
+    def ensureImported(self, name):
+        path = self.legacyPath(name)
+        delims = self.legacyDelims()
+        #the migrator records the delimiters at launch, a file that turned up since waits for the next one
+        if path.is_file() and delims is not None:
+            self.importLegacyFile(path, delims)
+
+    #import one chat from the old one .txt per chat history, the file is moved aside afterwards
+    def importLegacyFile(self, path, delims):
+        #the gui and the background migrator can both reach for the same file
+        with self.importLock:
+            if not path.is_file():
+                return
+            with open(path, "r", encoding="utf-8") as file:
+                transcript = TranscriptParser.parse(file.read(), delims)
+            connection = self.connection()
+            with connection:
+                if self.chatId(path.stem) is None:
+                    self.writeTurns(connection, path.stem, transcript.preamble, transcript.turns, "", path.stat().st_mtime)
+            imported = path.parent / "imported"
+            imported.mkdir(exist_ok=True)
+            path.replace(imported / path.name)
+
+    #the old files were written with whatever delimiters were set at the time, so remember those
+    #rather than parsing them with delimiters that were changed later
+    def legacyDelims(self, currentDelims=None):
+        delims = self.getMeta("legacyDelims")
+        if delims is None and currentDelims is not None:
+            delims = dict(currentDelims)
+            self.setMeta("legacyDelims", delims)
+        return delims
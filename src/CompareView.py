@@ -0,0 +1,178 @@
+import time
+
+from PyQt5.QtCore import pyqtSignal, QTimer
+from PyQt5.QtGui import QTextCursor
+from PyQt5.QtWidgets import QHBoxLayout, QVBoxLayout, QWidget, QTextEdit, QLabel, QPushButton
+
+
+class CompareColumn(QWidget):
+    """One model's answer in a compare, with its time to first token, speed and duration."""
+    keep = pyqtSignal()
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.start = time.monotonic()
+        self.ttft = None
+        self.firstAt = None
+        self.doneAt = None
+        self.chunks = 0
+        self.timings = {}
+        #the prompt was a regenerate, so keeping this answer replaces the last one
+        self.regen = False
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.setSpacing(2)
+        header = QHBoxLayout()
+        self.modelLabel = QLabel(f"<b>{model}</b>")
+        header.addWidget(self.modelLabel)
+        header.addStretch(1)
+        self.keepButton = QPushButton("keep")
+        self.keepButton.setMaximumHeight(22)
+        self.keepButton.setEnabled(False)
+        self.keepButton.clicked.connect(self.keep)
+        header.addWidget(self.keepButton)
+        layout.addLayout(header)
+        self.statsLabel = QLabel()
+        layout.addWidget(self.statsLabel)
+        self.output = QTextEdit()
+        self.output.setReadOnly(True)
+        self.output.setAcceptRichText(False)
+        layout.addWidget(self.output)
+        self.updateStats()
+
+    def chunk(self, text):
+        if text == "regen12":
+            self.regen = True
+        elif text in ("assis12", "usr12") or text == "":
+            pass
+        else:
+            if self.firstAt is None:
+                self.firstAt = time.monotonic()
+            #ollama streams about a token a chunk
+            self.chunks += 1
+            cursor = QTextCursor(self.output.document())
+            cursor.movePosition(QTextCursor.End)
+            cursor.insertText(text)
+
+    def setFirstToken(self, seconds):
+        self.ttft = seconds
+
+    def finish(self, timings):
+        self.doneAt = time.monotonic()
+        self.timings = timings or {}
+        self.keepButton.setEnabled(self.chunks > 0)
+        self.updateStats()
+
+    def isDone(self):
+        return self.doneAt is not None
+
+    def text(self):
+        return self.output.toPlainText()
+
+    #ollama's own numbers once there are any, until then measured here
+    def tokensPerSecond(self, now):
+        count, duration = self.timings.get("eval_count"), self.timings.get("eval_duration")
+        if count and duration:
+            return count / (duration / 1e9)
+        if self.firstAt is not None and now - self.firstAt > 0.2:
+            return self.chunks / (now - self.firstAt)
+        return None
+
+    def updateStats(self):
+        now = self.doneAt or time.monotonic()
+        ttft = self.ttft
+        if ttft is None and self.firstAt is not None:
+            ttft = self.firstAt - self.start
+        rate = self.tokensPerSecond(now)
+        parts = [f"ttft {ttft:.2f}s" if ttft is not None else "ttft -",
+                 f"{rate:.1f} tok/s" if rate is not None else "- tok/s",
+                 f"{now - self.start:.1f}s" + ("" if self.isDone() else "…")]
+        self.statsLabel.setText("  ·  ".join(parts))
+
+
+class CompareView(QWidget):
+    """Columns of answers from several models to the same prompt, any one of which can be kept."""
+    merge = pyqtSignal(str, bool)
+    dismissed = pyqtSignal()
+
+    def __init__(self):
+        super().__init__()
+        self.columns = []
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.setSpacing(2)
+        header = QHBoxLayout()
+        self.titleLabel = QLabel()
+        header.addWidget(self.titleLabel)
+        header.addStretch(1)
+        self.closeButton = QPushButton("✕")
+        self.closeButton.setMaximumWidth(25)
+        self.closeButton.setMaximumHeight(22)
+        self.closeButton.clicked.connect(self.dismiss)
+        header.addWidget(self.closeButton)
+        layout.addLayout(header)
+        self.columnLayout = QHBoxLayout()
+        self.columnLayout.setSpacing(5)
+        layout.addLayout(self.columnLayout)
+
+        #live numbers are redrawn a few times a second rather than on every chunk
+        self.statsTimer = QTimer()
+        self.statsTimer.setInterval(250)
+        self.statsTimer.timeout.connect(self.updateStats)
+        self.hide()
+
+    def start(self, models):
+        self.clearColumns()
+        for model in models:
+            column = CompareColumn(model)
+            column.keep.connect(lambda column=column: self.merge.emit(column.text(), column.regen))
+            self.columnLayout.addWidget(column)
+            self.columns.append(column)
+        self.titleLabel.setText(f"comparing {len(models)} models")
+        self.statsTimer.start()
+        self.show()
+
+    def clearColumns(self):
+        for column in self.columns:
+            self.columnLayout.removeWidget(column)
+            column.deleteLater()
+        self.columns = []
+
+    def column(self, index):
+        return self.columns[index] if 0 <= index < len(self.columns) else None
+
+    def chunk(self, index, text):
+        column = self.column(index)
+        if column is not None:
+            column.chunk(text)
+
+    def firstToken(self, index, seconds):
+        column = self.column(index)
+        if column is not None:
+            column.setFirstToken(seconds)
+
+    def finish(self, index, timings):
+        column = self.column(index)
+        if column is None:
+            return
+        column.finish(timings)
+        if all(column.isDone() for column in self.columns):
+            self.statsTimer.stop()
+            fastest = min(self.columns, key=lambda column: column.doneAt - column.start)
+            self.titleLabel.setText(f"comparing {len(self.columns)} models, {fastest.model} finished first")
+
+    def updateStats(self):
+        for column in self.columns:
+            if not column.isDone():
+                column.updateStats()
+
+    def dismiss(self):
+        if not self.isVisible():
+            return
+        self.statsTimer.stop()
+        self.clearColumns()
+        self.hide()
+        self.dismissed.emit()
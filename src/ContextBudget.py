@@ -0,0 +1,116 @@
+import math
+import re
+import threading
+from functools import lru_cache
+
+from Backends import BackendSet
+
+
+#used when the backend can't say how long the model's context is
+defaultContext = 4096
+#chat template tokens around each message
+messageOverhead = 4
+#rough cost of one image, the real number depends on the vision model
+imageTokens = 768
+
+policies = ["pinnedSystem", "slidingWindow", "none"]
+
+
+#about 4 characters a token for english and code, but never fewer tokens than words
+@lru_cache(maxsize=8192)
+def estimateTokens(role, content, images=0):
+    words = len(re.findall(r"\S+", content))
+    return max(math.ceil(len(content) / 4), words) + messageOverhead + images * imageTokens
+
+
+def messageTokens(message):
+    return estimateTokens(message["role"], message["content"], len(message.get("images", ())))
+
+
+class ContextBudget:
+    """Fits chat history into the model's context window.
+
+    When a chat outgrows the window the oldest turns are dropped, down to lowWater of the budget rather than
+    just enough to fit, and the same starting turn is reused while it still fits. The messages sent then keep an
+    identical prefix from turn to turn, so ollama can reuse its cached prompt instead of evaluating it again.
+    """
+    def __init__(self, policy="pinnedSystem", numCtx=0, reserve=1024, lowWater=0.6, backends=None):
+        self.policy = policy if policy in policies else "pinnedSystem"
+        #0 asks the model for its context length
+        self.numCtx = numCtx
+        self.reserve = reserve
+        self.lowWater = lowWater
+        self.lengths = {}
+        self.backends = backends if backends is not None else BackendSet()
+        #index and message the kept turns start at, for each chat and model, workers fit on their own threads
+        self.anchors = {}
+        self.lock = threading.Lock()
+
+    #runs on the worker thread, the lookup is remembered per model
+    def contextLength(self, model):
+        if self.numCtx > 0:
+            return self.numCtx
+        if model not in self.lengths:
+            length = None
+            try:
+                length = self.backends.forModel(model).contextLength(model)
+            except Exception as e:
+                print("context budget: ", str(e))
+            self.lengths[model] = length or defaultContext
+        return self.lengths[model]
+
+    #a saved chat can be renamed or deleted while nothing is generating, its anchors go with it
+    def renameChat(self, oldName, newName):
+        with self.lock:
+            for chat, model in [key for key in self.anchors if key[0] == oldName]:
+                self.anchors[(newName, model)] = self.anchors.pop((chat, model))
+
+    def forgetChat(self, name):
+        with self.lock:
+            for key in [key for key in self.anchors if key[0] == name]:
+                del self.anchors[key]
+
+    #returns (messages to send, estimated tokens, context length, number of turns dropped)
+    def fit(self, model, history, chat=None):
+        limit = self.contextLength(model)
+        tokens = [messageTokens(message) for message in history]
+        total = sum(tokens)
+        if self.policy == "none" or total <= limit - self.reserve:
+            return history, total, limit, 0
+
+        budget = max(limit - self.reserve, 0)
+        pinned = 0
+        if self.policy == "pinnedSystem":
+            while pinned < len(history) - 1 and history[pinned]["role"] == "system":
+                pinned += 1
+        pinnedTokens = sum(tokens[:pinned])
+
+        #suffix sums so the cost of keeping history[i:] is a lookup
+        suffix = [0] * (len(history) + 1)
+        for i in range(len(history) - 1, -1, -1):
+            suffix[i] = suffix[i + 1] + tokens[i]
+
+        start = None
+        key = (chat, model)
+        with self.lock:
+            anchor = self.anchors.get(key) if chat is not None else None
+        #the same turn in the same place, earlier turns being edited moves the start again
+        if anchor is not None:
+            i, message = anchor
+            if pinned <= i < len(history) and history[i] == message and pinnedTokens + suffix[i] <= budget:
+                start = i
+        if start is None:
+            #cut deeper than needed so the next few turns fit without moving the start again
+            target = budget * self.lowWater
+            start = pinned
+            while start < len(history) - 1 and pinnedTokens + suffix[start] > target:
+                start += 1
+            #begin the window on a user turn
+            while start < len(history) - 1 and history[start]["role"] != "user":
+                start += 1
+            if chat is not None:
+                with self.lock:
+                    self.anchors[key] = (start, history[start])
+
+        kept = history[:pinned] + history[start:]
+        return kept, pinnedTokens + suffix[start], limit, start - pinned
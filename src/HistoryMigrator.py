@@ -0,0 +1,33 @@
+from PyQt5.QtCore import QObject, QThread, pyqtSignal, pyqtSlot, Qt
+
+
+class HistoryMigrator(QObject):
+    """Imports the old .txt history into the chat store on a background thread."""
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal(int)
+
+    start = pyqtSignal()
+
+    def __init__(self, store, delims):
+        super().__init__()
+        self.store = store
+        self.delims = store.legacyDelims(delims) if len(store.legacyPaths()) > 0 else delims
+        self.start.connect(self.run, Qt.QueuedConnection)
+
+        self.thread = QThread()
+        self.moveToThread(self.thread)
+        self.finished.connect(self.thread.quit)
+        self.thread.start()
+
+    @pyqtSlot()
+    def run(self):
+        paths = self.store.legacyPaths()
+        done = 0
+        for path in paths:
+            try:
+                self.store.importLegacyFile(path, self.delims)
+            except Exception as e:
+                print("history migrator: ", path, str(e))
+            done += 1
+            self.progress.emit(done, len(paths))
+        self.finished.emit(done)
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import threading
+import traceback
+from collections import deque
+
+from PyQt5.QtCore import QObject, pyqtSignal, Qt
+
+
+#write to a temp file next to the target then swap it in, so a crash never leaves half a file
+def atomicWrite(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tempPath = path.with_name(f".{path.name}.tmp")
+    with open(tempPath, "w", encoding="utf-8") as file:
+        file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tempPath, path)
+
+
+class IOExecutor(QObject):
+    """Runs persistence on one background thread so the GUI never waits on the disk.
+
+    Writes are keyed, a write for a key that is still queued replaces the queued content,
+    and content identical to the last write for that key is skipped.
+    """
+    completed = pyqtSignal(object, object)
+
+    def __init__(self):
+        super().__init__()
+        self.condition = threading.Condition()
+        self.jobs = deque()
+        self.pendingWrites = {}
+        #only touched on the executor thread
+        self.writtenHashes = {}
+        self.busy = False
+
+        self.written = 0
+        self.skipped = 0
+        self.coalesced = 0
+
+        self.completed.connect(self.deliver, Qt.QueuedConnection)
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    #content of None means the writer deletes, which always runs and resets the hash for the key
+    def write(self, key, content, writer):
+        with self.condition:
+            if key in self.pendingWrites:
+                self.coalesced += 1
+            else:
+                self.jobs.append(("write", key))
+            self.pendingWrites[key] = (content, writer)
+            self.condition.notify_all()
+
+    #run job on the executor thread, callback gets the result back on the GUI thread
+    def run(self, job, callback=None):
+        with self.condition:
+            self.jobs.append(("run", (job, callback)))
+            self.condition.notify_all()
+
+    #forget the last written content for a key, for writers that move data between keys
+    def forget(self, key):
+        self.writtenHashes.pop(key, None)
+
+    def loop(self):
+        while True:
+            with self.condition:
+                while len(self.jobs) == 0:
+                    self.condition.wait()
+                kind, item = self.jobs.popleft()
+                if kind == "write":
+                    content, writer = self.pendingWrites.pop(item)
+                self.busy = True
+            try:
+                if kind == "write":
+                    digest = None
+                    if content is not None:
+                        digest = hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+                    if digest is not None and self.writtenHashes.get(item) == digest:
+                        self.skipped += 1
+                    else:
+                        writer(content)
+                        self.writtenHashes[item] = digest
+                        self.written += 1
+                else:
+                    job, callback = item
+                    try:
+                        result = job()
+                    except Exception as e:
+                        #the callback gets the exception so the GUI isn't left waiting
+                        if callback is None:
+                            raise
+                        result = e
+                    if callback is not None:
+                        self.completed.emit(callback, result)
+            except Exception:
+                print("io executor: An error occurred")
+                traceback.print_exc()
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    def deliver(self, callback, result):
+        callback(result)
+
+    #block until everything queued so far is on disk, used before exiting
+    def flush(self, timeout=10):
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.jobs) == 0 and not self.busy, timeout)
+
+    def stats(self):
+        with self.condition:
+            return {"queued": len(self.jobs), "written": self.written, "skipped": self.skipped, "coalesced": self.coalesced}
@@ -0,0 +1,114 @@
+import base64
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from PyQt5.QtCore import QBuffer, QByteArray, QIODevice, Qt
+from PyQt5.QtGui import QImage
+
+
+#longest side each vision model works at, anything bigger is scaled down by the model anyway
+defaultMaxSides = {"default": 1344, "llava": 672, "bakllava": 672, "moondream": 378, "gemma3": 896,
+                   "llama3.2-vision": 1120, "qwen2.5vl": 1792, "minicpm-v": 1344}
+
+
+#image paths mentioned in a turn, cached as the same turns are scanned every prompt
+@lru_cache(maxsize=4096)
+def imagePaths(content):
+    return tuple(re.findall(r"[A-Za-z]:[\\/][^:]+.(?:png|jpg|jpeg|webp)", content, flags=re.IGNORECASE))
+
+
+class ImageCache:
+    """Images ready to send, downscaled for the model and base64 encoded.
+
+    Keyed by path, mtime, size and the target resolution, so an edited image is encoded again. Payloads are
+    kept in memory and, given a cacheDir, on disk, so an image already sent costs a stat rather than a read
+    and encode each turn.
+    """
+    def __init__(self, cacheDir, maxSides=None, memoryBytes=64 << 20, diskBytes=256 << 20):
+        self.cacheDir = cacheDir
+        self.maxSides = {**defaultMaxSides, **(maxSides or {})}
+        self.memoryBytes = memoryBytes
+        self.diskBytes = diskBytes
+        self.memory = OrderedDict()
+        self.memorySize = 0
+        self.lock = threading.Lock()
+
+    def maxSide(self, model):
+        name = model.split(":")[0].split("/")[-1].lower()
+        return self.maxSides.get(name, self.maxSides["default"])
+
+    #base64 payload for the image, None if the file doesn't exist
+    def payload(self, path, model):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        maxSide = self.maxSide(model)
+        key = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{maxSide}"
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+        if data is None:
+            diskPath = None
+            if self.cacheDir is not None:
+                digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+                diskPath = self.cacheDir / f"{digest}.bin"
+            if diskPath is not None and diskPath.is_file():
+                data = base64.b64encode(diskPath.read_bytes()).decode("ascii")
+            else:
+                encoded = self.encode(path, maxSide)
+                if diskPath is not None:
+                    self.writeDisk(diskPath, encoded)
+                data = base64.b64encode(encoded).decode("ascii")
+            self.remember(key, data)
+        return data
+
+    #the file as it is if it's already small enough, otherwise scaled and re-encoded
+    def encode(self, path, maxSide):
+        image = QImage(path)
+        if image.isNull():
+            raise ValueError(f"can't read image - {path}")
+        if max(image.width(), image.height()) <= maxSide:
+            with open(path, "rb") as file:
+                return file.read()
+        image = image.scaled(maxSide, maxSide, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        data = QByteArray()
+        buffer = QBuffer(data)
+        buffer.open(QIODevice.WriteOnly)
+        #jpeg unless there is transparency to keep
+        if image.hasAlphaChannel():
+            image.save(buffer, "PNG")
+        else:
+            image.save(buffer, "JPEG", 90)
+        buffer.close()
+        return bytes(data)
+
+    def remember(self, key, data):
+        with self.lock:
+            self.memory[key] = data
+            self.memorySize += len(data)
+            while self.memorySize > self.memoryBytes and len(self.memory) > 1:
+                _, old = self.memory.popitem(last=False)
+                self.memorySize -= len(old)
+
+    #oldest files go first once the folder is over diskBytes
+    def writeDisk(self, diskPath, encoded):
+        try:
+            self.cacheDir.mkdir(parents=True, exist_ok=True)
+            tempPath = diskPath.with_suffix(".tmp")
+            tempPath.write_bytes(encoded)
+            os.replace(tempPath, diskPath)
+            files = sorted(self.cacheDir.glob("*.bin"), key=lambda file: file.stat().st_mtime)
+            total = sum(file.stat().st_size for file in files)
+            for file in files[:-1]:
+                if total <= self.diskBytes:
+                    break
+                total -= file.stat().st_size
+                file.unlink(missing_ok=True)
+        except OSError as e:
+            print("image cache: ", str(e))
@@ -0,0 +1,96 @@
+import json
+import math
+import os
+import time
+
+
+#numbers summarised per model, and whether a low value is the bad end
+summaryFields = {"ttft": False, "warmTtft": False, "coldTtft": False, "tokensPerSecond": True, "promptTokensPerSecond": True, "loadDuration": False,
+                 "renderLag": False, "stopLatency": False}
+
+
+#nearest rank on already sorted values
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+
+#entries from oldest to newest across the rotated files, since is a unix time
+def readEntries(path, backups=3, since=None):
+    entries = []
+    for i in range(backups, -1, -1):
+        filePath = path if i == 0 else path.with_name(f"{path.name}.{i}")
+        if not filePath.is_file():
+            continue
+        with open(filePath, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if since is None or entry.get("time", 0) >= since:
+                    entries.append(entry)
+    return entries
+
+
+#warm and cold are the time to first token of responses whose model was or wasn't already loaded
+def fieldValue(entry, field):
+    if field in ("warmTtft", "coldTtft"):
+        return entry.get("ttft") if entry.get("warm") is (field == "warmTtft") else None
+    return entry.get(field)
+
+
+#p50 and the bad tail of each field per model, stopped responses only count towards ttft and stop latency
+def summarise(entries):
+    models = {}
+    for entry in entries:
+        models.setdefault(entry.get("model", ""), []).append(entry)
+    summary = {}
+    for model, modelEntries in sorted(models.items()):
+        row = {"count": len(modelEntries)}
+        for field, lowIsBad in summaryFields.items():
+            values = sorted(fieldValue(entry, field) for entry in modelEntries if fieldValue(entry, field) is not None
+                            and (field in ("ttft", "warmTtft", "coldTtft", "stopLatency") or not entry.get("stopped")))
+            row[field] = (percentile(values, 50), percentile(values, 10 if lowIsBad else 90))
+        summary[model] = row
+    return summary
+
+
+class MetricsLog:
+    """One JSON line per response, appended on the executor thread.
+
+    The file is rotated once it passes maxBytes, keeping backups older files as metrics.jsonl.1, .2 and so on.
+    """
+    def __init__(self, path, executor, maxBytes=1 << 20, backups=3):
+        self.path = path
+        self.executor = executor
+        self.maxBytes = maxBytes
+        self.backups = backups
+
+    def record(self, entry):
+        line = json.dumps(entry) + "\n"
+        self.executor.run(lambda: self.append(line))
+
+    #runs on the executor thread
+    def append(self, line):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.path.is_file() and self.path.stat().st_size + len(line) > self.maxBytes:
+            self.rotate()
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(line)
+
+    def rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            older = self.path.with_name(f"{self.path.name}.{i}")
+            if older.is_file():
+                os.replace(older, self.path.with_name(f"{self.path.name}.{i + 1}"))
+        if self.backups > 0:
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+
+    #summary of the last window seconds, or everything, handed to callback on the GUI thread
+    def summary(self, callback, window=None):
+        since = None if window is None else time.time() - window
+        self.executor.run(lambda: summarise(readEntries(self.path, self.backups, since)), callback)
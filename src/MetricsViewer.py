@@ -0,0 +1,65 @@
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QComboBox, QLabel, QTableWidget, QTableWidgetItem, QHeaderView
+
+from MetricsLog import summaryFields
+
+
+class MetricsViewer(QWidget):
+    """Percentiles per model from the metrics log, over a chosen stretch of time."""
+    windows = {"last hour": 3600, "last day": 86400, "last week": 7 * 86400, "everything": None}
+    headings = {"ttft": "first token s", "warmTtft": "warm s", "coldTtft": "cold s", "tokensPerSecond": "tok/s", "promptTokensPerSecond": "prompt tok/s",
+                "loadDuration": "load s", "renderLag": "render lag ms", "stopLatency": "stop ms"}
+
+    def __init__(self, metricsLog):
+        super().__init__()
+        self.metricsLog = metricsLog
+        self.setWindowTitle("Generation Metrics")
+        self.resize(640, 240)
+
+        layout = QVBoxLayout(self)
+        controls = QHBoxLayout()
+        self.windowSelect = QComboBox()
+        self.windowSelect.addItems(list(self.windows))
+        self.windowSelect.setCurrentText("last day")
+        self.windowSelect.currentTextChanged.connect(self.refresh)
+        controls.addWidget(self.windowSelect)
+        controls.addStretch(1)
+        self.noteLabel = QLabel()
+        controls.addWidget(self.noteLabel)
+        layout.addLayout(controls)
+
+        self.table = QTableWidget(0, 2 + len(summaryFields))
+        self.table.setHorizontalHeaderLabels(["model", "responses"] + [self.headings[field] for field in summaryFields])
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.table.verticalHeader().hide()
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        layout.addWidget(self.table)
+
+    def toggle(self):
+        if self.isVisible():
+            self.hide()
+        else:
+            self.refresh()
+            self.show()
+
+    def refresh(self):
+        self.metricsLog.summary(self.showSummary, self.windows[self.windowSelect.currentText()])
+
+    #each cell is the median with the slow end in brackets, p90 for times and p10 for speeds
+    def showSummary(self, summary):
+        if isinstance(summary, Exception):
+            self.noteLabel.setText(f"can't read metrics - {summary}")
+            return
+        self.noteLabel.setText("median (slow 10%)")
+        self.table.setRowCount(len(summary))
+        for row, (model, values) in enumerate(summary.items()):
+            cells = [model, str(values["count"])]
+            for field in summaryFields:
+                median, tail = values[field]
+                scale = 1000 if field in ("renderLag", "stopLatency") else 1
+                cells.append("-" if median is None else f"{median * scale:.2f} ({tail * scale:.2f})")
+            for column, text in enumerate(cells):
+                item = QTableWidgetItem(text)
+                if column > 0:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.table.setItem(row, column, item)
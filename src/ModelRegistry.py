@@ -0,0 +1,116 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal, Qt
+
+from Backends import BackendSet
+from IOExecutor import atomicWrite
+
+
+#where ollama keeps one manifest file per pulled model
+def manifestsPath():
+    models = os.environ.get("OLLAMA_MODELS")
+    return (Path(models) if models else Path.home() / ".ollama/models") / "manifests"
+
+
+class ModelRegistry(QObject):
+    """The installed models, cached on disk so the window never waits on the server for them.
+
+    The list is refreshed in the background, and while polling, the manifests directory is checked
+    so a pull or delete shows up without asking the server every time. A pool of ollama servers is
+    asked on a slower timer as well, since only the local server's manifests can be watched.
+    """
+    modelsChanged = pyqtSignal(list)
+    fetched = pyqtSignal(object, object)
+
+    def __init__(self, cachePath, backends=None, pollInterval=5000, poolInterval=45000):
+        super().__init__()
+        self.cachePath = cachePath
+        self.backends = backends if backends is not None else BackendSet()
+        self.manifests = manifestsPath()
+        #the cache is written through this once the app has one, rather than on the GUI thread
+        self.executor = None
+        self.models = []
+        try:
+            if self.cachePath.is_file():
+                with open(self.cachePath, "r", encoding="utf-8") as file:
+                    self.models = json.load(file)
+        except Exception as e:
+            print("model registry: ", str(e))
+
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.signature = None
+        self.fetched.connect(self.updateModels, Qt.QueuedConnection)
+
+        self.pollTimer = QTimer(self)
+        self.pollTimer.setInterval(pollInterval)
+        self.pollTimer.timeout.connect(lambda: self.refresh(False))
+        self.poolTimer = QTimer(self)
+        self.poolTimer.setInterval(poolInterval)
+        self.poolTimer.timeout.connect(lambda: self.refresh() if self.backends.isPooled() else None)
+
+    def startPolling(self):
+        self.refresh()
+        self.pollTimer.start()
+        self.poolTimer.start()
+
+    def stopPolling(self):
+        self.pollTimer.stop()
+        self.poolTimer.stop()
+
+    #force asks the server even if the manifests look unchanged
+    def refresh(self, force=True):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self.fetch, args=(force,), daemon=True).start()
+
+    #cheap fingerprint of the manifests, changes whenever a model is pulled or removed
+    def manifestSignature(self):
+        if not self.manifests.is_dir():
+            return None
+        signature = []
+        for root, dirs, files in os.walk(self.manifests):
+            for name in files:
+                stat = os.stat(os.path.join(root, name))
+                signature.append((root, name, stat.st_mtime_ns, stat.st_size))
+        return tuple(sorted(signature))
+
+    #runs on a background thread, the manifests only cover ollama so other backends are asked when forced
+    def fetch(self, force):
+        models = None
+        signature = self.signature
+        try:
+            signature = self.manifestSignature()
+            if force or signature != self.signature:
+                #None if no backend answered, the cached list is kept
+                models = self.backends.listModels()
+        except Exception as e:
+            print("model registry: ", str(e))
+        finally:
+            with self.lock:
+                self.refreshing = False
+        self.fetched.emit(models, signature)
+
+    def updateModels(self, models, signature):
+        if models is None:
+            return
+        self.signature = signature
+        if models == self.models:
+            return
+        self.models = models
+        if self.executor is not None:
+            self.executor.write(("models", str(self.cachePath)), json.dumps(models), self.writeCache)
+        else:
+            self.writeCache(json.dumps(models))
+        self.modelsChanged.emit(models)
+
+    def writeCache(self, content):
+        try:
+            atomicWrite(self.cachePath, content)
+        except Exception as e:
+            print("model registry: ", str(e))
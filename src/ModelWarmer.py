@@ -0,0 +1,132 @@
+import http.client
+import json
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+
+#keep_alive as ollama takes it, "10m", "30s", "1h", a number of seconds, or negative to keep forever
+def keepAliveSeconds(keepAlive):
+    text = str(keepAlive).strip()
+    units = {"s": 1, "m": 60, "h": 3600}
+    try:
+        if text[-1:] in units:
+            seconds = float(text[:-1]) * units[text[-1]]
+        else:
+            seconds = float(text)
+    except ValueError:
+        return 300
+    return float("inf") if seconds < 0 else seconds
+
+
+class ModelWarmer(QObject):
+    """Loads a model into memory before the first prompt so the first token isn't waiting on the load.
+
+    Only one load is in flight, a new model cancels it, and a model that is already loading or
+    was recently seen loaded isn't asked for again.
+    """
+    warmed = pyqtSignal(str, float)
+
+    def __init__(self, supervisor, keepAlive="10m", enabled=True, recheckAfter=30, backends=None):
+        super().__init__()
+        self.supervisor = supervisor
+        #models served by other backends aren't warmed
+        self.backends = backends
+        self.keepAlive = keepAlive
+        self.enabled = enabled
+        #how long a model seen loaded is trusted to still be loaded without asking again
+        self.recheckAfter = min(recheckAfter, keepAliveSeconds(keepAlive))
+        self.lock = threading.Lock()
+        self.current = None
+        self.pending = None
+        self.loadedAt = {}
+
+        self.supervisor.ready.connect(self.warmPending)
+
+    def warm(self, model):
+        if not self.enabled or not model:
+            return
+        if self.backends is not None and not self.backends.isOllama(model):
+            return
+        with self.lock:
+            if (self.current is not None and self.current["model"] == model) or self.isWarm(model):
+                return
+        self.cancel()
+        #only a model on the server being started waits for it
+        serverBound = self.backends is None or self.backends.usesServer(model, self.supervisor.url)
+        if serverBound and not self.supervisor.isReady():
+            self.pending = model
+            return
+        #with a pool of ollama servers, the one the prompt is likely to go to
+        url = urlsplit(self.supervisor.url if self.backends is None else self.backends.ollamaUrl(model))
+        job = {"model": model, "connection": http.client.HTTPConnection(url.hostname, url.port, timeout=600), "cancelled": False}
+        with self.lock:
+            self.current = job
+        threading.Thread(target=self.load, args=(job,), daemon=True).start()
+
+    def warmPending(self):
+        model = self.pending
+        self.pending = None
+        self.warm(model)
+
+    def isWarm(self, model):
+        return time.monotonic() - self.loadedAt.get(model, float("-inf")) < self.recheckAfter
+
+    #drop anything waiting and abort the load in flight
+    def cancel(self):
+        self.pending = None
+        with self.lock:
+            job = self.current
+            self.current = None
+        if job is None:
+            return
+        job["cancelled"] = True
+        connection = job["connection"]
+        try:
+            #shutdown wakes the thread blocked reading the response, close alone doesn't
+            if connection.sock is not None:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        connection.close()
+
+    def request(self, connection, method, path, body=None):
+        connection.request(method, path, body=None if body is None else json.dumps(body),
+                           headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"{path} {response.status}: {data[:200]}")
+        return json.loads(data)
+
+    #runs on its own thread
+    def load(self, job):
+        model = job["model"]
+        connection = job["connection"]
+        try:
+            running = self.request(connection, "GET", "/api/ps")
+            alreadyLoaded = any(entry.get("model") == model or entry.get("name") == model for entry in running.get("models", []))
+            loadTime = 0.0
+            if not alreadyLoaded and not job["cancelled"]:
+                #an empty message list only loads the model
+                result = self.request(connection, "POST", "/api/chat",
+                                      {"model": model, "messages": [], "keep_alive": self.keepAlive, "stream": False})
+                loadTime = result.get("load_duration", 0) / 1e9
+            if not job["cancelled"]:
+                self.loadedAt[model] = time.monotonic()
+                self.warmed.emit(model, loadTime)
+        except Exception as e:
+            if not job["cancelled"]:
+                print("model warmer: ", model, str(e))
+        finally:
+            connection.close()
+            with self.lock:
+                if self.current is job:
+                    self.current = None
+
+    #a prompt leaves its model loaded too, whether warming paid off is in each response's metrics entry
+    def promptLoaded(self, model):
+        self.loadedAt[model] = time.monotonic()
@@ -0,0 +1,166 @@
+import os
+import subprocess
+import threading
+import time
+import urllib.request
+from collections import deque
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+
+CREATE_NO_WINDOW = 0x08000000
+
+
+#OLLAMA_HOST can be "host:port", "0.0.0.0" or a full url
+def hostUrl(host):
+    host = (host or "127.0.0.1:11434").strip()
+    if "://" not in host:
+        host = f"http://{host}"
+    scheme, rest = host.split("://", 1)
+    rest = rest.rstrip("/")
+    if rest.startswith("0.0.0.0"):
+        rest = "127.0.0.1" + rest[len("0.0.0.0"):]
+    if ":" not in rest.split("/")[0]:
+        rest = rest + ":11434"
+    return f"{scheme}://{rest}"
+
+
+class OllamaSupervisor(QObject):
+    """Starts the ollama server, or attaches to one that is already running, and keeps it up.
+
+    Readiness is probed on /api/version with backoff. A server started here is restarted if it exits,
+    an attached one is probed periodically and started here if it goes away.
+    """
+    stateChanged = pyqtSignal(str)
+    ready = pyqtSignal()
+
+    def __init__(self, command=("ollama", "serve"), env=None, logPath=None, checkInterval=5.0, startTimeout=60.0):
+        super().__init__()
+        self.command = list(command)
+        #only non-empty values are set, anything else is left to the inherited environment
+        self.env = {**os.environ, **{key: str(value) for key, value in (env or {}).items() if str(value) != ""}}
+        self.url = hostUrl(self.env.get("OLLAMA_HOST"))
+        self.logPath = logPath
+        self.checkInterval = checkInterval
+        self.startTimeout = startTimeout
+
+        self.state = "stopped"
+        self.process = None
+        self.owned = False
+        self.restarts = deque()
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.supervise, daemon=True)
+        self.thread.start()
+
+    #stops supervising, and the server too if it was started here and terminate is set
+    def stop(self, terminate=True, timeout=5):
+        self.stopEvent.set()
+        if terminate and self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.setState("stopped")
+
+    def isReady(self):
+        return self.state == "ready"
+
+    def setState(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        self.stateChanged.emit(state)
+        if state == "ready":
+            self.ready.emit()
+
+    def probe(self, timeout=1.0):
+        try:
+            with urllib.request.urlopen(f"{self.url}/api/version", timeout=timeout) as response:
+                return response.status == 200
+        except Exception:
+            return False
+
+    def spawn(self):
+        log = subprocess.DEVNULL
+        if self.logPath is not None:
+            self.logPath.parent.mkdir(parents=True, exist_ok=True)
+            log = open(self.logPath, "ab")
+        try:
+            self.process = subprocess.Popen(self.command, env=self.env, stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                                            creationflags=CREATE_NO_WINDOW if os.name == "nt" else 0)
+        finally:
+            if log is not subprocess.DEVNULL:
+                log.close()
+        self.owned = True
+
+    #probe with doubling delays until the server answers, gives up early if our process exits
+    def waitUntilUp(self):
+        delay = 0.05
+        deadline = time.monotonic() + self.startTimeout
+        while not self.stopEvent.is_set() and time.monotonic() < deadline:
+            if self.probe():
+                return True
+            if self.owned and self.process.poll() is not None:
+                return False
+            self.stopEvent.wait(delay)
+            delay = min(delay * 2, 1.0)
+        return False
+
+    #returns when the server has gone away or supervision is stopped
+    def monitor(self):
+        while not self.stopEvent.is_set():
+            if self.owned:
+                try:
+                    self.process.wait(self.checkInterval)
+                    return
+                except subprocess.TimeoutExpired:
+                    pass
+            else:
+                self.stopEvent.wait(self.checkInterval)
+                if not self.stopEvent.is_set() and not self.probe():
+                    return
+
+    #backoff before a restart grows with the number of restarts in the last minute
+    def restartDelay(self):
+        now = time.monotonic()
+        self.restarts.append(now)
+        while self.restarts[0] < now - 60:
+            self.restarts.popleft()
+        return min(30.0, 0.5 * 2 ** (len(self.restarts) - 1))
+
+    #runs on the supervisor thread
+    def supervise(self):
+        while not self.stopEvent.is_set():
+            self.setState("starting")
+            try:
+                if not self.probe():
+                    self.spawn()
+                else:
+                    self.owned = False
+                    self.process = None
+                up = self.waitUntilUp()
+            except Exception as e:
+                print("ollama supervisor: ", str(e))
+                up = False
+            if self.stopEvent.is_set():
+                break
+            if up:
+                self.setState("ready")
+                self.monitor()
+                if self.stopEvent.is_set():
+                    break
+                self.setState("crashed")
+            else:
+                if self.owned and self.process.poll() is None:
+                    self.process.kill()
+                self.setState("failed")
+            self.stopEvent.wait(self.restartDelay())
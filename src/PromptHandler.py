@@ -1,61 +1,379 @@
-import re
+import time
+from collections import deque
 
-from PyQt5.Qt import Qt
-from PyQt5.QtCore import pyqtSignal, QThreadPool, QThread, QObject
+from PyQt5.QtCore import Qt, pyqtSignal, QThread, QObject, QTimer
 
+import TranscriptParser
+from Backends import BackendSet
+from ContextBudget import ContextBudget
+from ImageCache import ImageCache
 from PromptWorker import PromptWorker
 
 
+class GenerationJob:
+    """One prompt being answered for one chat."""
+    def __init__(self, requestId, chat, model, turns, delims, sysPrompt):
+        self.requestId = requestId
+        self.chat = chat
+        self.model = model
+        self.turns = turns
+        self.delims = delims
+        self.sysPrompt = sysPrompt
+        self.worker = None
+        #set for one of the models answering a compare, its output goes to that column
+        self.column = None
+        self.timings = {}
+        self.startedAt = None
+        #whether the model was known to be loaded when the prompt started, None if nothing was watching
+        self.warm = None
+        self.ttft = None
+        self.stopped = False
+        #from asking the worker to stop to hearing it has, the connection is closed by then
+        self.stopAskedAt = None
+        self.stopLatency = None
+        self.imageBytes = None
+        self.imageBytesSaved = None
+        #seconds from a batch of output reaching the buffer to it being on screen
+        self.renderLags = []
+        #while attached output goes to the display, otherwise it builds up in text
+        self.attached = True
+        self.text = ""
+        #set when the chat is deleted, so its output goes nowhere
+        self.discarded = False
+
+    #the same edits ChatDisplay.chunk makes, for a chat that isn't on screen
+    def apply(self, chunk):
+        if chunk == "regen12":
+            transcript = TranscriptParser.parse(self.text, self.delims)
+            if len(transcript) >= 2:
+                self.text = self.text[:transcript[-2].span[0]][:-2]
+        elif chunk == "assis12":
+            self.text += f"\n\n{self.delims["assistant"]} "
+        elif chunk == "usr12":
+            self.text += f"\n\n{self.delims["user"]} "
+        else:
+            self.text += chunk
+
+
 class PromptHandler(QObject):
-    finished = pyqtSignal()
+    """Runs prompts as jobs keyed by chat on a small pool of workers.
+
+    Output for the chat on screen is emitted as progress, output for any other chat is kept with its job,
+    so switching chats doesn't stop a response.
+    """
     progress = pyqtSignal(str)
-    reGen = pyqtSignal()
     updatePrevModel = pyqtSignal(str)
+    waiting = pyqtSignal(bool)
+    firstToken = pyqtSignal(str, float)
+    usage = pyqtSignal(int, int, int)
+    #chat name and "queued", "generating", "done" or "" once there is nothing to show
+    chatState = pyqtSignal(str, str)
+    #a chat that wasn't on screen finished, with its full text
+    finishedOffscreen = pyqtSignal(str, str)
+    #output, time to first token, and ollama's timings at the end, for each compare column
+    compareProgress = pyqtSignal(int, str)
+    compareFirstToken = pyqtSignal(int, float)
+    compareFinished = pyqtSignal(int, object)
+    #one entry per response, for the metrics log
+    metrics = pyqtSignal(object)
 
-    def __init__(self):
+    def __init__(self, supervisor=None, maxStreams=1):
         super().__init__()
-        self.prompting = False
-
-        self.threadpool = QThreadPool()
-        self.thread = QThread()
-        self.worker = PromptWorker()
-        self.worker.moveToThread(self.thread)
-        self.worker.finished.connect(self.endPrompt, Qt.QueuedConnection)
-        self.worker.progress.connect(self.chunk, Qt.QueuedConnection)
-        self.worker.reGen.connect(self.deleteForRegen, Qt.QueuedConnection)
-        self.thread.start()
-
-    def endPrompt(self):
-        self.prompting = False
-    def chunk(self, chunk):
-        self.progress.emit(f"{chunk}")
-    def deleteForRegen(self):
-        self.reGen.emit()
-    def endGeneration(self):
-        self.worker.endGeneration()
-
-    def splitText(self, text, delims):
+        #a prompt made while the server is starting waits in the queue rather than failing
+        self.supervisor = supervisor
+        if self.supervisor is not None:
+            self.supervisor.ready.connect(self.schedule)
+        #more streams than the server runs in parallel would only wait on the server
+        self.maxStreams = max(1, maxStreams)
+
+        #shared by every worker
+        self.keepAlive = None
+        self.backends = BackendSet()
+        self.budget = ContextBudget()
+        self.images = ImageCache(None)
+        #set to the model warmer's, so each response's time to first token can be told apart warm or cold
+        self.isWarm = lambda model: None
+
+        self.nextId = 0
+        self.jobs = {}
+        self.chats = {}
+        self.queue = deque()
+        self.compareJobs = []
+        self.workers = []
+        self.idle = []
+
+        #worker output is drained at most once per frame unless the buffer fills up
+        self.flushInterval = 16
+        self.lastFlush = 0
+        self.flushTimer = QTimer()
+        self.flushTimer.setSingleShot(True)
+        self.flushTimer.timeout.connect(self.flush)
+
+    def addWorker(self):
+        thread = QThread()
+        worker = PromptWorker()
+        worker.keepAlive = self.keepAlive
+        worker.backends = self.backends
+        worker.budget = self.budget
+        worker.images = self.images
+        worker.moveToThread(thread)
+        worker.finished.connect(self.workerFinished, Qt.QueuedConnection)
+        worker.ready.connect(self.bufferReady, Qt.QueuedConnection)
+        worker.firstToken.connect(self.workerFirstToken, Qt.QueuedConnection)
+        worker.usage.connect(self.usage, Qt.QueuedConnection)
+        worker.timings.connect(self.workerTimings, Qt.QueuedConnection)
+        worker.imageBytes.connect(self.workerImageBytes, Qt.QueuedConnection)
+        thread.start()
+        self.workers.append((worker, thread))
+        return worker
+
+    def isGenerating(self, chat):
+        return chat in self.chats
+
+    #turn text box into formatted prompt, and generate it
+    def prompt(self, chat, transcript, delims, model, enableSysPrompt, sysPrompt):
         try:
-            return re.split(f"({delims["user"]}|{delims["assistant"]}|{delims["system"]})", text, flags=re.IGNORECASE)[1:]
+            #prompting again in a chat that is generating stops it
+            if chat in self.chats:
+                self.stopChat(chat)
+                return
+            if len(transcript) < 1:
+                return
+            self.nextId += 1
+            job = GenerationJob(self.nextId, chat, model, transcript.turns, delims, sysPrompt if enableSysPrompt else "")
+            self.jobs[job.requestId] = job
+            self.chats[chat] = job
+            self.queue.append(job)
+            self.chatState.emit(chat, "queued")
+            self.schedule()
         except Exception as e:
-            self.progress.emit(f"splitText: {str(e)}")
+            self.progress.emit(f"prompt main: {str(e)}")
 
-    #turn text box into formatted prompt, and generate it
-    def prompt(self, prompt, delims, model, enableSysPrompt, sysPrompt):
-        if self.prompting:
-            self.worker.endGeneration()
-            return
-        self.prompting = True
+    #the same prompt to each model at once, one column each
+    def compare(self, chat, transcript, delims, models, enableSysPrompt, sysPrompt):
         try:
-            prompt = self.splitText(prompt, delims)
-            if len(prompt) < 2:
-                self.prompting = False
+            self.stopCompare(True)
+            if len(transcript) < 1:
                 return
-            if enableSysPrompt:
-                self.worker.startPrompt.emit(model, prompt, delims, sysPrompt)
+            for column, model in enumerate(models):
+                self.nextId += 1
+                job = GenerationJob(self.nextId, chat, model, transcript.turns, delims, sysPrompt if enableSysPrompt else "")
+                job.column = column
+                self.jobs[job.requestId] = job
+                self.compareJobs.append(job)
+                self.queue.append(job)
+            self.schedule()
+        except Exception as e:
+            self.progress.emit(f"compare: {str(e)}")
+
+    def isComparing(self):
+        return len(self.compareJobs) > 0
+
+    #discard drops the columns' output too, for when they are being thrown away
+    def stopCompare(self, discard=False):
+        for job in list(self.compareJobs):
+            job.discarded = job.discarded or discard
+            job.stopped = True
+            if job.worker is None:
+                self.queue.remove(job)
+                self.endJob(job)
             else:
-                self.worker.startPrompt.emit(model, prompt, delims, "")
+                self.askToStop(job)
 
-            self.updatePrevModel.emit(model)
-        except Exception as e:
-            self.progress.emit("prompt main: ", str(e))
\ No newline at end of file
+    #start queued jobs on free workers
+    def schedule(self):
+        waiting = False
+        for job in list(self.queue):
+            #only prompts for the server being started wait for it, other backends and pool hosts go ahead
+            if self.needsServer(job):
+                waiting = True
+                continue
+            #a compare runs every model at once, on top of the usual streams, which stay within maxStreams
+            compare = job.column is not None
+            if self.running(compare) >= (len(self.compareJobs) if compare else self.maxStreams):
+                continue
+            worker = self.idle.pop() if len(self.idle) > 0 else self.addWorker()
+            self.queue.remove(job)
+            job.worker = worker
+            job.startedAt = time.time()
+            job.warm = self.isWarm(job.model)
+            #the worker is idle so nothing can race this
+            worker.stopGeneration = False
+            worker.startPrompt.emit(job.requestId, job.chat, job.model, job.turns, job.delims, job.sysPrompt)
+            if job.column is None:
+                self.chatState.emit(job.chat, "generating")
+                self.updatePrevModel.emit(job.model)
+        self.waiting.emit(waiting)
+
+    def needsServer(self, job):
+        return (self.supervisor is not None and not self.supervisor.isReady()
+                and self.backends.usesServer(job.model, self.supervisor.url))
+
+    #jobs on a worker, either compare columns or ordinary prompts
+    def running(self, compare):
+        return sum(1 for job in self.jobs.values() if job.worker is not None and (job.column is not None) == compare)
+
+    def stopChat(self, chat):
+        job = self.chats.get(chat)
+        if job is None:
+            return
+        if job.worker is None:
+            self.queue.remove(job)
+            self.endJob(job)
+            self.schedule()
+        else:
+            job.stopped = True
+            self.askToStop(job)
+
+    def askToStop(self, job):
+        if job.stopAskedAt is None:
+            job.stopAskedAt = time.perf_counter()
+        job.worker.endGeneration()
+
+    def discardChat(self, chat):
+        job = self.chats.get(chat)
+        if job is not None:
+            job.discarded = True
+            self.stopChat(chat)
+        self.budget.forgetChat(chat)
+
+    def stopAll(self):
+        for chat in list(self.chats):
+            self.stopChat(chat)
+
+    def workerFinished(self, requestId):
+        worker = self.sender()
+        self.flush(worker)
+        job = self.jobs.get(requestId)
+        if job is not None:
+            if job.stopAskedAt is not None:
+                job.stopLatency = round(time.perf_counter() - job.stopAskedAt, 4)
+            self.endJob(job)
+        self.idle.append(worker)
+        self.schedule()
+
+    def workerFirstToken(self, requestId, model, seconds):
+        self.firstToken.emit(model, seconds)
+        job = self.jobs.get(requestId)
+        if job is not None:
+            job.ttft = seconds
+        if job is not None and job.column is not None and not job.discarded:
+            self.compareFirstToken.emit(job.column, seconds)
+
+    def workerTimings(self, requestId, timings):
+        job = self.jobs.get(requestId)
+        if job is not None:
+            job.timings = timings
+
+    def workerImageBytes(self, requestId, sent, saved):
+        job = self.jobs.get(requestId)
+        if job is not None:
+            job.imageBytes = sent
+            job.imageBytesSaved = saved
+
+    def endJob(self, job):
+        self.jobs.pop(job.requestId, None)
+        if job.startedAt is not None:
+            self.metrics.emit(self.jobMetrics(job))
+        if job.column is not None:
+            self.compareJobs.remove(job)
+            if not job.discarded:
+                self.compareFinished.emit(job.column, job.timings)
+            return
+        if self.chats.get(job.chat) is job:
+            del self.chats[job.chat]
+        if job.attached or job.discarded:
+            self.chatState.emit(job.chat, "")
+        else:
+            self.chatState.emit(job.chat, "done")
+            self.finishedOffscreen.emit(job.chat, job.text)
+
+    #ollama's timings with what was measured here, durations in seconds
+    def jobMetrics(self, job):
+        def seconds(key):
+            value = job.timings.get(key)
+            return value / 1e9 if value is not None else None
+        def rate(count, duration):
+            return round(count / duration, 2) if count and duration else None
+        lags = sorted(job.renderLags)
+        evalDuration, promptDuration = seconds("eval_duration"), seconds("prompt_eval_duration")
+        return {"time": round(job.startedAt, 3), "model": job.model, "compare": job.column is not None,
+                "stopped": job.stopped, "ttft": round(job.ttft, 4) if job.ttft is not None else None, "warm": job.warm,
+                "evalCount": job.timings.get("eval_count"), "evalDuration": evalDuration,
+                "promptEvalCount": job.timings.get("prompt_eval_count"), "promptEvalDuration": promptDuration,
+                "loadDuration": seconds("load_duration"), "totalDuration": seconds("total_duration"),
+                "tokensPerSecond": rate(job.timings.get("eval_count"), evalDuration),
+                "promptTokensPerSecond": rate(job.timings.get("prompt_eval_count"), promptDuration),
+                "renderLag": lags[len(lags) // 2] if lags else None, "maxRenderLag": lags[-1] if lags else None,
+                "stopLatency": job.stopLatency, "imageBytes": job.imageBytes, "imageBytesSaved": job.imageBytesSaved}
+
+    #the display is switching away from chat, getText reads what it is showing
+    def detach(self, chat, getText):
+        job = self.chats.get(chat)
+        if job is None or not job.attached:
+            return
+        #anything already streamed belongs on the display before it is captured
+        if job.worker is not None:
+            self.flush(job.worker)
+        job.text = getText()
+        job.attached = False
+
+    #the display is switching to chat, returns the text to show if it has a job running
+    def attach(self, chat):
+        job = self.chats.get(chat)
+        if job is None or job.attached:
+            return None
+        if job.worker is not None:
+            self.flush(job.worker)
+        job.attached = True
+        return job.text
+
+    #text built up off screen is redrawn with the new delimiters, so what it is stored as keeps its roles
+    def changeDelims(self, newDelims):
+        for job in self.chats.values():
+            if job.worker is not None:
+                self.flush(job.worker)
+            if not job.attached:
+                transcript = TranscriptParser.parse(job.text, job.delims)
+                job.text = TranscriptParser.render(transcript.turns, newDelims, transcript.preamble)
+            job.delims = newDelims
+
+    #saving under a new name moves the job with it
+    def renameChat(self, oldName, newName):
+        job = self.chats.pop(oldName, None)
+        if job is not None:
+            job.chat = newName
+            self.chats[newName] = job
+        self.budget.renameChat(oldName, newName)
+
+    def bufferReady(self):
+        worker = self.sender()
+        if worker.buffer.isUrgent():
+            self.flush(worker)
+        elif not self.flushTimer.isActive():
+            wait = self.flushInterval - (time.monotonic() - self.lastFlush) * 1000
+            self.flushTimer.start(max(0, int(wait)))
+
+    #route buffered output to the display or to the job's own text
+    def flush(self, worker=None):
+        if worker is None:
+            self.flushTimer.stop()
+            self.lastFlush = time.monotonic()
+            for worker, _ in self.workers:
+                self.flush(worker)
+            return
+        job = self.jobs.get(worker.requestId)
+        drained = time.monotonic()
+        chunks = worker.buffer.drain()
+        for chunk in chunks:
+            if job is None or job.discarded:
+                continue
+            if job.column is not None:
+                self.compareProgress.emit(job.column, chunk)
+            elif job.attached:
+                self.progress.emit(chunk)
+            else:
+                job.apply(chunk)
+        #progress is delivered directly, so once it returns the batch is on screen
+        if job is not None and len(chunks) > 0 and len(job.renderLags) < 10000:
+            job.renderLags.append(round(worker.buffer.lastWait + time.monotonic() - drained, 4))
@@ -1,93 +1,151 @@
 from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot, Qt
-from ollama import chat
-import re
-from pathlib import Path
+import asyncio
+import os
+import time
+
+from TokenBuffer import TokenBuffer
+from Backends import BackendSet, timingKeys
+from ContextBudget import ContextBudget
+from ImageCache import ImageCache, imagePaths
 
 
 class PromptWorker(QObject):
-    finished = pyqtSignal()
-    progress = pyqtSignal(str)
-    reGen = pyqtSignal()
+    """Streams one generation at a time on its own thread, a PromptHandler runs a pool of these.
+
+    The stream is read on an event loop of the worker's own, so stopping cancels the read and drops the connection
+    at once, rather than waiting for a chunk that may be many seconds away while the server reads the prompt.
+    """
+    finished = pyqtSignal(int)
+    ready = pyqtSignal()
+    firstToken = pyqtSignal(int, str, float)
+    usage = pyqtSignal(int, int, int)
+    #ollama's own counts and durations from the last chunk of a response
+    timings = pyqtSignal(int, object)
+    #image bytes sent with a prompt, and how many fewer that is than the files
+    imageBytes = pyqtSignal(int, int, int)
 
-    startPrompt = pyqtSignal(object, object, object, object)
+    startPrompt = pyqtSignal(object, object, object, object, object, object)
 
     def __init__(self):
         super().__init__()
         self.stopGeneration = False
+        #the request being generated, everything in the buffer belongs to it
+        self.requestId = None
+        self.buffer = TokenBuffer()
+        #passed to ollama so prompts keep the model loaded as long as warming does
+        self.keepAlive = None
+        self.backends = BackendSet()
+        self.budget = ContextBudget()
+        #run on the worker's thread, the task is the response being streamed so the GUI thread can cancel it
+        self.loop = asyncio.new_event_loop()
+        self.task = None
+        #memory only unless given one with a folder
+        self.images = ImageCache(None)
         self.startPrompt.connect(self.prompt, Qt.QueuedConnection)
 
-    @pyqtSlot(object, object, object, object)
-    def prompt(self, model, splitPrompt, delims, sysPrompt):
+    @pyqtSlot(object, object, object, object, object, object)
+    def prompt(self, requestId, chat, model, turns, delims, sysPrompt):
+        self.requestId = requestId
         try:
-            if len(splitPrompt)==2:
-                if splitPrompt[1] == "":
-                    self.finished.emit()
+            if len(turns)==1:
+                if turns[0].content.strip() == "":
+                    self.finished.emit(requestId)
                     return
-            self.stopGeneration = False
             history = []
             missingImages = False
+            imageSent, imageFiles = 0, 0
 
-            for counter in range(0, len(splitPrompt), 2):
-                if counter + 1 < len(splitPrompt):
-                    role = None
-                    if splitPrompt[counter].lower().startswith(delims["user"]):
-                        role = "user"
-                    elif splitPrompt[counter].lower().startswith(delims["assistant"]):
-                        role = "assistant"
-                    elif splitPrompt[counter].lower().startswith(delims["system"]):
-                        role = "system"
-
-                    images = re.findall(r"[A-Za-z]:[\\/][^:]+.(?:png|jpg|jpeg|webp)", splitPrompt[counter + 1], flags=re.IGNORECASE)
-                    if len(images)>0:
-                        for pair in [(image, Path(image).is_file()) for image in images]:
-                            if not pair[1]:
-                                missingImages = True
-                                self.progress.emit(f"\nimage not found - {pair[0]}")
-
-                    if counter + 1 == len(splitPrompt) - 1 and splitPrompt[-1].strip() == "" and len(splitPrompt)>=4:
-                        if splitPrompt[-4] == delims["assistant"]:
-                            history = history[:-1]
-                            self.reGen.emit()
+            for counter, turn in enumerate(turns):
+                images = []
+                for image in imagePaths(turn.content):
+                    try:
+                        payload = self.images.payload(image, model)
+                    except Exception as e:
+                        payload = None
+                        print("prompt worker: ", str(e))
+                    if payload is None:
+                        missingImages = True
+                        self.emitChunk(f"\nimage not found - {image}")
                     else:
-                        if len(images) > 0:
-                            history.append({"role": role, "content": splitPrompt[counter + 1].strip(), "images": images})
-                        else:
-                            history.append({"role": role, "content": splitPrompt[counter + 1].strip()})
+                        images.append(payload)
+                        imageSent += len(payload) * 3 // 4
+                        imageFiles += os.path.getsize(image)
+
+                if counter == len(turns) - 1 and turn.content.strip() == "" and len(turns)>=2:
+                    if turns[-2].role == "assistant":
+                        history = history[:-1]
+                        #goes through the buffer so it is applied before the new response arrives
+                        self.emitChunk("regen12", True)
+                else:
+                    if len(images) > 0:
+                        history.append({"role": turn.role, "content": turn.content.strip(), "images": images})
+                    else:
+                        history.append({"role": turn.role, "content": turn.content.strip()})
 
             if missingImages:
-                self.finished.emit()
+                self.finished.emit(requestId)
                 return
+            if imageFiles > 0:
+                self.imageBytes.emit(requestId, imageSent, imageFiles - imageSent)
 
-            if sysPrompt.strip() != "" and not history[0]["role"] == delims["system"][:-1]:
-                history.insert(0, {"role": "system", "content": sysPrompt})
+            #the default prompt always goes first so the start of what is sent doesn't change between turns
+            if sysPrompt.strip() != "" and not history[0]["role"] == "system":
+                history.insert(0, {"role": "system", "content": sysPrompt.strip()})
+            history, tokens, limit, dropped = self.budget.fit(model, history, chat)
+            self.usage.emit(tokens, limit, dropped)
             self.generateResponse(history, model)
         except Exception as e:
             print("prompt worker: ", str(e))
             import traceback
             print("prompt worker: An error occurred")
             traceback.print_exc()
+            #the handler is waiting on this to free the worker
+            self.finished.emit(requestId)
 
     def generateResponse(self, history, model):
         try:
-            self.progress.emit("assis12")
-            stream = chat(
-                model=model,
-                messages=history,
-                stream=True,
-            )
-            for chunk in stream:
-                if self.stopGeneration:
-                    stream.close()
-                    break
-                self.progress.emit(chunk['message']['content'])
-
+            self.emitChunk("assis12", True)
+            self.task = self.loop.create_task(self.streamResponse(history, model))
+            #a stop that came before there was a task to cancel
             if self.stopGeneration:
-                self.stopGeneration = False
-            self.progress.emit("usr12")
-
+                self.task.cancel()
+            try:
+                self.loop.run_until_complete(self.task)
+            except asyncio.CancelledError:
+                #cancelled before it started, so streamResponse never ran to close the turn
+                self.emitChunk("usr12", True)
         except Exception as e:
-            self.progress.emit(f"gen response: {str(e)}")
-        self.finished.emit()
+            self.emitChunk(f"gen response: {str(e)}")
+        self.task = None
+        self.finished.emit(self.requestId)
+
+    async def streamResponse(self, history, model):
+        start = time.perf_counter()
+        firstToken = True
+        last = None
+        try:
+            async for chunk in self.backends.forModel(model).streamChat(model, history, self.keepAlive, self.budget.numCtx):
+                if firstToken and chunk["content"]:
+                    firstToken = False
+                    self.firstToken.emit(self.requestId, model, time.perf_counter() - start)
+                self.emitChunk(chunk["content"])
+                last = chunk
+        except asyncio.CancelledError:
+            #the backend has closed its connection by now
+            last = None
+
+        self.emitChunk("usr12", True)
+        if last is not None and last["done"]:
+            self.timings.emit(self.requestId, {key: last.get(key) for key in timingKeys})
+
+    #queue output for the GUI, only signalling when the GUI isn't already due to drain the buffer
+    def emitChunk(self, text, marker=False):
+        if self.buffer.push(text, marker):
+            self.ready.emit()
 
+    #called from the GUI thread
     def endGeneration(self):
-        self.stopGeneration = True
\ No newline at end of file
+        self.stopGeneration = True
+        task = self.task
+        if task is not None:
+            self.loop.call_soon_threadsafe(task.cancel)
\ No newline at end of file
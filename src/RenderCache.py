@@ -0,0 +1,31 @@
+from collections import OrderedDict
+
+
+class RenderCache:
+    """Rendered turns keyed by their text, least recently used first, capped at roughly maxChars of text."""
+    def __init__(self, maxChars=4 << 20):
+        self.maxChars = maxChars
+        self.entries = OrderedDict()
+        self.size = 0
+
+    #render is only called for text that isn't already in the cache
+    def get(self, text, render):
+        entry = self.entries.get(text)
+        if entry is not None:
+            self.entries.move_to_end(text)
+            return entry
+        entry = render(text)
+        self.entries[text] = entry
+        self.size += len(text)
+        self.evict()
+        return entry
+
+    def evict(self):
+        #the newest entry stays even if it is bigger than the cap
+        while self.size > self.maxChars and len(self.entries) > 1:
+            text, _ = self.entries.popitem(last=False)
+            self.size -= len(text)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
@@ -0,0 +1,94 @@
+import re
+import time
+from functools import lru_cache
+
+from PyQt5.QtCore import QTimer
+from PyQt5.QtGui import QSyntaxHighlighter, QTextCharFormat, QColor
+
+from TranscriptParser import getPattern
+
+
+nonBMP = re.compile("[\U00010000-\U0010FFFF]")
+
+#qt positions are utf-16 code units, so characters outside the BMP take two
+@lru_cache(maxsize=1024)
+def utf16Offsets(text):
+    if nonBMP.search(text) is None:
+        return None
+    offsets = [0]
+    for char in text:
+        offsets.append(offsets[-1] + (2 if ord(char) > 0xFFFF else 1))
+    return offsets
+
+
+class RoleHighlighter(QSyntaxHighlighter):
+    """Colours the role delimiters one block at a time as Qt marks blocks dirty.
+
+    A delimiter change recolours the blocks on screen straight away and the rest a slice at a time,
+    every block that changes colour relays out everything below it so a long chat at once froze the gui.
+    """
+    colours = {"user": "blue", "assistant": "green", "system": "gray"}
+
+    def __init__(self, document):
+        super().__init__(document)
+        self.delims = None
+        self.pattern = None
+        self.roles = {}
+        self.formats = {}
+        for role, colour in self.colours.items():
+            fmt = QTextCharFormat()
+            fmt.setForeground(QColor(colour))
+            self.formats[role] = fmt
+        #(first, end) block number ranges still to recolour
+        self.pending = []
+        self.sliceSeconds = 0.01
+        self.sliceTimer = QTimer(self)
+        self.sliceTimer.setSingleShot(True)
+        self.sliceTimer.timeout.connect(self.recolourSlice)
+
+    #only recolours the document if the delimiters actually changed, starting from firstBlock
+    def setDelims(self, delims, firstBlock=0):
+        if delims is None or delims == self.delims:
+            return
+        self.delims = dict(delims)
+        self.roles = {delim.lower(): role for role, delim in delims.items()}
+        self.pattern = getPattern(delims)
+        count = self.document().blockCount()
+        firstBlock = min(max(firstBlock, 0), count)
+        self.pending = [(firstBlock, count), (0, firstBlock)]
+        self.recolourSlice()
+
+    def isRecolouring(self):
+        return len(self.pending) > 0
+
+    #blocks typed or streamed in meanwhile are coloured by qt with the new pattern anyway
+    def recolourSlice(self):
+        deadline = time.perf_counter() + self.sliceSeconds
+        while len(self.pending) > 0:
+            first, end = self.pending[0]
+            block = self.document().findBlockByNumber(first)
+            while first < end and block.isValid() and time.perf_counter() < deadline:
+                self.rehighlightBlock(block)
+                block = block.next()
+                first += 1
+            if first < end and block.isValid():
+                self.pending[0] = (first, end)
+                self.sliceTimer.start(0)
+                return
+            self.pending.pop(0)
+
+    def highlightBlock(self, text):
+        if self.pattern is None:
+            return
+        offsets = None
+        for match in self.pattern.finditer(text):
+            role = self.roles.get(match.group().lower())
+            if role is None:
+                continue
+            #colour the name but not the ":"
+            start, end = match.start(), match.end() - 1
+            if offsets is None:
+                offsets = utf16Offsets(text) or False
+            if offsets:
+                start, end = offsets[start], offsets[end]
+            self.setFormat(start, end - start, self.formats[role])
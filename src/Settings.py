@@ -1,35 +1,26 @@
 import os
-import re
 import shutil
 import subprocess
 import sys
 import tempfile
-import threading
 
-import winshell
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import (
     QWidget, QVBoxLayout, QHBoxLayout,
     QTextEdit, QComboBox, QLabel, QLineEdit, QCheckBox, QRadioButton, QPushButton, QMessageBox
 )
-from PyQt5.QtCore import pyqtSignal, QTimer
-from ollama import list as ollamaList
-import json
+from PyQt5.QtCore import QTimer
 
 from LoadImage import resource_path
 
 
 class Settings(QWidget):
-    submitted = pyqtSignal(str)
-
-    def __init__(self, dataStore, screen, appname):
+    """The settings window, edits the values held by a SettingsModel."""
+    def __init__(self, settingsModel, appname):
         super().__init__()
-        self.dataStore = dataStore
+        self.settingsModel = settingsModel
         self.appName = appname
-        self.defaults = {"delimUser": "user", "delimAssistant": "assistant", "delimSystem": "sysprompt",
-                        "enableSysPrompt": False, "hideSysPrompt": False, "sysPrompt": "", "loadFixedModel": False,
-                        "selectedModel": "", "prevModel": "", "pos": (screen.width()//2-300, screen.height()//2-150), "size": (600, 300)}
-        self.settings = self.defaults
+        self.settingsModel.modelsUpdated.connect(self.updateModels)
 
         layout = QVBoxLayout()
         self.setWindowTitle("Settings")
@@ -111,9 +102,8 @@ class Settings(QWidget):
 
             defaultModelRadioFixedLayout = QHBoxLayout()
             self.defaultModelRadioFixed = QRadioButton("Fixed model:")
-            self.models = [str(model.model) for model in ollamaList().models]
             self.modelSelect = QComboBox()
-            self.modelSelect.addItems(self.models)
+            self.modelSelect.addItems(self.settingsModel.models)
             self.modelSelect.setFixedWidth(180)
             defaultModelRadioFixedLayout.addWidget(self.defaultModelRadioFixed)
             defaultModelRadioFixedLayout.addWidget(self.modelSelect)
@@ -124,6 +114,46 @@ class Settings(QWidget):
             return defaultModelLayout
         layout.addLayout(defaultModel())
 
+        #which backend answers each model
+        def backend():
+            backendLayout = QVBoxLayout()
+            self.backendLabel = QLabel("\nBackend for each model: \n"
+                                       "     (auto uses whichever backend has the model) \n"
+                                       "     (backends are added under \"backends\" in settings.json)")
+            backendLayout.addWidget(self.backendLabel)
+
+            backendSelectLayout = QHBoxLayout()
+            backendSelectLayout.addWidget(QLabel("     "))
+            self.backendModelSelect = QComboBox()
+            self.backendModelSelect.addItems(self.settingsModel.models)
+            self.backendModelSelect.setFixedWidth(180)
+            self.backendModelSelect.currentTextChanged.connect(self.showModelBackend)
+            backendSelectLayout.addWidget(self.backendModelSelect)
+            self.backendSelect = QComboBox()
+            self.backendSelect.setFixedWidth(120)
+            self.backendSelect.activated.connect(self.changeModelBackend)
+            backendSelectLayout.addWidget(self.backendSelect)
+            backendSelectLayout.addStretch(1)
+            backendLayout.addLayout(backendSelectLayout)
+
+            return backendLayout
+        self.modelBackends = {}
+        layout.addLayout(backend())
+
+        #how the rich pane is drawn
+        def richView():
+            richViewLayout = QVBoxLayout()
+            self.richViewLabel = QLabel("\nRich view:")
+            richViewLayout.addWidget(self.richViewLabel)
+            turnViewLayout = QHBoxLayout()
+            turnViewLayout.addWidget(QLabel("   "))
+            self.turnView = QCheckBox("One box per message, faster for very long chats (double click to edit)", self)
+            turnViewLayout.addWidget(self.turnView)
+            turnViewLayout.addStretch(1)
+            richViewLayout.addLayout(turnViewLayout)
+            return richViewLayout
+        layout.addLayout(richView())
+
         #create the reset and submit buttons
         def bottom():
             submissionLayout = QHBoxLayout()
@@ -149,7 +179,7 @@ class Settings(QWidget):
         self.setLayout(layout)
         #just locks size, cannot get smaller than elements
         self.setFixedSize(0,0)
-        threading.Thread(target=self.loadSettings(True)).start()
+        self.loadSettings()
 
     # --- Function that shows a warning and exits ---
     def confirmExit(self):
@@ -168,6 +198,7 @@ class Settings(QWidget):
         # Determine which was clicked
         clicked = msg.clickedButton()
 
+        import winshell
         if clicked == yes_btn:
             startup = winshell.startup()
             shortcut_path = os.path.join(startup, f"{self.appName}.lnk")
@@ -199,8 +230,8 @@ class Settings(QWidget):
             if clicked == cancel_btn:
                 pass
             elif clicked == full_btn:
-                if os.path.isdir(self.dataStore):
-                    shutil.rmtree(self.dataStore)
+                if os.path.isdir(self.settingsModel.dataStore):
+                    shutil.rmtree(self.settingsModel.dataStore)
             elif clicked == limited_btn or clicked == full_btn:
                 startup = winshell.startup()
                 shortcut_path = os.path.join(startup, f"{self.appName}.lnk")
@@ -230,9 +261,28 @@ class Settings(QWidget):
 
 
     def updateModels(self, models):
-        self.models = models
+        selected = self.modelSelect.currentText() if self.isVisible() else self.settingsModel.settings["selectedModel"]
         self.modelSelect.clear()
-        self.modelSelect.addItems(self.models)
+        self.modelSelect.addItems(models)
+        if selected in models:
+            self.modelSelect.setCurrentText(selected)
+        backendModel = self.backendModelSelect.currentText()
+        self.backendModelSelect.clear()
+        self.backendModelSelect.addItems(models)
+        if backendModel in models:
+            self.backendModelSelect.setCurrentText(backendModel)
+
+    def showModelBackend(self, model):
+        self.backendSelect.setCurrentText(self.modelBackends.get(model, "auto"))
+
+    def changeModelBackend(self):
+        model = self.backendModelSelect.currentText()
+        if model == "":
+            return
+        if self.backendSelect.currentText() == "auto":
+            self.modelBackends.pop(model, None)
+        else:
+            self.modelBackends[model] = self.backendSelect.currentText()
 
 
     def submit(self):
@@ -242,72 +292,59 @@ class Settings(QWidget):
         if (not delimUser != delimAssistant != delimSystem
                 or any([len(x)==0 for x in [delimUser, delimAssistant, delimSystem]])
                 or any([":" in x for x in [delimUser, delimAssistant, delimSystem]])):
-            if delimUser != self.settings["delimUser"]:
+            settings = self.settingsModel.settings
+            if delimUser != settings["delimUser"]:
                 self.delimUserInput.setText("invalid option")
-            if delimAssistant != self.settings["delimAssistant"]:
+            if delimAssistant != settings["delimAssistant"]:
                 self.delimAssistantInput.setText("invalid option")
-            if delimSystem != self.settings["delimSystem"]:
+            if delimSystem != settings["delimSystem"]:
                 self.delimSystemInput.setText("invalid option")
             return
 
 
-        self.settings = {"delimUser": delimUser,
-                         "delimAssistant": delimAssistant,
-                         "delimSystem": delimSystem,
-                         "enableSysPrompt": self.enableSysPrompt.isChecked(),
-                         "hideSysPrompt": self.hideSysPrompt.isChecked(),
-                         "sysPrompt": self.sysPromptInput.toPlainText(),
-                         "loadFixedModel": self.defaultModelRadioFixed.isChecked(),
-                         "selectedModel": self.modelSelect.currentText(),
-                         "prevModel": self.settings["prevModel"],
-                         "pos": self.settings["pos"],
-                         "size": self.settings["size"]}
-        self.saveSettingsFile()
         self.hide()
-        self.submitted.emit("New settings")
-
-    def saveSettingsFile(self):
-            try:
-                with open(self.dataStore / f"settings.json", "w") as file:
-                    json.dump(self.settings, file)
-            except Exception as e:
-                print(e)
-
-    def loadSettings(self, checkFile):
-        if checkFile:
-            try:
-                if (self.dataStore / f"settings.json").is_file():
-                    with open(self.dataStore / f"settings.json", "r") as file:
-                        self.settings = json.load(file)
-            except Exception as e:
-                print(e)
-                pass
-            if len(self.settings.keys()) != len(self.defaults):
-                self.settings = self.defaults
-
-        self.delimUserInput.setText(self.settings["delimUser"])
-        self.delimAssistantInput.setText(self.settings["delimAssistant"])
-        self.delimSystemInput.setText(self.settings["delimSystem"])
-        self.enableSysPrompt.setChecked(self.settings["enableSysPrompt"])
-        self.hideSysPrompt.setChecked(self.settings["hideSysPrompt"])
-        self.sysPromptInput.setText(self.settings["sysPrompt"])
-        if self.settings["loadFixedModel"]:
+        self.settingsModel.submit({"delimUser": delimUser,
+                                   "delimAssistant": delimAssistant,
+                                   "delimSystem": delimSystem,
+                                   "enableSysPrompt": self.enableSysPrompt.isChecked(),
+                                   "hideSysPrompt": self.hideSysPrompt.isChecked(),
+                                   "sysPrompt": self.sysPromptInput.toPlainText(),
+                                   "loadFixedModel": self.defaultModelRadioFixed.isChecked(),
+                                   "selectedModel": self.modelSelect.currentText(),
+                                   "modelBackends": dict(self.modelBackends),
+                                   "turnView": self.turnView.isChecked()})
+
+    #fill the inputs from the current settings
+    def loadSettings(self):
+        settings = self.settingsModel.settings
+        models = self.settingsModel.models
+        self.delimUserInput.setText(settings["delimUser"])
+        self.delimAssistantInput.setText(settings["delimAssistant"])
+        self.delimSystemInput.setText(settings["delimSystem"])
+        self.enableSysPrompt.setChecked(settings["enableSysPrompt"])
+        self.hideSysPrompt.setChecked(settings["hideSysPrompt"])
+        self.sysPromptInput.setText(settings["sysPrompt"])
+        if settings["loadFixedModel"]:
             self.defaultModelRadioFixed.setChecked(True)
         else:
             self.defaultModelRadioVar.setChecked(True)
-        if self.settings["selectedModel"] in self.models:
-            self.modelSelect.setCurrentText(self.settings["selectedModel"])
-        else:
-            self.modelSelect.setCurrentText(self.models[0])
+        if settings["selectedModel"] in models:
+            self.modelSelect.setCurrentText(settings["selectedModel"])
+        elif len(models) > 0:
+            self.modelSelect.setCurrentText(models[0])
+        self.turnView.setChecked(settings["turnView"])
+        self.modelBackends = dict(settings["modelBackends"])
+        self.backendSelect.clear()
+        self.backendSelect.addItems(["auto"] + list(settings["backends"]))
+        self.showModelBackend(self.backendModelSelect.currentText())
 
 
     def reset(self):
-        if (self.dataStore / f"settings.json").is_file():
-            (self.dataStore / f"settings.json").unlink()
-        self.loadSettings(True)
+        self.settingsModel.reset()
+        self.loadSettings()
 
     def showEvent(self, a0):
-        self.loadSettings(False)
+        self.loadSettings()
 
     # open the settings menu
     def toggleSettings(self):
@@ -320,131 +357,3 @@ class Settings(QWidget):
         except Exception as e:
             self.display_text("toggleSettings: ", str(e))
 
-    def updatePrevModel(self, model):
-        self.settings["prevModel"] = model
-        self.saveSettingsFile()
-
-    def movedOrResized(self, pos, size):
-        self.settings["pos"] = (pos.x(), pos.y())
-        self.settings["size"] = (size.width(), size.height())
-        self.saveSettingsFile()
-
-    # get settings when they are changed
-    def fetchSysPromptSettings(self, text, enableSysPrompt, hideSysPrompt, sysPrompt):
-        newSysPrompt = self.settings["sysPrompt"]
-        newHideSysPrompt = self.settings["hideSysPrompt"]
-        newEnableSysPrompt = self.settings["enableSysPrompt"]
-        delims = {"user": f"{self.settings["delimUser"]}:",
-                           "assistant": f"{self.settings["delimAssistant"]}:",
-                           "system": f"{self.settings["delimSystem"]}:"}
-        # check if there is any changes in default prompt
-        if (newSysPrompt != sysPrompt
-                or newHideSysPrompt != hideSysPrompt
-                or newEnableSysPrompt != enableSysPrompt):
-            parts = re.split(f"({delims["user"]}|{delims["assistant"]}|{delims["system"]})", text, flags=re.IGNORECASE)[1:]
-            safeToCheck = len(parts) >= 2
-            started = delims["assistant"].lower() in [part.lower() for part in parts[::2]]
-            # if there is a change in enabling
-            if newEnableSysPrompt != enableSysPrompt:
-                # if hiding sysPrompt don't have to do anything
-                if not hideSysPrompt:
-                    # if turning on the sysprompt
-                    if newEnableSysPrompt:
-                        # only change the sysprompt if the chat has not started
-                        if not started:
-                            # if there is enough entries to check if the default prompt is being used
-                            if safeToCheck:
-                                # if the current default prompt is there change it
-                                if parts[0].lower() == delims["system"].lower() and parts[
-                                    1] == sysPrompt:
-                                    text = delims["system"] + " " + sysPrompt + "\n\n" + "".join(
-                                        parts[2:])
-                                else:
-                                    text = delims["system"] + " " + sysPrompt + "\n\n" + text
-                            # if there is not enough entries then it doesnt have a system prompt
-                            else:
-                                text = delims["system"] + " " + sysPrompt + "\n\n" + text
-                        # do not change prompt if chat has already started
-                        else:
-                            pass
-                    # if turning off the sysPrompt
-                    else:
-                        # only change if chat has been started
-                        if not started:
-                            if safeToCheck:
-                                # if the current default prompt is there remove it
-                                if parts[0].lower() == delims["system"].lower() and parts[
-                                    1].strip() == sysPrompt.strip():
-                                    text = "".join(parts[2:])
-                            # it wont have the current Default prompt
-                            else:
-                                pass
-                        # do nothing if the chat has started
-                        else:
-                            pass
-                # do nothing if sysprompt is hidden
-                else:
-                    pass
-                enableSysPrompt = newEnableSysPrompt
-
-            # if there is a change in hiding
-            # dont care whether chat has started as this doesn't affect generation
-            if newHideSysPrompt != hideSysPrompt:
-                # only do anything if sysprompt is enabled and there is a sysprompt
-                # if it is disabled it is already hidden and won't be shown
-                if enableSysPrompt:
-                    # if prompt is getting shown
-                    if not newHideSysPrompt:
-                        # if it is safe to check for an existing prompt
-                        if safeToCheck:
-                            # if there is an existing sysprompt do nothing
-                            if parts[0].lower() == delims["system"].lower():
-                                pass
-                            # else add on the default prompt
-                            else:
-                                text = delims["system"] + " " + sysPrompt + "\n\n" + text
-                        # if it is short then it won't have a sysprompt
-                        else:
-                            text = delims["system"] + " " + sysPrompt + "\n\n" + text
-                    # if hiding sysprompt
-                    else:
-                        # if it is safe to check for the prompt
-                        if safeToCheck:
-                            # if the current default prompt is there remove it
-                            if parts[0].lower() == delims["system"].lower() and parts[
-                                1].strip() == sysPrompt.strip():
-                                text = "".join(parts[2:])
-                            # else do nothing
-                            else:
-                                pass
-                        # if it is short then it won't have a sysprompt
-                        else:
-                            pass
-                hideSysPrompt = newHideSysPrompt
-
-            # if change in the content of the prompt
-            if newSysPrompt != sysPrompt:
-                # only do anything if enabled and showing
-                if enableSysPrompt:
-                    if not hideSysPrompt:
-                        # only change if the chat has started
-                        if not started:
-                            if safeToCheck:
-                                # if the old default prompt is there replace it
-                                if parts[0].lower() == delims["system"].lower() and parts[
-                                    1].strip() == sysPrompt.strip():
-                                    text = delims["system"] + " " + newSysPrompt + "\n\n" + "".join(
-                                        parts[2:])
-                            else:
-                                text = delims["system"] + " " + newSysPrompt + "\n\n" + text
-                        # change nothing if chat has started
-                        else:
-                            pass
-                    # if prompt was hidden and chat is started, want to display the old prompt
-                    else:
-                        if started:
-                            # if there is no system prompt
-                            if parts[0].lower() != delims["system"].lower():
-                                text = delims["system"] + " " + sysPrompt + "\n\n" + text
-                sysPrompt = newSysPrompt
-        return enableSysPrompt, hideSysPrompt, sysPrompt, text
\ No newline at end of file
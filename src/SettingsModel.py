@@ -0,0 +1,212 @@
+import json
+import os
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from IOExecutor import atomicWrite
+import TranscriptParser
+
+
+class SettingsModel(QObject):
+    """The settings values and settings.json, kept apart from the Settings window so the window is only built when opened."""
+    submitted = pyqtSignal(str)
+    modelsUpdated = pyqtSignal(list)
+
+    def __init__(self, dataStore, screen, models=[]):
+        super().__init__()
+        self.dataStore = dataStore
+        self.models = list(models)
+        self.defaults = {"delimUser": "user", "delimAssistant": "assistant", "delimSystem": "sysprompt",
+                        "enableSysPrompt": False, "hideSysPrompt": False, "sysPrompt": "", "loadFixedModel": False,
+                        "selectedModel": "", "prevModel": "", "pos": (screen.width()//2-300, screen.height()//2-150), "size": (600, 300),
+                        "transcriptCacheMB": 64,
+                        #turns shown when a chat is opened, older ones are added as it is scrolled up, 0 shows them all
+                        "pageTurns": 40,
+                        #responses generated at once, 0 matches the server's OLLAMA_NUM_PARALLEL
+                        "maxStreams": 0,
+                        #load the selected model when the window opens or the model changes
+                        "warmModel": True, "keepAlive": "10m",
+                        #what to do with chats longer than the context, pinnedSystem, slidingWindow or none
+                        #numCtx of 0 uses the model's own context length, contextReserve is kept free for the reply
+                        "contextPolicy": "pinnedSystem", "numCtx": 0, "contextReserve": 1024,
+                        #longest image side sent to a model, by model name, on top of the built in table
+                        "imageMaxSide": {},
+                        #how the ollama server is started if it isn't already running, empty values are left unset
+                        "serverCommand": ["ollama", "serve"],
+                        "serverEnv": {"OLLAMA_NUM_PARALLEL": "", "OLLAMA_KEEP_ALIVE": "", "OLLAMA_FLASH_ATTENTION": "",
+                                      "OLLAMA_MAX_LOADED_MODELS": ""},
+                        #what generates, by name, types are ollama, openai (with a url) and replay (with a path)
+                        #and any of them can have a record path to save what it streams
+                        #ollama can have "hosts", a list of servers that prompts are shared between
+                        "backends": {"ollama": {"type": "ollama"}},
+                        #backend chosen for a model, a model not listed goes to whichever backend has it
+                        "modelBackends": {},
+                        #the rich pane as a list of turns that are only laid out on screen, rather than one document
+                        "turnView": False}
+        self.settings = dict(self.defaults)
+        self.loadSettings()
+
+    def loadSettings(self):
+        loaded = {}
+        try:
+            if (self.dataStore / f"settings.json").is_file():
+                with open(self.dataStore / f"settings.json", "r") as file:
+                    loaded = json.load(file)
+        except Exception as e:
+            print(e)
+            pass
+        #fill in anything added since the file was written
+        self.settings = {**self.defaults, **loaded}
+
+    def saveSettingsFile(self):
+            try:
+                atomicWrite(self.dataStore / f"settings.json", json.dumps(self.settings))
+            except Exception as e:
+                print(e)
+
+    def submit(self, changes):
+        self.settings = {**self.settings, **changes}
+        self.saveSettingsFile()
+        self.submitted.emit("New settings")
+
+    def reset(self):
+        if (self.dataStore / f"settings.json").is_file():
+            (self.dataStore / f"settings.json").unlink()
+        self.loadSettings()
+
+    def updateModels(self, models):
+        self.models = models
+        self.modelsUpdated.emit(models)
+
+    def updatePrevModel(self, model):
+        self.settings["prevModel"] = model
+        self.saveSettingsFile()
+
+    def movedOrResized(self, pos, size):
+        self.settings["pos"] = (pos.x(), pos.y())
+        self.settings["size"] = (size.width(), size.height())
+        self.saveSettingsFile()
+
+    #responses generated at once, the server queues anything past its own parallel limit anyway
+    def maxStreams(self):
+        if self.settings["maxStreams"] > 0:
+            return self.settings["maxStreams"]
+        parallel = str(self.settings["serverEnv"].get("OLLAMA_NUM_PARALLEL", "") or os.environ.get("OLLAMA_NUM_PARALLEL", ""))
+        return int(parallel) if parallel.isdigit() and int(parallel) > 0 else 1
+
+    def getDelims(self):
+        return {"user": f"{self.settings["delimUser"]}:",
+                "assistant": f"{self.settings["delimAssistant"]}:",
+                "system": f"{self.settings["delimSystem"]}:"}
+
+    # get settings when they are changed
+    def fetchSysPromptSettings(self, text, enableSysPrompt, hideSysPrompt, sysPrompt):
+        newSysPrompt = self.settings["sysPrompt"]
+        newHideSysPrompt = self.settings["hideSysPrompt"]
+        newEnableSysPrompt = self.settings["enableSysPrompt"]
+        delims = self.getDelims()
+        # check if there is any changes in default prompt
+        if (newSysPrompt != sysPrompt
+                or newHideSysPrompt != hideSysPrompt
+                or newEnableSysPrompt != enableSysPrompt):
+            transcript = TranscriptParser.parse(text, delims)
+            safeToCheck = len(transcript) >= 1
+            started = transcript.started()
+            # if there is a change in enabling
+            if newEnableSysPrompt != enableSysPrompt:
+                # if hiding sysPrompt don't have to do anything
+                if not hideSysPrompt:
+                    # if turning on the sysprompt
+                    if newEnableSysPrompt:
+                        # only change the sysprompt if the chat has not started
+                        if not started:
+                            # if there is enough entries to check if the default prompt is being used
+                            if safeToCheck:
+                                # if the current default prompt is there change it
+                                if transcript[0].role == "system" and transcript[0].content == sysPrompt:
+                                    text = delims["system"] + " " + sysPrompt + "\n\n" + transcript.textFrom(1)
+                                else:
+                                    text = delims["system"] + " " + sysPrompt + "\n\n" + text
+                            # if there is not enough entries then it doesnt have a system prompt
+                            else:
+                                text = delims["system"] + " " + sysPrompt + "\n\n" + text
+                        # do not change prompt if chat has already started
+                        else:
+                            pass
+                    # if turning off the sysPrompt
+                    else:
+                        # only change if chat has been started
+                        if not started:
+                            if safeToCheck:
+                                # if the current default prompt is there remove it
+                                if transcript[0].role == "system" and transcript[0].content.strip() == sysPrompt.strip():
+                                    text = transcript.textFrom(1)
+                            # it wont have the current Default prompt
+                            else:
+                                pass
+                        # do nothing if the chat has started
+                        else:
+                            pass
+                # do nothing if sysprompt is hidden
+                else:
+                    pass
+                enableSysPrompt = newEnableSysPrompt
+
+            # if there is a change in hiding
+            # dont care whether chat has started as this doesn't affect generation
+            if newHideSysPrompt != hideSysPrompt:
+                # only do anything if sysprompt is enabled and there is a sysprompt
+                # if it is disabled it is already hidden and won't be shown
+                if enableSysPrompt:
+                    # if prompt is getting shown
+                    if not newHideSysPrompt:
+                        # if it is safe to check for an existing prompt
+                        if safeToCheck:
+                            # if there is an existing sysprompt do nothing
+                            if transcript[0].role == "system":
+                                pass
+                            # else add on the default prompt
+                            else:
+                                text = delims["system"] + " " + sysPrompt + "\n\n" + text
+                        # if it is short then it won't have a sysprompt
+                        else:
+                            text = delims["system"] + " " + sysPrompt + "\n\n" + text
+                    # if hiding sysprompt
+                    else:
+                        # if it is safe to check for the prompt
+                        if safeToCheck:
+                            # if the current default prompt is there remove it
+                            if transcript[0].role == "system" and transcript[0].content.strip() == sysPrompt.strip():
+                                text = transcript.textFrom(1)
+                            # else do nothing
+                            else:
+                                pass
+                        # if it is short then it won't have a sysprompt
+                        else:
+                            pass
+                hideSysPrompt = newHideSysPrompt
+
+            # if change in the content of the prompt
+            if newSysPrompt != sysPrompt:
+                # only do anything if enabled and showing
+                if enableSysPrompt:
+                    if not hideSysPrompt:
+                        # only change if the chat has started
+                        if not started:
+                            if safeToCheck:
+                                # if the old default prompt is there replace it
+                                if transcript[0].role == "system" and transcript[0].content.strip() == sysPrompt.strip():
+                                    text = delims["system"] + " " + newSysPrompt + "\n\n" + transcript.textFrom(1)
+                            else:
+                                text = delims["system"] + " " + newSysPrompt + "\n\n" + text
+                        # change nothing if chat has started
+                        else:
+                            pass
+                    # if prompt was hidden and chat is started, want to display the old prompt
+                    else:
+                        if started:
+                            # if there is no system prompt
+                            if transcript[0].role != "system":
+                                text = delims["system"] + " " + sysPrompt + "\n\n" + text
+                sysPrompt = newSysPrompt
+        return enableSysPrompt, hideSysPrompt, sysPrompt, text
\ No newline at end of file
@@ -0,0 +1,49 @@
+import json
+import time
+from contextlib import contextmanager
+
+
+class StartupProfiler:
+    """Wall time of each startup phase, appended to a log so slow starts can be compared."""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.phases = []
+
+    #time since the previous mark is put down to name
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, (now - self.last) * 1000))
+        self.last = now
+
+    #for work that happens later on first use, like building the settings window
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, (time.perf_counter() - start) * 1000))
+
+    def report(self):
+        return {"time": time.time(),
+                "total": round((self.last - self.started) * 1000, 1),
+                "phases": [[name, round(ms, 1)] for name, ms in self.phases]}
+
+    #one json line per start, only the most recent keep starts are kept
+    def dump(self, path, keep=100):
+        try:
+            lines = []
+            if path.is_file():
+                with open(path, "r", encoding="utf-8") as file:
+                    lines = file.read().splitlines()
+            lines = lines[-(keep - 1):] + [json.dumps(self.report())]
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as file:
+                file.write("\n".join(lines) + "\n")
+        except Exception as e:
+            print("startup profiler: ", str(e))
+
+
+#shared so every module marks against the same start
+profiler = StartupProfiler()
@@ -0,0 +1,60 @@
+import threading
+import time
+
+
+class TokenBuffer:
+    """Coalesces streamed tokens on the worker side until the GUI drains them."""
+    def __init__(self, maxBytes=4096, highWater=1 << 20):
+        #flush straight away once this many characters are waiting
+        self.maxBytes = maxBytes
+        #worker blocks in push while more than this is waiting
+        self.highWater = highWater
+
+        self.condition = threading.Condition()
+        self.items = []
+        self.pendingBytes = 0
+        self.wakeupPending = False
+        self.urgentPending = False
+        #when the oldest waiting item was pushed, and how long the last drained batch had waited
+        self.oldestAt = None
+        self.lastWait = 0.0
+
+    #add text, or a control marker such as assis12, returns True if the GUI should be woken up
+    def push(self, text, marker=False):
+        with self.condition:
+            while self.pendingBytes > self.highWater:
+                self.condition.wait(0.05)
+
+            if len(self.items) == 0:
+                self.oldestAt = time.monotonic()
+            if marker or len(self.items) == 0 or self.items[-1][0]:
+                self.items.append((marker, [text]))
+            else:
+                self.items[-1][1].append(text)
+            self.pendingBytes += len(text)
+
+            wake = False
+            if not self.wakeupPending:
+                self.wakeupPending = True
+                wake = True
+            elif self.pendingBytes >= self.maxBytes and not self.urgentPending:
+                self.urgentPending = True
+                wake = True
+            return wake
+
+    def isUrgent(self):
+        with self.condition:
+            return self.pendingBytes >= self.maxBytes
+
+    #take everything waiting, consecutive text is joined, markers stay separate
+    def drain(self):
+        with self.condition:
+            items = self.items
+            self.items = []
+            self.pendingBytes = 0
+            self.wakeupPending = False
+            self.urgentPending = False
+            if len(items) > 0:
+                self.lastWait = time.monotonic() - self.oldestAt
+            self.condition.notify_all()
+        return ["".join(parts) for _, parts in items]
@@ -1,11 +1,45 @@
-from PyQt5.QtWidgets import QComboBox, QPushButton, QLineEdit, QHBoxLayout, QWidget, QCheckBox
+from html import escape
+
+from PyQt5.QtCore import Qt, pyqtSignal, QTimer, QSize, QModelIndex
+from PyQt5.QtGui import QStandardItemModel, QStandardItem, QTextDocument, QColor
+from PyQt5.QtWidgets import (QComboBox, QPushButton, QLineEdit, QHBoxLayout, QWidget, QCheckBox, QLabel,
+                             QCompleter, QStyledItemDelegate, QStyleOptionViewItem, QStyle, QMenu)
+
+from ChatStore import matchStart, matchEnd
+
+
+class SnippetDelegate(QStyledItemDelegate):
+    """Draws a search result as its chat name over the matching snippet."""
+    def document(self, option, index):
+        document = QTextDocument()
+        document.setDefaultFont(option.font)
+        document.setHtml(index.data(Qt.UserRole))
+        document.setTextWidth(max(option.rect.width(), 330))
+        return document
+
+    def paint(self, painter, option, index):
+        options = QStyleOptionViewItem(option)
+        self.initStyleOption(options, index)
+        document = self.document(options, index)
+        options.text = ""
+        options.widget.style().drawControl(QStyle.CE_ItemViewItem, options, painter, options.widget)
+        painter.save()
+        painter.translate(options.rect.topLeft())
+        document.drawContents(painter)
+        painter.restore()
+
+    def sizeHint(self, option, index):
+        document = self.document(option, index)
+        return QSize(int(document.idealWidth()), int(document.size().height()))
 
 
 class TopBar(QWidget):
-    def __init__(self, dataStore):
+    searchRequested = pyqtSignal(str)
+    searchSelected = pyqtSignal(str)
+
+    def __init__(self, historyNames):
         super().__init__()
 
-        self.dataStore = dataStore
         buttonWidth = 25
 
         layout = QHBoxLayout(self)
@@ -17,7 +51,9 @@ class TopBar(QWidget):
         self.historySelect = QComboBox(editable=True)
         self.historySelect.setMaximumWidth(18)
         self.historySelect.view().setMinimumWidth(143)
-        self.historyNames = [path.name[:-4] for path in list(sorted((self.dataStore / f"history").glob('*.txt')))]
+        self.historyNames = list(historyNames)
+        #chats generating in the background, marked in the dropdown
+        self.chatStates = {}
         layout.addWidget(self.historySelect)
         # history text box
         self.historyInput = QLineEdit()
@@ -37,9 +73,53 @@ class TopBar(QWidget):
         self.newButton = self.makeButton("📖", buttonWidth)
         layout.addWidget(self.newButton)
 
+        # search over the text of saved chats
+        self.searchInput = QLineEdit()
+        self.searchInput.setPlaceholderText("🔍 search")
+        self.searchInput.setMaximumWidth(120)
+        self.searchInput.setMinimumWidth(60)
+        layout.addWidget(self.searchInput)
+
+        self.searchTimer = QTimer()
+        self.searchTimer.setSingleShot(True)
+        self.searchTimer.timeout.connect(lambda: self.searchRequested.emit(self.searchInput.text().strip()))
+        self.searchInput.textChanged.connect(lambda: self.searchTimer.start(120))
+
+        self.searchModel = QStandardItemModel(self)
+        self.searchCompleter = QCompleter(self.searchModel, self)
+        self.searchCompleter.setWidget(self.searchInput)
+        self.searchCompleter.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.searchCompleter.popup().setItemDelegate(SnippetDelegate(self.searchCompleter.popup()))
+        self.searchCompleter.popup().setMinimumWidth(350)
+        self.searchCompleter.activated[QModelIndex].connect(lambda index: self.searchSelected.emit(index.data()))
+
         """right aligned"""
         layout.addStretch(1)
 
+        #shown while old .txt history is being imported
+        self.importLabel = QLabel()
+        self.importLabel.hide()
+        layout.addWidget(self.importLabel)
+
+        #only shown while the ollama server isn't ready
+        self.serverState = "ready"
+        self.promptQueued = False
+        self.serverLabel = QLabel()
+        self.serverLabel.hide()
+        layout.addWidget(self.serverLabel)
+
+        #estimated tokens sent with the last prompt against the model's context
+        self.contextLabel = QLabel()
+        self.contextLabel.hide()
+        layout.addWidget(self.contextLabel)
+
+        #speed of the last response, opens the metrics viewer
+        self.speedButton = QPushButton()
+        self.speedButton.setFlat(True)
+        self.speedButton.setMaximumHeight(buttonWidth)
+        self.speedButton.hide()
+        layout.addWidget(self.speedButton)
+
         self.checkboxRaw = QCheckBox("Raw ")
         self.checkboxRaw.setChecked(True)
         self.checkboxMarkdown = QCheckBox("Rich ")
@@ -71,6 +151,15 @@ class TopBar(QWidget):
         self.modelSelect.setMinimumWidth(80)
         layout.addWidget(self.modelSelect)
 
+        #models ticked here are all sent the next prompt, side by side
+        self.compareButton = self.makeButton("⚖", buttonWidth)
+        self.compareButton.setMaximumWidth(35)
+        self.compareButton.setStyleSheet("QPushButton::menu-indicator { image: none; }")
+        self.compareMenu = QMenu(self)
+        self.compareButton.setMenu(self.compareMenu)
+        self.updateCompareButton()
+        layout.addWidget(self.compareButton)
+
         self.settingsButton = self.makeButton("⚙", buttonWidth)
         layout.addWidget(self.settingsButton)
 
@@ -85,6 +174,103 @@ class TopBar(QWidget):
         self.modelSelect.addItems(models)
         self.modelSelect.setCurrentText(model)
 
+        checked = set(self.compareModels())
+        self.compareMenu.clear()
+        for name in models:
+            action = self.compareMenu.addAction(name)
+            action.setData(name)
+            action.setCheckable(True)
+            action.setChecked(name in checked)
+            action.toggled.connect(self.updateCompareButton)
+        self.updateCompareButton()
+
+    def compareModels(self):
+        return [action.data() for action in self.compareMenu.actions() if action.isChecked()]
+
+    def updateCompareButton(self):
+        count = len(self.compareModels())
+        self.compareButton.setText(f"⚖{count}" if count > 0 else "⚖")
+        self.compareButton.setToolTip(f"next prompt goes to {count} models side by side" if count > 0
+                                      else "pick models to compare")
+
+    #results are (chat name, snippet) with matches wrapped in matchStart/matchEnd
+    def showSearchResults(self, results):
+        self.searchModel.clear()
+        for name, snippet in results:
+            snippet = escape(snippet).replace(matchStart, "<span style='background-color:#fff3a0'>").replace(matchEnd, "</span>")
+            item = QStandardItem(name)
+            item.setData(f"<b>{escape(name)}</b><br><span style='color:#555555'>{snippet}</span>", Qt.UserRole)
+            self.searchModel.appendRow(item)
+        if len(results) > 0:
+            self.searchCompleter.complete()
+        else:
+            self.searchCompleter.popup().hide()
+
+    def showImportProgress(self, done, total):
+        self.importLabel.setText(f"importing {done}/{total}")
+        self.importLabel.setVisible(done < total)
+
+    def showContextUsage(self, tokens, limit, dropped):
+        def short(n):
+            return f"{n/1000:.1f}k" if n >= 1000 else str(n)
+        self.contextLabel.setText(f"~{short(tokens)}/{short(limit)}")
+        self.contextLabel.setToolTip(f"about {tokens} of {limit} context tokens used by the last prompt"
+                                     + (f", {dropped} oldest turns left out" if dropped > 0 else ""))
+        self.contextLabel.setStyleSheet("color: #b36b00;" if dropped > 0 else "")
+        self.contextLabel.show()
+
+    def showSpeed(self, entry):
+        if entry["compare"]:
+            return
+        #a stopped response says how long the stop took rather than how fast it was
+        if entry["stopLatency"] is not None:
+            self.speedButton.setText(f"stopped in {entry["stopLatency"] * 1000:.0f} ms")
+            self.speedButton.setToolTip(f"{entry["model"]}, stopped and disconnected from the server")
+            self.speedButton.show()
+            return
+        if entry["tokensPerSecond"] is None:
+            return
+        self.speedButton.setText(f"{entry["tokensPerSecond"]:.1f} tok/s")
+        details = [f"{entry["model"]}, {entry["evalCount"]} tokens"]
+        if entry["ttft"] is not None:
+            warmth = {True: " with the model loaded", False: " with the model cold"}.get(entry.get("warm"), "")
+            details.append(f"first token after {entry["ttft"]:.2f}s{warmth}")
+        if entry["promptTokensPerSecond"] is not None:
+            details.append(f"prompt read at {entry["promptTokensPerSecond"]:.0f} tok/s")
+        self.speedButton.setToolTip(", ".join(details))
+        self.speedButton.show()
+
+    def showServerState(self, state):
+        self.serverState = state
+        self.updateServerLabel()
+    def showPromptQueued(self, queued):
+        self.promptQueued = queued
+        self.updateServerLabel()
+    def updateServerLabel(self):
+        text = {"starting": "starting ollama", "crashed": "restarting ollama", "failed": "ollama not responding",
+                "stopped": "ollama stopped"}.get(self.serverState, "")
+        if self.promptQueued:
+            text = f"{text}, prompt queued" if text else "prompt queued"
+        self.serverLabel.setText(text)
+        self.serverLabel.setVisible(text != "")
+
+    def showChatState(self, name, state):
+        if state == "":
+            self.chatStates.pop(name, None)
+        else:
+            self.chatStates[name] = state
+        if name in self.historyNames:
+            self.markChat(self.historyNames.index(name))
+    #a finished chat stops being marked once it has been looked at
+    def chatShown(self, name):
+        if self.chatStates.get(name) == "done":
+            self.showChatState(name, "")
+    def markChat(self, index):
+        state = self.chatStates.get(self.historyNames[index])
+        colour = {"queued": QColor("#999999"), "generating": QColor("#2a7ae2"), "done": QColor("#3c9a3c")}.get(state)
+        self.historySelect.setItemData(index, colour, Qt.DecorationRole)
+        self.historySelect.setItemData(index, state, Qt.ToolTipRole)
+
     def newChatNames(self, allNames, newName, blockSignals):
         allNames = sorted(allNames)
         self.historyNames = allNames
@@ -94,6 +280,9 @@ class TopBar(QWidget):
 
         self.historySelect.clear()
         self.historySelect.addItems(allNames)
+        for i in range(len(allNames)):
+            if allNames[i] in self.chatStates:
+                self.markChat(i)
         if newName != "":
             self.historySelect.setCurrentIndex(allNames.index(newName))
             self.historyInput.setText(newName)
@@ -0,0 +1,60 @@
+from collections import OrderedDict
+
+
+#rough per-turn overhead of the python objects on top of the text itself
+turnOverhead = 100
+
+
+class TranscriptCache:
+    """LRU of chat turns capped at roughly maxBytes.
+
+    Drafts (unsaved edits) are only held here, so they are never evicted.
+    """
+    def __init__(self, maxBytes=64 << 20):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def entrySize(self, preamble, turns):
+        return 2 * (len(preamble) + sum(len(turn.content) for turn in turns)) + turnOverhead * (len(turns) + 1)
+
+    #returns (preamble, turns, isDraft) or None
+    def get(self, name):
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+        self.entries.move_to_end(name)
+        return entry["preamble"], entry["turns"], entry["draft"]
+
+    def contains(self, name):
+        return name in self.entries
+
+    def isDraft(self, name):
+        return name in self.entries and self.entries[name]["draft"]
+
+    #a clean copy from disk never replaces a draft
+    def put(self, name, preamble, turns, draft=False):
+        if not draft and self.isDraft(name):
+            return
+        self.discard(name)
+        size = self.entrySize(preamble, turns)
+        self.entries[name] = {"preamble": preamble, "turns": turns, "draft": draft, "size": size}
+        self.size += size
+        self.evict()
+
+    def discard(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.size -= entry["size"]
+
+    def dropDrafts(self):
+        for name in [name for name, entry in self.entries.items() if entry["draft"]]:
+            self.discard(name)
+
+    def evict(self):
+        if self.size <= self.maxBytes:
+            return
+        for name in [name for name, entry in self.entries.items() if not entry["draft"]]:
+            if self.size <= self.maxBytes:
+                break
+            self.discard(name)
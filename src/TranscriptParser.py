@@ -0,0 +1,81 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+
+roles = ["user", "assistant", "system"]
+
+#span covers the delimiter and the content up to the next delimiter
+Turn = namedtuple("Turn", ["role", "delim", "content", "span"])
+
+
+@lru_cache(maxsize=32)
+def compilePattern(delimKey):
+    return re.compile("(" + "|".join(re.escape(delim) for delim in delimKey) + ")", re.IGNORECASE)
+
+def delimKey(delims):
+    return tuple(delims[role] for role in roles)
+
+#compiled split pattern for a delimiter set, built once per set
+def getPattern(delims):
+    return compilePattern(delimKey(delims))
+
+
+class Transcript:
+    """A chat split into turns, tagged with the document revision it was parsed from."""
+    def __init__(self, text, preamble, turns, delims, revision=None):
+        self.text = text
+        self.preamble = preamble
+        self.turns = turns
+        self.delims = delims
+        self.revision = revision
+        self.key = (revision, delimKey(delims))
+
+    def __len__(self):
+        return len(self.turns)
+    def __iter__(self):
+        return iter(self.turns)
+    def __getitem__(self, index):
+        return self.turns[index]
+
+    #raw text starting from turn index, empty if there is no such turn
+    def textFrom(self, index):
+        if index >= len(self.turns):
+            return ""
+        return self.text[self.turns[index].span[0]:]
+
+    def started(self):
+        return any(turn.role == "assistant" for turn in self.turns)
+
+
+def parse(text, delims, revision=None):
+    pattern = getPattern(delims)
+    lookup = {delims[role].lower(): role for role in roles}
+    turns = []
+    matches = list(pattern.finditer(text))
+    preamble = text[:matches[0].start()] if matches else text
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        turns.append(Turn(lookup[match.group().lower()], match.group(), text[match.end():end], (match.start(), end)))
+    return Transcript(text, preamble, turns, delims, revision)
+
+#turn structured turns back into raw text using the given delimiters
+def render(turns, delims, preamble=""):
+    return preamble + "".join(delims[turn.role] + turn.content for turn in turns)
+
+
+class TranscriptParser:
+    """Keeps the last parse so an unchanged document is never split twice."""
+    def __init__(self):
+        self.cached = None
+        self.hits = 0
+        self.misses = 0
+
+    #getText is only called when the revision or delimiters have changed
+    def parse(self, revision, delims, getText):
+        if self.cached is not None and self.cached.key == (revision, delimKey(delims)):
+            self.hits += 1
+            return self.cached
+        self.misses += 1
+        self.cached = parse(getText(), delims, revision)
+        return self.cached
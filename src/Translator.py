@@ -1,57 +1,153 @@
 import re
-import markdown
-import html2text
+
+from PyQt5.QtGui import QTextDocument, QTextDocumentFragment, QTextCursor
+
+from RenderCache import RenderCache
 
 
 class BaseTranslator:
-    """Abstract base class for translators."""
-    def rawToRich(self, richDisplay, rawDisplay):
-        raise NotImplementedError("Subclasses must implement rawToRich")
+    """Abstract base class for translators.
+
+    The rich pane is rendered a turn at a time. Rendered turns are cached by their text, and only turns that differ
+    from what the pane already shows are replaced, so typing or a finished response costs one turn rather than the
+    whole chat.
+    """
+    def __init__(self):
+        self.cache = RenderCache()
+        #what this translator last put in the rich pane: the document, its revision afterwards,
+        #and the text and first block number of each turn
+        self.document = None
+        self.revision = None
+        self.shown = []
+        self.blocks = []
 
     def richToRaw(self, delims, richDisplay, rawDisplay):
         raise NotImplementedError("Subclasses must implement richToRaw")
 
+    #one turn's text into a document of its own
+    def renderTurn(self, text, document):
+        raise NotImplementedError("Subclasses must implement renderTurn")
+
+    #a fragment loses the format of its first block when inserted, so that is kept alongside it
+    def renderFragment(self, text):
+        document = QTextDocument()
+        self.renderTurn(text, document)
+        return QTextDocumentFragment(document), document.begin().blockFormat(), document.begin().charFormat()
+
+    #a rendered turn at the cursor, which should be at the start of an empty block
+    def insertTurn(self, cursor, text):
+        fragment, blockFormat, charFormat = self.cache.get(text, self.renderFragment)
+        cursor.setBlockFormat(blockFormat)
+        cursor.setBlockCharFormat(charFormat)
+        cursor.insertFragment(fragment)
+
+    #segments are the raw text cut where each turn starts
+    def rawToRich(self, richDisplay, segments):
+        if not richDisplay.isVisible():
+            return
+        document = richDisplay.document()
+        #the pane was edited or filled by something else since, so nothing in it can be reused
+        if document is not self.document or document.revision() != self.revision or len(segments) == 0:
+            self.shown = []
+            self.blocks = []
+            document.clear()
+
+        old, new = self.shown, segments
+        first = 0
+        while first < min(len(old), len(new)) and old[first] == new[first]:
+            first += 1
+        kept = 0
+        while kept < min(len(old), len(new)) - first and old[-1 - kept] == new[-1 - kept]:
+            kept += 1
+        if first == len(old) == len(new):
+            return
+
+        scrollBar = richDisplay.verticalScrollBar()
+        atBottom = scrollBar.value() >= scrollBar.maximum()
+        richDisplay.blockSignals(True)
+        #undo can't be allowed to take turns out from under the block numbers
+        document.setUndoRedoEnabled(False)
+        cursor = QTextCursor(document)
+        blockCount = document.blockCount()
+        def position(turn):
+            return document.findBlockByNumber(self.blocks[turn]).position()
+        added = new[first:len(new) - kept]
+
+        #a selection from the start of a block leaves the block it ends in, so the first kept turn after the
+        #changed ones comes through whole, or with nothing kept an empty block is left to fill
+        if first < len(old) - kept:
+            cursor.setPosition(position(first))
+            cursor.setPosition(position(len(old) - kept) if kept > 0 else document.characterCount() - 1,
+                               QTextCursor.KeepAnchor)
+            cursor.removeSelectedText()
+            if kept == 0 and len(added) == 0:
+                #nothing is left after it, so the empty block is made like the one before and merged into it
+                block, previous = cursor.block(), cursor.block().previous()
+                if block.textList() is not None:
+                    block.textList().remove(block)
+                cursor.setBlockFormat(previous.blockFormat())
+                cursor.setBlockCharFormat(previous.charFormat())
+                if previous.textList() is not None:
+                    previous.textList().add(block)
+                cursor.deletePreviousChar()
+        elif kept > 0:
+            cursor.setPosition(position(first))
+        else:
+            cursor.movePosition(QTextCursor.End)
+            if len(old) > 0:
+                cursor.insertBlock()
+
+        if kept > 0 and len(added) > 0:
+            #split off the kept turn, with its own formats, and fill the empty block left in front of it
+            cursor.insertBlock(cursor.blockFormat(), cursor.blockCharFormat())
+            cursor.movePosition(QTextCursor.PreviousBlock)
+        blocks = self.blocks[:first]
+        for i, text in enumerate(added):
+            if i > 0:
+                cursor.insertBlock()
+            #the block can still be in a list from the text that was taken out
+            if cursor.block().textList() is not None:
+                cursor.block().textList().remove(cursor.block())
+            blocks.append(cursor.blockNumber())
+            self.insertTurn(cursor, text)
+        shift = document.blockCount() - blockCount
+        blocks += [block + shift for block in self.blocks[len(old) - kept:]]
+        document.setUndoRedoEnabled(True)
+        richDisplay.blockSignals(False)
+        if atBottom:
+            scrollBar.setValue(scrollBar.maximum())
+
+        self.shown = list(new)
+        self.blocks = blocks
+        self.document = document
+        self.revision = document.revision()
+
 
 class HTMLTranslator(BaseTranslator):
     """Translator for HTML content."""
-    def rawToRich(self, richDisplay, rawDisplay):
-        if richDisplay.isVisible():
-            text = rawDisplay.toPlainText()
-            savedCursor = richDisplay.textCursor()
-
-            # Convert Markdown delimiters to HTML
-            html = markdown.markdown(text, extensions = ["codehilite",
-                                                         "fenced_code",
-                                                         "footnotes",
-                                                         "sane_lists",
-                                                         "smarty",
-                                                         "tables",
-                                                         "wikilinks"
-                                                    ])
-            html = f"""
-            <html>
-            <head>
-            <style>
-            table, th, td {{
-                border: 1px solid black;
-                border-collapse: collapse;
-                padding: 4px;
-            }}
-            </style>
-            </head>
-            <body>
-            {html}
-            </body>
-            </html>
-            """
-
-            #html = markdown.markdown(text)
-
-            richDisplay.blockSignals(True)
-            richDisplay.setHtml(html)
-            richDisplay.blockSignals(False)
-
-            richDisplay.setTextCursor(savedCursor)
+    def __init__(self):
+        super().__init__()
+        #built on first use and reused, loading the extensions costs more than converting a turn
+        self.markdown = None
+        self.html2text = None
+
+    def toHtml(self, text):
+        if self.markdown is None:
+            #markdown and pygments are slow to import, so not until something is rendered
+            import markdown
+            self.markdown = markdown.Markdown(extensions = ["codehilite",
+                                                            "fenced_code",
+                                                            "footnotes",
+                                                            "sane_lists",
+                                                            "smarty",
+                                                            "tables",
+                                                            "wikilinks"
+                                                        ])
+        return self.markdown.reset().convert(text)
+
+    def renderTurn(self, text, document):
+        document.setDefaultStyleSheet("table, th, td { border: 1px solid black; border-collapse: collapse; padding: 4px; }")
+        document.setHtml(self.toHtml(text))
 
     def richToRaw(self, delims, richDisplay, rawDisplay):
         # Get HTML from rich display
@@ -60,13 +156,15 @@ class HTMLTranslator(BaseTranslator):
         savedCursor = rawDisplay.textCursor()
 
         # Convert HTML back to Markdown delimiters
-        h2t = html2text.HTML2Text()
-        h2t.body_width = 0   # prevent line wrapping
+        if self.html2text is None:
+            import html2text
+            self.html2text = html2text.HTML2Text()
+            self.html2text.body_width = 0   # prevent line wrapping
 
-        # Configure delimiter style
-        h2t.emphasis_mark = "*"  # use * instead of _
-        h2t.strong_mark = "**"  # use ** instead of __
-        richText = h2t.handle(html)
+            # Configure delimiter style
+            self.html2text.emphasis_mark = "*"  # use * instead of _
+            self.html2text.strong_mark = "**"  # use ** instead of __
+        richText = self.html2text.handle(html)
 
         """
         
@@ -89,19 +187,9 @@ class HTMLTranslator(BaseTranslator):
 
 class MarkdownTranslator(BaseTranslator):
     """Translator for Markdown content."""
-    def rawToRich(self, richDisplay, rawDisplay):
-        if richDisplay.isVisible():
-            text = rawDisplay.toPlainText()
-            text = re.sub(r': ```', ': \n```', text)
-            # text = text.split()
-            savedCursor = richDisplay.textCursor()
-
-            richDisplay.blockSignals(True)
-            richDisplay.setMarkdown(text)
-            # self.recolourMarkdown()
-            richDisplay.blockSignals(False)
-
-            richDisplay.setTextCursor(savedCursor)
+    def renderTurn(self, text, document):
+        text = re.sub(r': ```', ': \n```', text)
+        document.setMarkdown(text)
 
     def richToRaw(self, delims, richDisplay, rawDisplay):
         # Example: strip Markdown bold markers
@@ -122,19 +210,9 @@ class MarkdownTranslator(BaseTranslator):
 
 class CustomTranslator(BaseTranslator):
     """Translator for Markdown content."""
-    def rawToRich(self, richDisplay, rawDisplay):
-        if richDisplay.isVisible():
-            text = rawDisplay.toPlainText()
-            text = re.sub(r': ```', ': \n```', text)
-            # text = text.split()
-            savedCursor = richDisplay.textCursor()
-
-            richDisplay.blockSignals(True)
-            richDisplay.setMarkdown(text)
-            # self.recolourMarkdown()
-            richDisplay.blockSignals(False)
-
-            richDisplay.setTextCursor(savedCursor)
+    def renderTurn(self, text, document):
+        text = re.sub(r': ```', ': \n```', text)
+        document.setMarkdown(text)
 
     def richToRaw(self, delims, richDisplay, rawDisplay):
         # Example: strip Markdown bold markers
@@ -0,0 +1,243 @@
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QSize, QRectF, pyqtSignal
+from PyQt5.QtGui import QTextDocument, QTextCursor, QColor, QKeySequence
+from PyQt5.QtWidgets import QListView, QStyledItemDelegate, QTextEdit, QAbstractItemView, QApplication
+
+from RoleHighlighter import RoleHighlighter
+
+
+class TurnModel(QAbstractListModel):
+    """The chat's turns, one row each, kept in step with the raw pane by only touching rows that changed."""
+    roleRole = Qt.UserRole
+    delimRole = Qt.UserRole + 1
+    #row and its new content, the raw pane is edited and the model follows from that
+    edited = pyqtSignal(int, str)
+
+    def __init__(self):
+        super().__init__()
+        self.turns = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.turns)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        turn = self.turns[index.row()]
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return turn.content
+        if role == self.roleRole:
+            return turn.role
+        if role == self.delimRole:
+            return turn.delim
+        return None
+
+    def flags(self, index):
+        return super().flags(index) | Qt.ItemIsEditable
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or not index.isValid():
+            return False
+        self.edited.emit(index.row(), value)
+        return True
+
+    def setTurns(self, turns):
+        old = self.turns
+        #older turns put in front of the ones already shown, as a long chat is scrolled up
+        added = len(turns) - len(old)
+        if added > 0 and len(old) > 0 and all(a[:3] == b[:3] for a, b in zip(old, turns[added:])):
+            self.beginInsertRows(QModelIndex(), 0, added - 1)
+            self.turns = list(turns)
+            self.endInsertRows()
+            return
+        common = min(len(old), len(turns))
+        first = 0
+        while first < common and old[first][:3] == turns[first][:3]:
+            first += 1
+        last = common - 1
+        while last >= first and old[last][:3] == turns[last][:3]:
+            last -= 1
+        if len(turns) < len(old):
+            self.beginRemoveRows(QModelIndex(), len(turns), len(old) - 1)
+            self.turns = old[:len(turns)]
+            self.endRemoveRows()
+        if len(turns) > len(old):
+            self.beginInsertRows(QModelIndex(), len(old), len(turns) - 1)
+            self.turns = list(turns)
+            self.endInsertRows()
+        self.turns = list(turns)
+        if first <= last:
+            self.dataChanged.emit(self.index(first), self.index(last))
+
+    #streamed output goes on the end of the last turn without reparsing the chat
+    def appendToLast(self, text):
+        if len(self.turns) == 0:
+            return
+        last = self.turns[-1]
+        self.turns[-1] = last._replace(content=last.content + text)
+        self.dataChanged.emit(self.index(len(self.turns) - 1), self.index(len(self.turns) - 1))
+
+
+class TurnDelegate(QStyledItemDelegate):
+    """Draws a turn as its coloured role name over the rendered content.
+
+    Content is only rendered for turns that are painted, and the documents for the most recent are kept. Heights
+    are cached by row and width, a turn that hasn't been painted at that width gets an estimate from its length
+    until it is.
+    """
+    padding = 6
+    maxDocuments = 64
+
+    def __init__(self, view):
+        super().__init__(view)
+        self.view = view
+        self.translator = None
+        #row -> (content check, width, height, exact)
+        self.heights = {}
+        #row -> (content check, width, document), least recently painted first
+        self.documents = OrderedDict()
+        self.rendered = 0
+
+    @staticmethod
+    def check(index):
+        content = index.data(Qt.DisplayRole)
+        return (index.data(TurnModel.roleRole), len(content), hash(content))
+
+    def textWidth(self, option):
+        return max(50, self.view.viewport().width() - 2 * self.padding)
+
+    def headerHeight(self, option):
+        return option.fontMetrics.height()
+
+    def sizeHint(self, option, index):
+        width = self.textWidth(option)
+        check = self.check(index)
+        cached = self.heights.get(index.row())
+        if cached is None or cached[0] != check or cached[1] != width:
+            cached = (check, width, self.estimate(index.data(Qt.DisplayRole), width, option), False)
+            self.heights[index.row()] = cached
+        return QSize(width, cached[2])
+
+    #wrapped lines of plain text, close enough to keep the scrollbar honest
+    def estimate(self, content, width, option):
+        metrics = option.fontMetrics
+        perLine = max(1, width // max(1, metrics.averageCharWidth()))
+        lines = sum(1 + len(line) // perLine for line in content.strip().split("\n"))
+        return self.headerHeight(option) + lines * metrics.lineSpacing() + 2 * self.padding
+
+    def document(self, index, width, option):
+        row = index.row()
+        check = self.check(index)
+        cached = self.documents.get(row)
+        if cached is not None and cached[0] == check and cached[1] == width:
+            self.documents.move_to_end(row)
+            return cached[2]
+        document = QTextDocument()
+        document.setDefaultFont(option.font)
+        document.setDocumentMargin(0)
+        self.translator.insertTurn(QTextCursor(document), index.data(Qt.DisplayRole).strip())
+        document.setTextWidth(width)
+        self.rendered += 1
+        self.documents[row] = (check, width, document)
+        self.documents.move_to_end(row)
+        while len(self.documents) > self.maxDocuments:
+            self.documents.popitem(last=False)
+        return document
+
+    def paint(self, painter, option, index):
+        width = self.textWidth(option)
+        document = self.document(index, width, option)
+        header = self.headerHeight(option)
+        rect = option.rect
+
+        painter.save()
+        painter.setPen(QColor(RoleHighlighter.colours.get(index.data(TurnModel.roleRole), "black")))
+        painter.drawText(rect.adjusted(self.padding, self.padding, -self.padding, 0), Qt.AlignLeft | Qt.AlignTop,
+                         index.data(TurnModel.delimRole))
+        painter.translate(rect.left() + self.padding, rect.top() + self.padding + header)
+        document.drawContents(painter, QRectF(0, 0, width, document.size().height()))
+        painter.restore()
+
+        #now it has been laid out the estimate can be replaced
+        height = int(document.size().height()) + header + 2 * self.padding
+        cached = self.heights.get(index.row())
+        if cached is None or not cached[3] or cached[2] != height or cached[1] != width:
+            self.heights[index.row()] = (self.check(index), width, height, True)
+            if cached is None or cached[2] != height:
+                self.sizeHintChanged.emit(index)
+
+    #the raw text of just this turn
+    def createEditor(self, parent, option, index):
+        editor = QTextEdit(parent)
+        editor.setAcceptRichText(False)
+        editor.setMinimumHeight(120)
+        return editor
+
+    def setEditorData(self, editor, index):
+        editor.setPlainText(index.data(Qt.EditRole).strip())
+
+    def setModelData(self, editor, model, index):
+        if editor.toPlainText() != index.data(Qt.EditRole).strip():
+            model.setData(index, editor.toPlainText(), Qt.EditRole)
+
+    def updateEditorGeometry(self, editor, option, index):
+        editor.setGeometry(option.rect)
+
+    #rows put in front of others take their cached heights and documents along with them
+    def shift(self, parent, first, last):
+        count = last - first + 1
+        self.heights = {row + count if row >= first else row: value for row, value in self.heights.items()}
+        self.documents = OrderedDict((row + count if row >= first else row, value) for row, value in self.documents.items())
+
+    #rows moved, so nothing cached by row can be trusted
+    def clear(self):
+        self.heights.clear()
+        self.documents.clear()
+
+
+class TurnView(QListView):
+    """The rich pane as a list of turns, so only the turns on screen are laid out and drawn.
+
+    Double click or F2 edits a turn's raw text, ctrl+c copies the current turn.
+    """
+    def __init__(self):
+        super().__init__()
+        self.turnModel = TurnModel()
+        self.turnDelegate = TurnDelegate(self)
+        self.setModel(self.turnModel)
+        self.setItemDelegate(self.turnDelegate)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setResizeMode(QListView.Adjust)
+        #long chats are laid out a batch at a time instead of all before the first paint
+        self.setLayoutMode(QListView.Batched)
+        self.setBatchSize(200)
+        self.setUniformItemSizes(False)
+        self.setWordWrap(True)
+        self.setSelectionMode(QAbstractItemView.NoSelection)
+        self.setEditTriggers(QAbstractItemView.DoubleClicked | QAbstractItemView.EditKeyPressed)
+        self.turnModel.rowsRemoved.connect(self.turnDelegate.clear)
+        self.turnModel.rowsInserted.connect(self.turnDelegate.shift)
+        #a view scrolled to the end stays there as turns grow, even once painting corrects their heights
+        self.atBottom = True
+        self.verticalScrollBar().valueChanged.connect(self.trackBottom)
+        self.verticalScrollBar().rangeChanged.connect(self.keepAtBottom)
+
+    def setTranslator(self, translator):
+        self.turnDelegate.translator = translator
+        self.turnDelegate.clear()
+        self.viewport().update()
+
+    def trackBottom(self, value):
+        self.atBottom = value >= self.verticalScrollBar().maximum()
+
+    def keepAtBottom(self, low, high):
+        if self.atBottom:
+            self.verticalScrollBar().setValue(high)
+
+    def keyPressEvent(self, event):
+        if event.matches(QKeySequence.Copy) and self.currentIndex().isValid():
+            QApplication.clipboard().setText(self.currentIndex().data(Qt.DisplayRole).strip())
+            return
+        super().keyPressEvent(event)
@@ -1,8 +1,9 @@
+from StartupProfiler import profiler
+
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
 from PyQt5.QtGui import QFont
 from PyQt5.QtWidgets import QApplication
 
-from App import App
-
 import os
 import sys
 import winshell
@@ -10,7 +11,9 @@ from win32com.client import Dispatch
 import keyboard
 import ctypes
 import threading
-import subprocess
+from pathlib import Path
+
+profiler.mark("imports")
 
 appName = "ollamaChat"
 
@@ -42,19 +45,35 @@ def addStartup():
         shortcut.WindowStyle = 7
         shortcut.save()
 addStartup()
+profiler.mark("startup shortcut")
 
-
-CREATE_NO_WINDOW = 0x08000000
-subprocess.Popen(["ollama", "serve"], creationflags=CREATE_NO_WINDOW)
 app = QApplication(sys.argv)
 font = QFont("Arial", 11)
 app.setFont(font)
-chat = App(app.primaryScreen().availableGeometry(), appName)
+profiler.mark("qt")
+
+#the hotkey is live before the window exists, presses wait in the event queue until it does
+class HotkeyRelay(QObject):
+    pressed = pyqtSignal()
+relay = HotkeyRelay()
+chat = None
+relay.pressed.connect(lambda: chat.toggleSignal.emit() if chat is not None else None)
 
 def hotkey_listener():
-    keyboard.add_hotkey('ctrl+alt+space', lambda: chat.toggleSignal.emit())
+    keyboard.add_hotkey('ctrl+alt+space', lambda: relay.pressed.emit())
     keyboard.wait()
 threading.Thread(target=hotkey_listener, daemon=True).start()
+profiler.mark("hotkey")
+
+#build the window hidden once the event loop is running
+def createWindow():
+    global chat
+    from App import App
+    profiler.mark("import app")
+    chat = App(app.primaryScreen().availableGeometry(), appName)
+    profiler.mark("window")
+    profiler.dump(Path.home() / f"AppData/Roaming/{appName}/startup.log")
+QTimer.singleShot(0, createWindow)
 
 app.exec()
 